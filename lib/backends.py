@@ -0,0 +1,100 @@
+'''
+Database backends for `DbSession`.
+
+The connection string (`DBCONN`) chooses the backend. An ODBC connection string connects to SQL Server through
+pyodbc, as on the OpenSAFELY server. A string starting with a registered scheme, e.g. `duckdb:../.cache/local.duckdb`,
+connects to another engine instead. That engine is handed the same T-SQL, and must translate it and provide the
+DB-API calls the session uses (see `local.py`, the embedded engine used to run the notebook on simulated data).
+'''
+import os
+import re
+
+
+# key=value fields of an ODBC connection string (values may be braced)
+ODBC_FIELD = re.compile(r"([^;=\s][^;=]*?)\s*=\s*(\{[^}]*\}|[^;]*)")
+
+# scheme -> function called with the rest of the connection string, returning a DB-API connection
+BACKENDS = {}
+# schemes whose databases can only be opened by one process at a time (connections must share that process)
+SINGLE_PROCESS = set()
+# scheme -> function returning the exception class raised by its connections
+ERRORS = {}
+
+
+def register_backend(scheme, connect, single_process=False, errors=None):
+    '''
+    Add a backend for connection strings of the form "<scheme>:<target>".
+
+    INPUTS:
+    scheme (str): prefix of the connection strings to handle, e.g. "duckdb"
+    connect (function): called as connect(target), returning a DB-API connection in autocommit mode
+    single_process (bool): the database can only be opened by one process at once (e.g. an embedded engine's file)
+    errors (function): called with no arguments, returning the exception class its connections raise (the base class
+                       of its DB-API errors); any exception is treated as a database error if not given
+
+    OUTPUTS:
+    None
+    '''
+    BACKENDS[scheme] = connect
+    ERRORS[scheme] = errors if errors is not None else (lambda: Exception)
+    if single_process:
+        SINGLE_PROCESS.add(scheme)
+    else:
+        SINGLE_PROCESS.discard(scheme)
+
+
+# the local engine (and duckdb) and pyodbc (and unixODBC) are imported when they are used, so each backend only needs
+# its own driver installed
+
+def _connect_local(target):
+    from local import connect
+    return connect(target)
+
+
+def _local_errors():
+    from local import Error
+    return Error
+
+
+# DuckDB locks its file to the process which opened it
+register_backend("duckdb", _connect_local, single_process=True, errors=_local_errors)
+
+
+def connect(dbconn):
+    '''Open a connection for a connection string, with whichever backend handles it (SQL Server by default)'''
+    scheme, _, target = dbconn.partition(":")
+    if scheme in BACKENDS:
+        return BACKENDS[scheme](target)
+    import pyodbc
+    return pyodbc.connect(dbconn, autocommit=True)
+
+
+def errors(dbconn):
+    '''The exception class raised by connections to a database (pyodbc.Error for SQL Server), to catch their errors'''
+    scheme = dbconn.partition(":")[0]
+    if scheme in BACKENDS:
+        return ERRORS[scheme]()
+    import pyodbc
+    return pyodbc.Error
+
+
+def single_process(dbconn):
+    '''Whether every connection to a database must be opened from the same process'''
+    return dbconn.partition(":")[0] in SINGLE_PROCESS
+
+
+def database_id(dbconn):
+    '''
+    Identity of the database a connection string opens, without its credentials: the server and database of an ODBC
+    connection string, or the scheme and (absolute) path of another backend's. Results cached from one database are
+    keyed on this, so they are never returned for another.
+
+    OUTPUTS:
+    id (str)
+    '''
+    scheme, _, target = dbconn.partition(":")
+    if scheme in BACKENDS:
+        return f"{scheme}:{os.path.abspath(target) if target else ''}"
+    fields = {k.strip().upper(): v.strip().strip("{}") for k, v in ODBC_FIELD.findall(dbconn)}
+    server = fields.get("SERVER", fields.get("ADDRESS", fields.get("ADDR", "")))
+    return f"{server}/{fields.get('DATABASE', fields.get('INITIAL CATALOG', ''))}".lower()
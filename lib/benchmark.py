@@ -0,0 +1,365 @@
+'''
+Benchmarks of each stage of the anticoagulant analyses, at several data scales, against the local DuckDB backend.
+
+For each scale a simulated database (see `simulate.py`) is built once, under `.cache/benchmark/`, and every stage
+of the notebook is run on it in order, on a fresh session with no query cache:
+
+codelists (dm+d -> Multilex resolution and loading the code tables), staging, issues (monthly counts), repeats
+(monthly repeat counts), same_day (duplicate issues), doac_repeats (DOAC repeat switching), switching (the baseline
+vs follow-up comparison, for both periods), inr (the INR testing series) and ttr (TTRs, and whether patients were
+tested again the next month).
+
+Each stage reports its wall time, peak memory (the most the process grew by while it ran, which includes the
+embedded engine) and rows/sec (rows of its input table processed per second). With `--save` the results are stored
+as the baseline for that scale in `benchmarks/`, and later runs are compared to it, so a revision which slows a
+stage down shows up:
+
+    python benchmark.py --scales 10k 1m --repeat 3 --save    # record baselines
+    python benchmark.py --scales 10k 1m --repeat 3           # compare (exits with 1 if any stage has slowed)
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import tracemalloc
+import subprocess
+
+import pandas as pd
+
+from db import DbSession
+from queries import load_codelists, PERIODS
+from codelists import file_hash, _query_dictionary
+from staging import stage
+import simulate
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA_DIR = os.path.join(ROOT, ".cache", "benchmark")
+BASELINE_DIR = os.path.join(ROOT, "benchmarks")
+
+SCALES = {"10k": 10000, "100k": 100000, "1m": 1000000, "10m": 10000000}
+
+# patients simulated and loaded at a time, so building the larger databases needs bounded memory
+BATCH = 250000
+
+# a stage is reported as slower than its baseline if it takes this much longer (as a fraction), and by at least
+# MIN_SECONDS (shorter differences are mostly noise)
+TOLERANCE = 0.2
+MIN_SECONDS = 0.05
+
+# the switching comparison periods, as in the notebook
+PERIOD_DATES = [['20191201', '20200301', '20200531', '20181201', '20190301', '20190531'],
+                ['20200301', '20200601', '20200831', '20190301', '20190601', '20190831']]
+
+
+##### simulated databases ########
+
+def database(scale, seed=1, rebuild=False):
+    '''
+    Connection string for the simulated database of a scale, building it first if it doesn't exist (or was built
+    by a different version of the simulation).
+
+    INPUTS:
+    scale (str): key of SCALES, e.g. "1m"
+    seed (int): seed for the simulation
+    rebuild (bool): rebuild the database even if it is up to date
+
+    OUTPUTS:
+    dbconn (str): "duckdb:<path>" connection string
+    '''
+    patients = SCALES[scale]
+    path = os.path.join(DATA_DIR, f"{scale}.duckdb")
+    meta = {"patients": patients, "seed": seed, "simulate": file_hash(simulate.__file__)}
+    meta_path = path + ".json"
+    if not rebuild and os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return "duckdb:" + path
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for f in (path, meta_path):
+        if os.path.exists(f):
+            os.remove(f)
+    dbconn = "duckdb:" + path
+    for first in range(0, patients, BATCH):
+        tables = simulate.simulate(patients=min(BATCH, patients - first), seed=seed + first // BATCH)
+        for table in ("MedicationIssue", "MedicationRepeat", "CodedEvent"):
+            tables[table]["Patient_ID"] += first
+        if first > 0:
+            tables.pop("MedicationDictionary")
+        simulate.load(dbconn, tables, replace=first == 0)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return dbconn
+
+
+##### stages ########
+
+def _codelists(connection, context):
+    ids = {}
+    for anticoag, name in [("warfarin", "warfarin_codelist.csv"), ("DOAC", "doac_codelist.csv")]:
+        codelist = pd.read_csv(os.path.join(ROOT, "local_codelists", name))
+        # queried directly, rather than through `drug_codelist`, so the local codelist cache is neither used nor
+        # overwritten with the simulated dictionary
+        ids[anticoag] = tuple(_query_dictionary(codelist, connection.dbconn)["MultilexDrug_ID"].astype(str))
+    ctv3 = {}
+    for group, name in [("inr", "opensafely-international-normalised-ratio-inr.csv"),
+                        ("high_inr", "opensafely-high-international-normalised-ratio-inr.csv")]:
+        ctv3[group] = list(pd.read_csv(os.path.join(ROOT, "codelists", name))["id"])
+    load_codelists(connection, drugs=ids, ctv3=ctv3)
+
+
+def _issues(connection, context):
+    connection.run("issues/allpts", start=context["start"])
+    connection.read("issues/by_anticoag")
+    connection.read("issues/total")
+
+
+def _same_day(connection, context):
+    connection.read("issues/same_day")
+
+
+def _repeats(connection, context):
+    connection.run("repeats/temp", start=context["start"])
+    connection.run("repeats/rpts2", start=context["start"])
+    connection.run("repeats/results")
+    connection.read("repeats/summary")
+
+
+def _doac_repeats(connection, context):
+    connection.run("doac_repeats/doacR", start=context["start"])
+    connection.run("doac_repeats/warfdoac", start=context["warfdoac_start"])
+    connection.run("doac_repeats/out")
+    connection.read("doac_repeats/summary")
+
+
+def _switching(connection, context):
+    for dates in PERIOD_DATES:
+        periods = dict(zip(PERIODS, dates))
+        connection.run("switching/baseline", **periods)
+        connection.run("switching/doac_fu", **periods)
+        connection.run("switching/doac")
+        connection.run("switching/doac_type_a")
+        connection.run("switching/doac_type_b")
+        connection.run("switching/warf2", **periods)
+        connection.run("switching/inr", **periods)
+        connection.run("switching/out")
+        connection.read("switching/summary")
+        connection.read("switching/doac_types")
+
+
+def _inr(connection, context):
+    connection.run("inr_testing/inr_all", start=context["start"])
+    connection.run("inr_testing/months", first_month=context["start"], months=20)
+    connection.run("inr_testing/warf")
+    connection.run("inr_testing/inr")
+    connection.read("inr_testing/summary")
+
+
+def _ttr(connection, context):
+    connection.run("ttr/ttr", start='20190301', end='20200830')
+    connection.run("ttr/warfissue", start='20181201', end='20200830')
+    connection.run("ttr/warftests")
+    connection.run("ttr/out")
+    for template in ("ttr/split", "ttr/overall", "ttr/binned"):
+        connection.read(template)
+
+
+# name, function, and the tables whose rows are counted as the stage's input (for rows/sec).
+# Stages run in this order, each on the tables built by the ones before it
+STAGES = [
+    ("codelists", _codelists, ["MedicationDictionary"]),
+    ("staging", lambda connection, context: stage(connection), ["MedicationIssue", "MedicationRepeat"]),
+    ("issues", _issues, ["#ac_issues"]),
+    ("same_day", _same_day, ["#allpts"]),
+    ("repeats", _repeats, ["#ac_issues", "#ac_repeats"]),
+    ("doac_repeats", _doac_repeats, ["#ac_repeats"]),
+    ("switching", _switching, ["#ac_issues", "CodedEvent"]),
+    ("inr", _inr, ["#ac_issues", "CodedEvent"]),
+    ("ttr", _ttr, ["#ac_issues", "CodedEvent"]),
+]
+
+
+##### measurement ########
+
+def _rss():
+    '''Resident memory of this process in bytes, or None where /proc isn't available'''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class PeakMemory:
+    '''
+    Context manager measuring the most memory grew by while it was open, by sampling the resident memory of the
+    process (so memory used by the embedded database engine is included). Where that isn't available, falls back
+    to the peak of Python allocations (tracemalloc).
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, _rss() - self._start)
+
+    def __enter__(self):
+        self._start = _rss()
+        if self._start is None:
+            tracemalloc.start()
+        else:
+            self._done = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._start is None:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            self._done.set()
+            self._thread.join()
+            self.peak = max(self.peak, _rss() - self._start)
+        return False
+
+
+def _rows(connection, tables):
+    return sum(int(connection.read_sql(f"SELECT COUNT(*) AS n FROM {t}")["n"].iloc[0]) for t in tables)
+
+
+def run_stages(dbconn, stages=None, repeat=1):
+    '''
+    Run the stages in order on fresh sessions, timing each.
+
+    INPUTS:
+    dbconn (str): connection string of the database to run on
+    stages (list): names of the stages to report (all by default); the stages they depend on are run but not reported
+    repeat (int): times to run the stages; the fastest time, and the largest peak memory, of each is reported
+
+    OUTPUTS:
+    results (df): seconds, peak_mb, rows and rows_per_sec for each stage, indexed by stage
+    '''
+    names = [s[0] for s in STAGES]
+    stages = names if stages is None else stages
+    unknown = set(stages) - set(names)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    last = max(names.index(s) for s in stages)
+    context = {"start": '20190101', "warfdoac_start": '20180601'}
+
+    results = {}
+    for _ in range(repeat):
+        connection = DbSession(dbconn, name="benchmark")
+        try:
+            for name, func, inputs in STAGES[:last + 1]:
+                rows = _rows(connection, inputs)
+                with PeakMemory() as memory:
+                    started = time.perf_counter()
+                    func(connection, context)
+                    seconds = time.perf_counter() - started
+                if name not in stages:
+                    continue
+                best = results.get(name)
+                results[name] = {"seconds": seconds if best is None else min(seconds, best["seconds"]),
+                                 "peak_mb": memory.peak / 2**20 if best is None else
+                                 max(memory.peak / 2**20, best["peak_mb"]),
+                                 "rows": rows}
+        finally:
+            connection.reset()
+
+    out = pd.DataFrame.from_dict(results, orient="index").loc[stages]
+    out["rows_per_sec"] = out["rows"] / out["seconds"]
+    return out
+
+
+##### baselines ########
+
+def _baseline_path(scale):
+    return os.path.join(BASELINE_DIR, f"{scale}.json")
+
+
+def _revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_baseline(scale):
+    '''Stored baseline results for a scale (as returned by `run_stages`), or None if there are none'''
+    path = _baseline_path(scale)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return pd.DataFrame.from_dict(json.load(f)["stages"], orient="index")
+
+
+def save_baseline(scale, results):
+    '''
+    Store results as the baseline for a scale, with the revision and machine they were measured on. Stages not in
+    the results keep their stored baseline.
+    '''
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    stored = load_baseline(scale)
+    if stored is not None:
+        results = pd.concat([stored.drop(results.index, errors="ignore"), results], sort=False)
+    record = {"revision": _revision(), "date": time.strftime("%Y-%m-%d"), "machine": platform.node(),
+              "python": platform.python_version(), "patients": SCALES[scale],
+              "stages": json.loads(results.to_json(orient="index"))}
+    with open(_baseline_path(scale), "w") as f:
+        json.dump(record, f, indent=2)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''
+    Compare results with a baseline.
+
+    INPUTS:
+    results (df): results of `run_stages`
+    baseline (df): baseline results, or None
+    tolerance (float): fraction by which a stage may be slower than its baseline before it is flagged (if it is
+                       also at least MIN_SECONDS slower)
+
+    OUTPUTS:
+    out (df): results, with the baseline seconds, the ratio to them and a "slower" flag for each stage
+    '''
+    out = results.copy()
+    if baseline is None:
+        return out
+    out["baseline_seconds"] = baseline["seconds"].reindex(out.index)
+    out["ratio"] = out["seconds"] / out["baseline_seconds"]
+    out["slower"] = (out["ratio"] > 1 + tolerance) & (out["seconds"] - out["baseline_seconds"] > MIN_SECONDS)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the analyses on simulated data")
+    parser.add_argument("--scales", nargs="+", default=["10k"], choices=list(SCALES))
+    parser.add_argument("--stages", nargs="+", default=None, choices=[s[0] for s in STAGES])
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each stage (the fastest is reported)")
+    parser.add_argument("--save", action="store_true", help="store the results as the baselines")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="fraction slower than the baseline at which a stage is flagged")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the simulated databases")
+    args = parser.parse_args()
+
+    slower = False
+    for scale in args.scales:
+        dbconn = database(scale, rebuild=args.rebuild)
+        results = run_stages(dbconn, stages=args.stages, repeat=args.repeat)
+        out = compare(results, None if args.save else load_baseline(scale), tolerance=args.tolerance)
+        print(f"\n{scale} patients ({dbconn})")
+        print(out.round({"seconds": 3, "peak_mb": 1, "rows_per_sec": 0, "baseline_seconds": 3, "ratio": 2}).to_string())
+        if args.save:
+            save_baseline(scale, results)
+        elif "slower" in out:
+            slower = slower or bool(out["slower"].any())
+    sys.exit(1 if slower else 0)
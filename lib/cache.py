@@ -0,0 +1,166 @@
+'''
+Local cache of SQL Server query results - the equivalent of `bq.cached_read` for the TPP database.
+
+Results are stored as Parquet (so dtypes survive the round trip) under `.cache/queries/`, keyed on a hash of:
+- the database it was read from (server and database, see `backends.database_id`)
+- the normalised SQL text and its parameter values
+- how every temp table it reads was built (see `DbSession.lineage`)
+- the contents of the codelists used
+- the database snapshot identifier (`DB_SNAPSHOT`)
+- the current month, for queries which use GETDATE()
+
+so that results are only reused when they would come out the same. Attach a cache to a session with
+`connection.use_cache(QueryCache(dbconn, ...))`; every `connection.read(...)` then goes through it.
+
+Queries which don't depend on the current month are only re-run when the snapshot changes, so a cache should only be
+attached when `DB_SNAPSHOT` identifies the version of the database; the notebook runs without one otherwise.
+'''
+import os
+import re
+import json
+import time
+import hashlib
+
+import pandas as pd
+
+from codelists import file_hash
+from backends import database_id
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "queries")
+
+COMMENT = re.compile(r"--[^\n]*")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalise(sql):
+    '''SQL without comments, and with all whitespace collapsed, so that layout changes don't invalidate the cache'''
+    return WHITESPACE.sub(" ", COMMENT.sub("", sql)).strip()
+
+
+def _normalise_key(key):
+    '''Normalise any SQL within the (nested) record of how a table was built'''
+    if isinstance(key, str):
+        return normalise(key)
+    if isinstance(key, (tuple, list)):
+        return [_normalise_key(k) for k in key]
+    return str(key)
+
+
+class QueryCache:
+    '''
+    INPUTS:
+    dbconn (str): connection string of the database the results are read from (only its server and database are kept)
+    codelists (list): paths of codelist CSVs the results depend on
+    snapshot (str): identifier for the version of the database (e.g. the build date); a change invalidates the cache
+    ttl (int): seconds after which cached results expire (None to keep until invalidated)
+    directory (str): where results are stored
+    '''
+
+    def __init__(self, dbconn, codelists=None, snapshot=None, ttl=None, directory=CACHE_DIR):
+        self.database = database_id(dbconn)
+        self.codelists = {os.path.basename(p): file_hash(p) for p in (codelists or [])}
+        self.snapshot = "" if snapshot is None else str(snapshot)
+        self.ttl = ttl
+        self.directory = directory
+
+    def key(self, query, params, lineage):
+        '''Hash identifying a query's results'''
+        content = {
+            "database": self.database,
+            "sql": normalise(query),
+            "params": [str(p) for p in (params or [])],
+            "tables": [[table, _normalise_key(k)] for table, k in lineage],
+            "codelists": self.codelists,
+            "snapshot": self.snapshot,
+        }
+        # queries cut off at the current month (GETDATE()) give different results each month
+        if "GETDATE(" in json.dumps(content).upper():
+            content["month"] = time.strftime("%Y-%m")
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + ".parquet"), os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        '''Cached results, or None if there are none (or they have expired)'''
+        data, meta = self._paths(key)
+        if not (os.path.exists(data) and os.path.exists(meta)):
+            return None
+        with open(meta) as f:
+            created = json.load(f)["created"]
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return None
+        return pd.read_parquet(data)
+
+    def put(self, key, df, label=None, query=None):
+        os.makedirs(self.directory, exist_ok=True)
+        data, meta = self._paths(key)
+        # write to temporary files first so an interrupted write never leaves a half-written entry behind
+        df.to_parquet(data + ".tmp", index=False)
+        with open(meta + ".tmp", "w") as f:
+            json.dump({"label": label, "created": time.time(), "query": query}, f)
+        os.replace(data + ".tmp", data)
+        os.replace(meta + ".tmp", meta)
+
+    def invalidate(self, label=None):
+        '''
+        Remove cached results.
+
+        INPUTS:
+        label (str): only remove results of queries with this label (template name), or whose label starts with it
+                     if it ends in "/" (e.g. "switching/"). If None, everything is removed
+
+        OUTPUTS:
+        removed (int): number of results removed
+        '''
+        if not os.path.exists(self.directory):
+            return 0
+        removed = 0
+        for f in os.listdir(self.directory):
+            if not f.endswith(".json"):
+                continue
+            meta = os.path.join(self.directory, f)
+            if label is not None:
+                with open(meta) as m:
+                    stored = json.load(m)["label"] or ""
+                if not (stored == label or (label.endswith("/") and stored.startswith(label))):
+                    continue
+            data = meta[:-len(".json")] + ".parquet"
+            for path in (data, meta):
+                if os.path.exists(path):
+                    os.remove(path)
+            removed += 1
+        return removed
+
+    def read_sql(self, connection, query, params=None, label=None, refresh=False):
+        '''
+        Read the results of a query on a session, from the cache if possible.
+
+        INPUTS:
+        connection (DbSession): session to run the query on if it isn't cached
+        query (str): SQL returning results
+        params (list): values for any ? markers in the query
+        label (str): name to store the results under, for `invalidate`
+        refresh (bool): ignore any cached results (and replace them)
+
+        OUTPUTS:
+        df (df): results
+        '''
+        lineage = connection.lineage(query)
+        if lineage is None:
+            # a temp table it reads has been changed in a way that can't be tracked (e.g. dummy data inserted)
+            return connection.read_sql(query, params=params, label=label)
+        key = self.key(query, params, lineage)
+        if not refresh:
+            df = self.get(key)
+            if df is not None:
+                return df
+        df = connection.read_sql(query, params=params, label=label)
+        self.put(key, df, label=label, query=query)
+        return df
+
+
+def cached_read_sql(connection, query, cache, params=None, label=None, refresh=False):
+    '''Read the results of a query on a session through a `QueryCache` (see `QueryCache.read_sql`)'''
+    return cache.read_sql(connection, query, params=params, label=label, refresh=refresh)
@@ -0,0 +1,124 @@
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from db import session
+from backends import database_id
+
+
+# resolved codelists are cached here, outside of version control
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "codelists")
+
+# codes bound per dictionary lookup
+PARAM_BATCH = 1000
+
+
+def file_hash(path):
+    '''sha256 of a file's contents'''
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _query_dictionary(codelist, dbconn):
+    '''Look up the Multilex drug IDs for a dm+d codelist in MedicationDictionary'''
+    codes = list(codelist["id"].astype("str"))
+    out = []
+    with session(dbconn) as connection:
+        # codes are bound as parameters, in batches below SQL Server's limit of 2100 per statement
+        for i in range(0, len(codes), PARAM_BATCH):
+            batch = codes[i:i + PARAM_BATCH]
+            query = f'''SELECT
+            MultilexDrug_ID, DMD_ID
+            FROM
+              MedicationDictionary
+            WHERE
+              DMD_ID IN ({", ".join("?"*len(batch))})
+            '''
+            out.append(connection.read_sql(query, params=batch))
+    return pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=["MultilexDrug_ID", "DMD_ID"])
+
+
+def _cache_path(path):
+    return os.path.join(CACHE_DIR, os.path.splitext(os.path.basename(path))[0] + ".npz")
+
+
+def _database_hash(dbconn):
+    '''sha256 of the server and database a connection string opens (see `backends.database_id`)'''
+    return hashlib.sha256(database_id(dbconn).encode()).hexdigest()
+
+
+def _read_cache(path, csv_hash, snapshot, database):
+    '''
+    Return the cached lookup if it was resolved from the same CSV contents, on the same database and dictionary
+    snapshot, else None
+    '''
+    cache = _cache_path(path)
+    if not os.path.exists(cache):
+        return None
+    with np.load(cache, allow_pickle=False) as f:
+        # caches written before the database was recorded can't be trusted for any database
+        if "database" not in f.files or str(f["database"]) != database:
+            return None
+        if str(f["csv_hash"]) != csv_hash or str(f["snapshot"]) != snapshot:
+            return None
+        return pd.DataFrame({"MultilexDrug_ID": f["MultilexDrug_ID"].astype(str), "DMD_ID": f["DMD_ID"]})
+
+
+def cached_lookup(path):
+    '''Return the last resolved lookup for a codelist, whichever CSV or snapshot it was resolved from, else None'''
+    cache = _cache_path(path)
+    if not os.path.exists(cache):
+        return None
+    with np.load(cache, allow_pickle=False) as f:
+        return pd.DataFrame({"MultilexDrug_ID": f["MultilexDrug_ID"].astype(str), "DMD_ID": f["DMD_ID"]})
+
+
+def _write_cache(path, csv_hash, snapshot, database, out):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache = _cache_path(path)
+    # write to a temporary file first so an interrupted write never leaves a half-written cache behind
+    tmp = cache + ".tmp.npz"
+    np.savez_compressed(tmp,
+                        MultilexDrug_ID=out["MultilexDrug_ID"].to_numpy(dtype=str),
+                        DMD_ID=out["DMD_ID"].to_numpy(dtype=np.int64),
+                        csv_hash=np.array(csv_hash),
+                        snapshot=np.array(snapshot),
+                        database=np.array(database))
+    os.replace(tmp, cache)
+
+
+def drug_codelist(path, dbconn, snapshot=None, refresh=False):
+    '''
+    Resolve a dm+d codelist to Multilex drug IDs, using a local cache so the database is only queried when the
+    codelist CSV, the database (server and database name) or the dictionary snapshot has changed.
+
+    INPUTS:
+    path (str): path to codelist CSV (with an "id" column of dm+d codes)
+    dbconn (str): ODBC connection string; the database it opens is recorded with the cache, which is only queried if
+                  the cache needs refreshing
+    snapshot (str): identifier for the version of MedicationDictionary (e.g. the database build date); a change
+                    invalidates the cache
+    refresh (bool): ignore the cache and query the database
+
+    OUTPUTS:
+    out (df): MultilexDrug_ID and DMD_ID for each resolved drug
+    ids (tuple): Multilex IDs, for use in SQL strings and dummy data
+    '''
+    snapshot = "" if snapshot is None else str(snapshot)
+    csv_hash = file_hash(path)
+    database = _database_hash(dbconn)
+
+    out = None if refresh else _read_cache(path, csv_hash, snapshot, database)
+    if out is None:
+        codelist = pd.read_csv(path)
+        out = _query_dictionary(codelist, dbconn)
+        out["MultilexDrug_ID"] = out["MultilexDrug_ID"].astype(str)
+        out["DMD_ID"] = out["DMD_ID"].astype(np.int64)
+        _write_cache(path, csv_hash, snapshot, database, out)
+
+    return out, tuple(out["MultilexDrug_ID"])
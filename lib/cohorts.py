@@ -0,0 +1,365 @@
+'''
+Cohort index: compressed bitmaps of the patients with each kind of event in each month.
+
+Most of the notebook's outputs are `COUNT(DISTINCT Patient_ID)` over some combination of month, drug class and
+event (issued, on a repeat, tested), and each definition is another query. Instead, the patients with each event in
+each month are held as a bitmap, keyed by (event, anticoag, month), built once from the extracted timelines (see
+`timelines.py`). A cohort is then a union of bitmaps over months, combined with `&`, `|` and `-`, and its count is
+the size of the result, with no SQL:
+
+    index = CohortIndex.build(Timelines.extract(connection), start="2019-01-01")
+    index.save()
+
+    def tested_warfarin(month):
+        # on warfarin in the last 3 months, tested for INR this month, and not issued a DOAC since
+        return (index.cohort("issue", "warfarin", add_months(month, -3), add_months(month, -1))
+                & index.cohort("inr", start=month, end=month)
+                - index.cohort("issue", "DOAC", start=month))
+
+    index.counts(tested_warfarin)
+
+The bitmaps are "roaring" bitmaps (Chambi, Lemire et al.): patient IDs are split by their upper bits into chunks of
+65536 IDs, and each chunk holds either a sorted array of its (16-bit) lower bits, while it has at most 4096 patients,
+or a 65536-bit bitmap once it has more. Both take at most 8kB per chunk, and intersections and unions work chunk by
+chunk, only on the chunks both sides have.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+from timelines import _month_keys, _months
+
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "cohorts", "index.npz")
+
+EVENTS = ["issue", "repeat", "inr", "ttr"]
+ANTICOAGS = ["warfarin", "DOAC"]
+
+# patient IDs per chunk (the lower 16 bits), and the most held as an array before a chunk becomes a bitmap
+CHUNK = 1 << 16
+ARRAY_MAX = 4096
+
+# set bits in each byte value (for numpy versions without bitwise_count)
+_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _unique(values):
+    '''Sorted distinct values (sorting, which is faster than np.unique's hashing for these arrays)'''
+    values = np.sort(values)
+    return values[np.append(True, values[1:] != values[:-1])] if len(values) else values
+
+
+##### containers: a sorted uint16 array, or a bitmap of 1024 uint64 words ########
+
+def _is_bitmap(c):
+    return c.dtype == np.uint64
+
+
+def _size(c):
+    if not _is_bitmap(c):
+        return len(c)
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(c).sum())
+    return int(_BITS[c.view(np.uint8)].sum())
+
+
+def _to_bitmap(c):
+    if _is_bitmap(c):
+        return c
+    bits = np.zeros(CHUNK, dtype=bool)
+    bits[c] = True
+    return np.packbits(bits, bitorder="little").view(np.uint64)
+
+
+def _to_array(c):
+    if not _is_bitmap(c):
+        return c
+    return np.flatnonzero(np.unpackbits(c.view(np.uint8), bitorder="little")).astype(np.uint16)
+
+
+def _test(bitmap, values):
+    '''Whether each of the (uint16) values is set in the bitmap'''
+    return (bitmap.view(np.uint8)[values >> 3] >> (values & 7).astype(np.uint8)) & 1 == 1
+
+
+def _container(c):
+    '''The smaller form of a container: an array up to ARRAY_MAX values, else a bitmap (None if it's empty)'''
+    n = _size(c)
+    if n == 0:
+        return None
+    if n <= ARRAY_MAX:
+        return _to_array(c)
+    return _to_bitmap(c)
+
+
+def _and(a, b):
+    if _is_bitmap(a) and _is_bitmap(b):
+        return _container(a & b)
+    if _is_bitmap(a):
+        a, b = b, a
+    if _is_bitmap(b):
+        return _container(a[_test(b, a)])
+    return _container(np.intersect1d(a, b, assume_unique=True))
+
+
+def _andnot(a, b):
+    if _is_bitmap(a):
+        return _container(a & ~_to_bitmap(b))
+    if _is_bitmap(b):
+        return _container(a[~_test(b, a)])
+    return _container(np.setdiff1d(a, b, assume_unique=True))
+
+
+class Bitmap:
+    '''
+    A compressed set of patient IDs.
+
+    INPUTS:
+    keys (array): upper bits (ID // 65536) of each chunk, sorted
+    containers (list): the container of each chunk
+    '''
+
+    def __init__(self, keys=None, containers=None):
+        self.keys = np.empty(0, dtype=np.int64) if keys is None else np.asarray(keys, dtype=np.int64)
+        self.containers = [] if containers is None else list(containers)
+        self._len = None
+
+    @classmethod
+    def from_ids(cls, ids, unique=False):
+        '''
+        INPUTS:
+        ids (array): patient IDs (non-negative integers)
+        unique (bool): whether the IDs are already sorted and unique
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if not unique:
+            ids = _unique(ids)
+        high = ids >> 16
+        keys, first = np.unique(high, return_index=True)
+        last = np.append(first[1:], len(ids))
+        low = (ids & (CHUNK - 1)).astype(np.uint16)
+        return cls(keys, [_container(low[a:b]) for a, b in zip(first, last)])
+
+    @classmethod
+    def union(cls, *bitmaps):
+        '''Union of any number of bitmaps, merging each chunk once'''
+        chunks = {}
+        for b in bitmaps:
+            for k, c in zip(b.keys, b.containers):
+                chunks.setdefault(k, []).append(c)
+        keys = sorted(chunks)
+        containers = []
+        for k in keys:
+            parts = chunks[k]
+            if len(parts) == 1:
+                containers.append(parts[0])
+            elif any(_is_bitmap(c) for c in parts) or sum(len(c) for c in parts) > 4*ARRAY_MAX:
+                containers.append(_container(np.bitwise_or.reduce([_to_bitmap(c) for c in parts])))
+            else:
+                containers.append(_container(_unique(np.concatenate(parts))))
+        return cls(keys, containers)
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(_size(c) for c in self.containers)
+        return self._len
+
+    def __repr__(self):
+        return f"Bitmap({len(self)} patients, {len(self.keys)} chunks)"
+
+    def __contains__(self, patient):
+        pos = np.searchsorted(self.keys, patient >> 16)
+        if pos == len(self.keys) or self.keys[pos] != patient >> 16:
+            return False
+        c, low = self.containers[pos], np.array([patient & (CHUNK - 1)], dtype=np.uint16)
+        return bool(_test(c, low)[0]) if _is_bitmap(c) else bool(np.isin(low, c)[0])
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and np.array_equal(self.to_array(), other.to_array())
+
+    def _combine(self, other, op):
+        keys, i, j = np.intersect1d(self.keys, other.keys, assume_unique=True, return_indices=True)
+        out = [(k, op(self.containers[a], other.containers[b])) for k, a, b in zip(keys, i, j)]
+        return [k for k, c in out if c is not None], [c for k, c in out if c is not None]
+
+    def __and__(self, other):
+        return Bitmap(*self._combine(other, _and))
+
+    def __or__(self, other):
+        return Bitmap.union(self, other)
+
+    def __sub__(self, other):
+        # chunks only this side has are kept as they are
+        keys, containers = self._combine(other, _andnot)
+        only = ~np.isin(self.keys, other.keys)
+        keys = np.concatenate([keys, self.keys[only]]).astype(np.int64)
+        containers = containers + [c for c, o in zip(self.containers, only) if o]
+        order = np.argsort(keys, kind="stable")
+        return Bitmap(keys[order], [containers[i] for i in order])
+
+    def to_array(self):
+        '''The patient IDs, sorted'''
+        if not self.containers:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([(k << 16) + _to_array(c).astype(np.int64) for k, c in zip(self.keys, self.containers)])
+
+
+##### the index ########
+
+def _patient_months(patient, first, last):
+    '''
+    Unique (month, patient) pairs, for events with a patient and month keys, each covering the months first to last.
+
+    OUTPUTS:
+    months (array): month key of each pair, sorted
+    patients (array): patient of each pair, sorted within month
+    '''
+    n = np.maximum(last - first + 1, 0)
+    rows = np.repeat(np.arange(len(patient)), n)
+    # the month of each expanded row: its interval's first month plus its position within the interval
+    offset = np.arange(len(rows)) - np.repeat(np.cumsum(n) - n, n)
+    months = first[rows] + offset
+    ranks, patients = np.unique(patient, return_inverse=True)
+    keys = _unique(months * len(ranks) + patients.reshape(-1)[rows])
+    return keys // max(len(ranks), 1), ranks[keys % max(len(ranks), 1)]
+
+
+class CohortIndex:
+    '''
+    Bitmaps of the patients with each event in each month.
+
+    INPUTS:
+    bitmaps (dict): bitmap of each (event, anticoag, month key) (anticoag is None for INR tests and TTRs)
+    '''
+
+    def __init__(self, bitmaps=None):
+        self.bitmaps = {} if bitmaps is None else bitmaps
+
+    def __repr__(self):
+        return f"CohortIndex({len(self.bitmaps)} bitmaps, {len(self.months())} months)"
+
+    @classmethod
+    def build(cls, timelines, start, end=None):
+        '''
+        Index the patients issued each anticoagulant, on a repeat of each (from the month it started to the month it
+        ended), and with an INR test or TTR recorded, in each month.
+
+        INPUTS:
+        timelines (Timelines): extracted timelines
+        start (str): first month to index
+        end (str): last month to index (by default the latest month with an event)
+
+        OUTPUTS:
+        CohortIndex
+        '''
+        first_month = _month_keys(np.array([pd.Timestamp(start)], dtype="datetime64[D]"))[0]
+        t = timelines
+        sources = []
+        for anticoag, doac in zip(ANTICOAGS, (False, True)):
+            rows = t.issue_doac == doac
+            months = _month_keys(t.issue_date[rows])
+            sources.append(("issue", anticoag, t.issue_patient[rows], months, months))
+            rows = (t.repeat_doac == doac) & ~np.isnat(t.repeat_start) & ~np.isnat(t.repeat_end)
+            sources.append(("repeat", anticoag, t.repeat_patient[rows],
+                            _month_keys(t.repeat_start[rows]), _month_keys(t.repeat_end[rows])))
+        for event, rows in (("inr", t.event_inr), ("ttr", t.event_ttr)):
+            months = _month_keys(t.event_date[rows])
+            sources.append((event, None, t.event_patient[rows], months, months))
+
+        if end is None:
+            last_month = max((int(s[4].max()) for s in sources if len(s[4]) > 0 and s[0] != "repeat"),
+                             default=first_month)
+        else:
+            last_month = _month_keys(np.array([pd.Timestamp(end)], dtype="datetime64[D]"))[0]
+
+        bitmaps = {}
+        for event, anticoag, patient, first, last in sources:
+            months, patients = _patient_months(patient, np.maximum(first, first_month),
+                                               np.minimum(last, last_month))
+            keys, begin = np.unique(months, return_index=True)
+            finish = np.append(begin[1:], len(months))
+            for key, a, b in zip(keys, begin, finish):
+                bitmaps[(event, anticoag, int(key))] = Bitmap.from_ids(patients[a:b], unique=True)
+        return cls(bitmaps)
+
+    def months(self):
+        return list(_months(np.array(sorted({k[2] for k in self.bitmaps}), dtype=np.int64)))
+
+    def cohort(self, event, anticoag=None, start=None, end=None):
+        '''
+        Patients with an event in any month from `start` to `end`.
+
+        INPUTS:
+        event (str): "issue", "repeat", "inr" or "ttr"
+        anticoag (str): "warfarin" or "DOAC" (either, if None) for issues and repeats
+        start (str): first month (the earliest indexed, if None)
+        end (str): last month (the latest indexed, if None); for a single month, pass it as both start and end
+
+        OUTPUTS:
+        Bitmap
+        '''
+        if event not in EVENTS:
+            raise ValueError(f"unknown event {event!r}, expected one of {EVENTS}")
+        first = -np.inf if start is None else _month_keys(np.array([pd.Timestamp(start)], dtype="datetime64[D]"))[0]
+        last = np.inf if end is None else _month_keys(np.array([pd.Timestamp(end)], dtype="datetime64[D]"))[0]
+        anticoags = [None] if event in ("inr", "ttr") else ANTICOAGS if anticoag is None else [anticoag]
+        return Bitmap.union(*[b for (e, a, m), b in self.bitmaps.items()
+                              if e == event and a in anticoags and first <= m <= last])
+
+    def counts(self, definition, months=None):
+        '''
+        Size of a cohort defined for each month.
+
+        INPUTS:
+        definition (function): takes a month (as a timestamp) and returns a Bitmap
+        months (list): months to count (every indexed month by default)
+
+        OUTPUTS:
+        counts (series): patient count of each month
+        '''
+        months = self.months() if months is None else [pd.Timestamp(m) for m in months]
+        return pd.Series([len(definition(m)) for m in months], index=pd.Index(months, name="month"),
+                         name="patient_count")
+
+    ##### storage ########
+
+    def save(self, path=INDEX_PATH):
+        '''Save the index as one .npz of concatenated containers'''
+        names = sorted(self.bitmaps, key=lambda k: (k[0], k[1] or "", k[2]))
+        table, arrays, words = [], [], []
+        n_arrays = n_words = 0
+        for i, name in enumerate(names):
+            b = self.bitmaps[name]
+            for k, c in zip(b.keys, b.containers):
+                if _is_bitmap(c):
+                    table.append((i, k, 1, n_words, len(c)))
+                    words.append(c)
+                    n_words += len(c)
+                else:
+                    table.append((i, k, 0, n_arrays, len(c)))
+                    arrays.append(c)
+                    n_arrays += len(c)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f,
+                     events=np.array([n[0] for n in names], dtype=str),
+                     anticoags=np.array([n[1] or "" for n in names], dtype=str),
+                     months=np.array([n[2] for n in names], dtype=np.int64),
+                     table=np.array(table, dtype=np.int64).reshape(-1, 5),
+                     arrays=np.concatenate(arrays) if arrays else np.empty(0, dtype=np.uint16),
+                     words=np.concatenate(words) if words else np.empty(0, dtype=np.uint64))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        with np.load(path) as f:
+            names = [(e, a or None, int(m)) for e, a, m in zip(f["events"], f["anticoags"], f["months"])]
+            table, arrays, words = f["table"], f["arrays"], f["words"]
+        chunks = {}
+        for i, k, kind, offset, n in table:
+            c = (words if kind else arrays)[offset:offset + n]
+            chunks.setdefault(i, ([], []))
+            chunks[i][0].append(k)
+            chunks[i][1].append(c)
+        return cls({name: Bitmap(*chunks.get(i, ([], []))) for i, name in enumerate(names)})
@@ -0,0 +1,704 @@
+import re
+import time
+import uuid
+import threading
+import queue
+from contextlib import contextmanager
+
+import pandas as pd
+
+from queries import get_template
+from backends import connect, errors
+
+
+# SQLSTATEs raised by the ODBC driver when the link to the server has gone (timeouts, dropped sessions etc)
+STALE_STATES = ("08S01", "08003", "08001", "08007", "HYT00", "HYT01")
+
+# patterns used to work out which temp table a statement creates, fills or drops
+INSERT_INTO = re.compile(r"\bINSERT\s+INTO\s+(#\w+)", re.IGNORECASE)
+SELECT_INTO = re.compile(r"\bINTO\s+(#\w+)", re.IGNORECASE)
+CREATE_TABLE = re.compile(r"\bCREATE\s+TABLE\s+(#\w+)", re.IGNORECASE)
+DROP_TABLE = re.compile(r"\bDROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(#\w+)", re.IGNORECASE)
+TEMP_TABLE = re.compile(r"#\w+")
+# every way a batch can create, change or drop a temp table, in the order they appear (for `_remember`)
+TABLE_CHANGE = re.compile(
+    r"\b(?:(?P<insert>INSERT\s+INTO)|(?P<drop>DROP\s+TABLE(?:\s+IF\s+EXISTS)?)"
+    r"|(?P<index>CREATE\s+(?:UNIQUE\s+)?(?:(?:NON)?CLUSTERED\s+)?INDEX\s+\w+\s+ON)|INTO|CREATE\s+TABLE)"
+    r"\s+(?P<table>#\w+)",
+    re.IGNORECASE)
+
+
+def is_stale(error):
+    '''Return True if a pyodbc error means the connection itself has dropped (rather than the SQL being wrong)'''
+    try:
+        import pyodbc
+    except ImportError:
+        # without pyodbc there are no SQL Server connections to drop
+        return False
+    return isinstance(error, pyodbc.Error) and len(error.args) > 0 and error.args[0] in STALE_STATES
+
+
+def drop_if_exists(table):
+    '''T-SQL to drop a temp table only if it is present on the current connection'''
+    return f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table}"
+
+
+class DbSession:
+    '''
+    A long-lived database session which replaces `closing_connection`. The connection (and so every #temp table
+    built on it) stays open between notebook cells, so later cells can query tables built earlier and re-running
+    a cell does not rebuild tables whose SQL has not changed.
+
+    Use as a drop-in for the old context manager: `with session(dbconn) as connection:`. Leaving the `with` block
+    does NOT close the connection; call `close()` (or `close_all()`) when finished.
+
+    With a query cache attached (`use_cache`), `read` returns cached results where it can, and temp tables are not
+    built until something actually needs them: a read which isn't cached, an insert, or a change to a table they
+    are built from. Replaying a notebook whose results are all cached then runs nothing on the server.
+
+    INPUTS:
+    dbconn (str): ODBC connection string
+    name (str): label for the session within its pool
+    ping_after (int): seconds idle after which the connection is checked with a cheap query before being reused
+    '''
+
+    def __init__(self, dbconn, name="main", ping_after=300):
+        self.dbconn = dbconn
+        self.name = name
+        self.ping_after = ping_after
+        self._cnxn = None
+        self._last_used = 0
+        # temp table -> (number, batch, parameters) of the batch which created it and of each since which changed it,
+        # so the tables can be rebuilt after a reconnect (see `_remember`)
+        self._history = {}
+        self._sent = 0
+        # temp table -> (sql that built it, other temp tables it was built from)
+        self._built = {}
+        # temp table -> batches still to run to build it (only while a cache is attached)
+        self._pending = {}
+        self.cache = None
+        # query log (see `instrument.py`), and the section raw SQL is labelled with
+        self.log = None
+        self._section = None
+        self._counts = {}
+        # temp table -> (global temp table copy readable by other connections, key of the table when copied)
+        self._shared = {}
+        # temp table -> clustered index columns of the template which built it, for its shared copy
+        self._indexes = {}
+        # tables read from another session's shared copies (see `use_shared`): temp table -> global temp table, and
+        # temp table -> session in this process to share it from, when first needed
+        self._aliases = {}
+        self._sources = {}
+        # other sessions' workers may ask for copies at the same time
+        self._share_lock = threading.Lock()
+        # exception class raised by the backend's connections (see `backends.errors`)
+        self.errors = errors(dbconn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # keep the connection (and its temp tables) warm for the next cell
+        return False
+
+    ##### connection management ########
+
+    def _connect(self):
+        self._cnxn = connect(self.dbconn)
+        self._last_used = time.time()
+
+    def _reconnect(self):
+        '''Open a fresh connection and replay the batches which built the temp tables, so they are back as they were'''
+        built, pending, aliases, sources = self._built, self._pending, self._aliases, self._sources
+        self.close()
+        # shared copies belong to the sessions they came from, so are still there
+        self._aliases, self._sources = aliases, sources
+        self._connect()
+        history, self._history = self._history, {}
+        for batch, params in self._replay(history):
+            self._run(batch, params, label="replay", kind="replay")
+        self._built, self._pending = built, pending
+
+    def _replay(self, history):
+        '''
+        The batches to run, in their original order, to rebuild the temp tables in a session's history. Tables built
+        from an older copy of a table which has since been rebuilt or dropped are out of date, so are left out (they are
+        no longer in `_built`, so are built again if they are needed).
+        '''
+        created = {table: changes[0][0] for table, changes in history.items()}
+        batches = {}
+        for table, changes in history.items():
+            if all(t in self._aliases or t in self._sources or created.get(t, n + 1) <= n
+                   for n, batch, params in changes for t in set(TEMP_TABLE.findall(batch)) - {table}):
+                batches.update({n: (batch, params) for n, batch, params in changes})
+            else:
+                created.pop(table)
+        return [batches[n] for n in sorted(batches)]
+
+    def _alive(self):
+        '''Make sure there is a usable connection, checking it first if it has been idle for a while'''
+        if self._cnxn is None:
+            self._connect()
+            return self._cnxn
+        if time.time() - self._last_used > self.ping_after:
+            try:
+                self._cnxn.cursor().execute("SELECT 1").fetchall()
+            except self.errors as e:
+                if not is_stale(e):
+                    raise
+                self._reconnect()
+        self._last_used = time.time()
+        return self._cnxn
+
+    def close(self):
+        if self._cnxn is not None:
+            try:
+                self._cnxn.close()
+            except self.errors:
+                pass
+        self._cnxn = None
+        self._built = {}
+        self._pending = {}
+        self._shared = {}
+        self._aliases = {}
+        self._sources = {}
+
+    def reset(self):
+        '''Close the connection and forget all temp tables, so the next statement starts from a clean session'''
+        self.close()
+        self._history = {}
+
+    ##### DB-API passthroughs so pd.read_sql(query, connection) keeps working ########
+
+    def cursor(self):
+        return self._alive().cursor()
+
+    def commit(self):
+        if self._cnxn is not None:
+            self._cnxn.commit()
+
+    def rollback(self):
+        if self._cnxn is not None:
+            self._cnxn.rollback()
+
+    ##### running SQL ########
+
+    def _run(self, batch, params=None, label=None, kind="execute", tables=()):
+        '''
+        Send one batch to the server and wait for every statement in it to finish. If a query log is attached, the
+        batch is recorded under `label`, with the sizes of the temp `tables` it built.
+        '''
+        cursor = self._cnxn.cursor()
+        capture = self.log is not None and self.log.plans
+        sent = self._aliased(batch)
+        sent = f"SET STATISTICS XML ON;\n{sent}\n;\nSET STATISTICS XML OFF" if capture else sent
+        started = time.time()
+        if params:
+            cursor.execute(sent, params)
+        else:
+            cursor.execute(sent)
+        # later statements in a batch only run (and only raise errors) once earlier results are consumed
+        plans = []
+        while True:
+            if capture and cursor.description is not None and "showplan" in cursor.description[0][0].lower():
+                plans += [row[0] for row in cursor.fetchall()]
+            if not cursor.nextset():
+                break
+        cursor.close()
+        self._remember(batch, params)
+        self._last_used = time.time()
+        if self.log is not None:
+            self._record(label, kind, started, tables=tables, plans=plans)
+
+    def _remember(self, batch, params):
+        '''
+        Keep a batch which created or changed temp tables, for `_reconnect` to replay. Creating or dropping a table
+        starts its history again, so superseded builds are not kept (or replayed).
+        '''
+        self._sent += 1
+        sent = (self._sent, batch, params)
+        for change in TABLE_CHANGE.finditer(batch):
+            table = change.group("table")
+            if change.group("drop"):
+                self._history.pop(table, None)
+            elif change.group("insert") or change.group("index"):
+                if table in self._history and self._history[table][-1] is not sent:
+                    self._history[table].append(sent)
+            else:
+                # (re)created: moved to the end so tables come after those they were built from
+                self._history.pop(table, None)
+                self._history[table] = [sent]
+
+    def _retry(self, batch, params=None, **record):
+        '''Run a batch, reconnecting and trying once more if the connection has dropped'''
+        try:
+            self._run(batch, params, **record)
+        except self.errors as e:
+            if not is_stale(e):
+                raise
+            self._reconnect()
+            self._run(batch, params, **record)
+
+    ##### instrumentation ########
+
+    def use_log(self, log):
+        '''Attach an `instrument.QueryLog` to record every statement run on this session (or None to stop)'''
+        self.log = log
+
+    @contextmanager
+    def section(self, name):
+        '''Label raw SQL run within the block as name/sql1, name/sql2, ... in the query log'''
+        previous, self._section = self._section, name
+        try:
+            yield self
+        finally:
+            self._section = previous
+
+    def _label(self):
+        section = self._section or "sql"
+        self._counts[section] = self._counts.get(section, 0) + 1
+        return f"{section}/sql{self._counts[section]}"
+
+    def _table_size(self, table):
+        '''Rows and space used (KB) by a temp table'''
+        if hasattr(self._cnxn, "table_size"):
+            # backends other than SQL Server report this themselves
+            return self._cnxn.table_size(table)
+        cursor = self._cnxn.cursor()
+        row = cursor.execute(f'''SELECT
+        SUM(CASE WHEN index_id IN (0, 1) THEN row_count END), SUM(reserved_page_count) * 8
+        FROM tempdb.sys.dm_db_partition_stats WHERE object_id = OBJECT_ID('tempdb..{table}')''').fetchone()
+        cursor.close()
+        return {"rows": row[0], "kb": row[1]}
+
+    def _record(self, label, kind, started, rows=None, tables=(), plans=()):
+        seconds = time.time() - started
+        label = label or self._label()
+        self.log.record(label=label, session=self.name, kind=kind, started=started, seconds=seconds, rows=rows,
+                        tables={t: self._table_size(t) for t in tables},
+                        plans=self.log.save_plans(label, plans) if plans else [])
+
+    def _invalidate(self, table):
+        '''Forget a temp table and anything that was built from it'''
+        self._built.pop(table, None)
+        self._aliases.pop(table, None)
+        self._sources.pop(table, None)
+        for t, (_, deps) in list(self._built.items()):
+            if table in deps:
+                self._invalidate(t)
+
+    def _dependents(self, table):
+        '''Every temp table built (directly or indirectly) from a table'''
+        out = set()
+        for t, (_, deps) in self._built.items():
+            if table in deps:
+                out |= {t} | self._dependents(t)
+        return out
+
+    def _changing(self, table):
+        '''
+        Called before a table is rebuilt, filled or dropped. Deferred tables built from it need the current contents,
+        so are built now; a deferred build of the table itself is no longer needed.
+        '''
+        for t in self._dependents(table):
+            if t in self._pending:
+                self._materialise(t)
+        self._pending.pop(table, None)
+
+    def _materialise(self, table):
+        '''Run the deferred build of a temp table, after those of any tables it is built from'''
+        if table in self._sources and table not in self._aliases:
+            self._aliases[table] = self._sources[table].share(table)
+        if table not in self._pending:
+            return
+        batches, deps, label = self._pending.pop(table)
+        for d in deps:
+            self._materialise(d)
+        self._alive()
+        try:
+            for batch, params, tables in batches:
+                self._retry(batch, params, label=label, kind="build", tables=tables)
+        except self.errors:
+            self._invalidate(table)
+            raise
+
+    def require(self, sql):
+        '''Make sure every temp table referred to in some SQL has actually been built'''
+        for table in TEMP_TABLE.findall(sql):
+            self._materialise(table)
+
+    def lineage(self, sql):
+        '''
+        How each temp table referred to in some SQL was built, including the tables they were built from, as a sorted
+        list of (table, sql/parameters). None if any of them has unknown contents (e.g. rows were inserted into it).
+        '''
+        out = {}
+        todo = set(TEMP_TABLE.findall(sql))
+        while todo:
+            table = todo.pop()
+            if table in out:
+                continue
+            if table not in self._built:
+                return None
+            key, deps = self._built[table]
+            out[table] = key
+            todo |= deps
+        return sorted(out.items())
+
+    def mark_built(self, table, key):
+        '''Record what a temp table filled outside of `run` (e.g. with `insert_rows`) contains, so it can be cached'''
+        self._built[table] = (key, set())
+
+    def _plan(self, statement, reuse):
+        '''
+        Work out what to send for a single statement. Statements creating a temp table are skipped if the same SQL
+        has already built that table on this connection (and reuse is on), otherwise any old copy is dropped first.
+        '''
+        inserted = INSERT_INTO.search(statement)
+        created = SELECT_INTO.search(statement) or CREATE_TABLE.search(statement)
+        dropped = DROP_TABLE.search(statement)
+
+        if inserted or dropped:
+            # contents changed outside of the building statement, so it can't be reused next time
+            table = (inserted or dropped).group(1)
+            self._changing(table)
+            self._invalidate(table)
+            return statement
+
+        if created:
+            table = created.group(1)
+            if reuse and table in self._built and self._built[table][0] == statement:
+                return None
+            self._changing(table)
+            self._invalidate(table)
+            deps = set(TEMP_TABLE.findall(statement)) - {table}
+            self._built[table] = (statement, deps)
+            return f"{drop_if_exists(table)};\n{statement}"
+
+        return statement
+
+    def execute(self, *statements, reuse=True):
+        '''
+        Run one or more statements in a single round trip to the server.
+
+        INPUTS:
+        statements (str): SQL statements, run in the order given
+        reuse (bool): skip statements which would rebuild a temp table with exactly the same SQL as before
+
+        OUTPUTS:
+        None
+        '''
+        self._alive()
+        # build any deferred tables the statements read from or insert into (but not those they create)
+        for s in statements:
+            created = SELECT_INTO.search(s) or CREATE_TABLE.search(s)
+            tables = set(TEMP_TABLE.findall(s))
+            if created and not INSERT_INTO.search(s):
+                tables.discard(created.group(1))
+            for table in tables:
+                self._materialise(table)
+        planned = [self._plan(s, reuse) for s in statements]
+        planned = [s for s in planned if s is not None]
+        if len(planned) == 0:
+            return
+        # separators go on their own line so a trailing `-- comment` can't swallow them
+        batch = "SET NOCOUNT ON;\n" + "\n;\n".join(planned)
+        # temp tables built or filled, for the query log
+        tables = []
+        for s in statements:
+            changed = INSERT_INTO.search(s) or SELECT_INTO.search(s) or CREATE_TABLE.search(s)
+            if changed and changed.group(1) not in tables:
+                tables.append(changed.group(1))
+        try:
+            self._retry(batch, tables=tables)
+        except self.errors:
+            # the statements failed, so the tables they would have built aren't there
+            for s in statements:
+                created = SELECT_INTO.search(s) or CREATE_TABLE.search(s)
+                if created:
+                    self._invalidate(created.group(1))
+            raise
+
+    def run(self, template, reuse=True, **values):
+        '''
+        Run a registered SQL template (see `queries.py`), binding its parameters.
+
+        Templates which build a temp table are skipped if the table was already built on this connection by the
+        same template with the same parameter values (and reuse is on). While a cache is attached the build is
+        deferred until the table is needed.
+
+        INPUTS:
+        template (str or Template): template, or its name in the registry
+        reuse (bool): skip rebuilding a temp table which is already up to date
+        values: parameter values, e.g. start="20190101"
+
+        OUTPUTS:
+        None
+        '''
+        t = get_template(template)
+        params = t.values(values)
+        if t.into is None:
+            self.require(t.sql)
+            self._alive()
+            self._retry(t.query(), params, label=t.name)
+            return
+
+        if not t.params:
+            key = t.select_into()
+            statements = [st for st in [t.select_into(), t.create_index()] if st is not None]
+            batches = [("SET NOCOUNT ON;\n" + drop_if_exists(t.into) + ";\n" + "\n;\n".join(statements), None, [t.into])]
+        else:
+            key = (t.sql, tuple(params))
+            batches = [(f"{drop_if_exists(t.into)};\n{t.shell()}", None, []), (t.fill(), params, [t.into])]
+            if t.index is not None:
+                batches.append((t.create_index(), None, []))
+        if reuse and t.into in self._built and self._built[t.into][0] == key:
+            return
+
+        self._changing(t.into)
+        self._invalidate(t.into)
+        deps = set(TEMP_TABLE.findall(t.sql)) - {t.into}
+        self._built[t.into] = (key, deps)
+        self._indexes[t.into] = t.index
+        self._pending[t.into] = (batches, deps, t.name)
+        if self.cache is None:
+            self._materialise(t.into)
+
+    def read(self, template, refresh=False, **values):
+        '''
+        Run a registered SQL template which returns results, and read them into a dataframe. If a cache is attached,
+        results are returned from it when the query, its parameters and the temp tables it reads are unchanged.
+
+        INPUTS:
+        template (str or Template): template, or its name in the registry
+        refresh (bool): ignore any cached results (and replace them)
+        values: parameter values, e.g. start="20190101"
+
+        OUTPUTS:
+        df (df): results
+        '''
+        t = get_template(template)
+        params = t.values(values)
+        if self.cache is not None:
+            return self.cache.read_sql(self, t.query(), params=params or None, label=t.name, refresh=refresh)
+        return self.read_sql(t.query(), params=params or None, label=t.name)
+
+    def use_cache(self, cache):
+        '''Attach a `cache.QueryCache` (or None to detach it, building any deferred tables)'''
+        self.cache = cache
+        if cache is None:
+            for table in list(self._pending):
+                self._materialise(table)
+
+    def insert_rows(self, table, columns, rows):
+        '''
+        Insert rows into an existing table using multi-row, parameterised INSERT statements.
+
+        INPUTS:
+        table (str): table to insert into
+        columns (list): column names
+        rows (list): tuples of values, one per row
+
+        OUTPUTS:
+        None
+        '''
+        self._alive()
+        self._materialise(table)
+        self._changing(table)
+        self._invalidate(table)
+        # SQL Server allows at most 1000 rows per VALUES list and 2100 parameters per statement
+        chunk = max(1, min(1000, 2000 // len(columns)))
+        cols = ", ".join(columns)
+        placeholders = "(" + ", ".join("?" for c in columns) + ")"
+        for i in range(0, len(rows), chunk):
+            part = rows[i:i + chunk]
+            sql = f"INSERT INTO {table} ({cols}) VALUES " + ", ".join(placeholders for r in part)
+            self._retry(sql, [v for r in part for v in r], tables=[table] if i + chunk >= len(rows) else [])
+
+    def read_sql(self, query, label=None, **kwargs):
+        '''Read the results of a query into a dataframe, reconnecting once if the connection has dropped'''
+        self.require(query)
+        query = self._aliased(query)
+        started = time.time()
+        try:
+            df = pd.read_sql(query, self._alive(), **kwargs)
+        except self.errors as e:
+            if not is_stale(e):
+                raise
+            self._reconnect()
+            df = pd.read_sql(query, self._cnxn, **kwargs)
+        if self.log is not None:
+            self._record(label, "read", started, rows=len(df))
+        return df
+
+    def share(self, table):
+        '''
+        Copy a temp table to a global temp table (##), which other connections can read while this session is open.
+        The copy is reused until the table is rebuilt or changed.
+
+        INPUTS:
+        table (str): temp table to share, e.g. "#allpts"
+
+        OUTPUTS:
+        name (str): name of the global temp table
+        '''
+        with self._share_lock:
+            self._materialise(table)
+            if table in self._aliases:
+                # already a shared copy from another session
+                return self._aliases[table]
+            key = self._built[table][0] if table in self._built else None
+            if table in self._shared:
+                name, shared_key = self._shared[table]
+                if key is not None and shared_key == key:
+                    return name
+                self._retry(drop_if_exists(name), label=f"share/{table}")
+            name = f"##{table[1:]}_{uuid.uuid4().hex[:8]}"
+            copy = [f"{drop_if_exists(name)};\nSELECT * INTO {name} FROM {table}"]
+            if self._indexes.get(table) is not None:
+                # the copy is read the way the table is, so give it the same clustered index
+                copy.append(f"CREATE CLUSTERED INDEX ix_{name[2:]} ON {name} ({self._indexes[table]})")
+            self._retry("\n;\n".join(copy), label=f"share/{table}")
+            self._shared[table] = (name, key)
+            return name
+
+    def share_tables(self, tables):
+        '''
+        Share several temp tables (see `share`), for sessions in other processes to read with `use_shared`.
+
+        INPUTS:
+        tables (list): temp tables to share, e.g. `staging.STAGED`
+
+        OUTPUTS:
+        shared (dict): temp table -> (name of its global temp table copy, how it was built)
+        '''
+        return {table: (self.share(table), self.lineage(table)) for table in tables}
+
+    def use_shared(self, source, tables=None):
+        '''
+        Read temp tables built on another session from their shared (##) copies, rather than building them again on
+        this connection. Statements referring to the tables are sent with the names of the copies, and their results
+        are cached as if the tables had been built here.
+
+        INPUTS:
+        source (DbSession or dict): session in this process the tables were built on (each is then only shared when
+                                    first needed here), or the result of `share_tables` from another process
+        tables (list): temp tables to read from the session (not used with the result of `share_tables`)
+
+        OUTPUTS:
+        None
+        '''
+        if isinstance(source, dict):
+            shared = {table: (name, key) for table, (name, key) in source.items()}
+        else:
+            shared = {table: (None, source.lineage(table)) for table in tables}
+        for table, (name, key) in shared.items():
+            if key is None:
+                raise ValueError(f"{table} has unknown contents on the session it is shared from")
+            current = self._aliases.get(table) if name is not None else self._sources.get(table)
+            if table in self._built and self._built[table][0] == key and current == (name or source):
+                continue
+            self._changing(table)
+            self._invalidate(table)
+            self._built[table] = (key, set())
+            if name is None:
+                self._sources[table] = source
+            else:
+                self._aliases[table] = name
+
+    def _aliased(self, sql):
+        '''SQL with the temp tables read from shared copies renamed to the copies'''
+        if not self._aliases:
+            return sql
+        return TEMP_TABLE.sub(lambda m: self._aliases.get(m.group(0), m.group(0)), sql)
+
+    def has_table(self, table):
+        '''Check whether a temp table currently exists on this connection (or is read from a shared copy)'''
+        if table in self._aliases or table in self._sources:
+            return True
+        self._materialise(table)
+        cursor = self.cursor()
+        exists = cursor.execute(f"SELECT OBJECT_ID('tempdb..{table}')").fetchone()[0] is not None
+        cursor.close()
+        return exists
+
+
+class SessionPool:
+    '''
+    A pool of warm sessions against one database. Named sessions persist for the life of the notebook (so their
+    temp tables can be shared between cells); anonymous worker sessions are handed out for independent jobs.
+
+    INPUTS:
+    dbconn (str): ODBC connection string
+    size (int): maximum number of worker sessions open at once
+    ping_after (int): seconds idle after which a session's connection is checked before reuse
+    '''
+
+    def __init__(self, dbconn, size=4, ping_after=300):
+        self.dbconn = dbconn
+        self.size = size
+        self.ping_after = ping_after
+        self._named = {}
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def session(self, name="main"):
+        '''Return the named session, opening it on first use'''
+        with self._lock:
+            if name not in self._named:
+                self._named[name] = DbSession(self.dbconn, name=name, ping_after=self.ping_after)
+            return self._named[name]
+
+    @contextmanager
+    def worker(self):
+        '''Check out an idle worker session (blocking if all are busy) and return it to the pool afterwards'''
+        with self._lock:
+            new = self._idle.empty() and self._opened < self.size
+            if new:
+                self._opened += 1
+                s = DbSession(self.dbconn, name=f"worker{self._opened}", ping_after=self.ping_after)
+        if not new:
+            s = self._idle.get()
+        try:
+            yield s
+        finally:
+            self._idle.put(s)
+
+    def close(self):
+        for s in self._named.values():
+            s.reset()
+        while not self._idle.empty():
+            self._idle.get().reset()
+        self._named = {}
+        self._opened = 0
+
+
+_pools = {}
+
+def get_pool(dbconn, size=4):
+    '''Return the shared pool for a connection string, creating it on first use'''
+    if dbconn not in _pools:
+        _pools[dbconn] = SessionPool(dbconn, size=size)
+    return _pools[dbconn]
+
+
+def session(dbconn, name="main"):
+    '''
+    Return a warm, pooled session for the database. Replaces `closing_connection(dbconn)`.
+
+    INPUTS:
+    dbconn (str): ODBC connection string
+    name (str): name of the session; cells using the same name share a connection and its temp tables
+
+    OUTPUTS:
+    DbSession
+    '''
+    return get_pool(dbconn).session(name)
+
+
+def close_all():
+    '''Close every pooled connection'''
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
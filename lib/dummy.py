@@ -0,0 +1,104 @@
+'''
+Dummy data for running the notebooks against the OPENCoronaExport dummy database, where the real tables don't
+contain linkable patients. Rows are generated in a few vectorised numpy operations from a seeded generator, so the
+same arguments always give the same data, and large volumes (millions of rows) can be generated to check how the
+analyses scale.
+'''
+import numpy as np
+import pandas as pd
+
+
+def generate_dummy_data(date_fields, month_field=None, multiple_choice=None, exclusive_choices=None, size=1000,
+                        seed=1, start='2020-01-01', end='2020-07-01'):
+    '''Generate a dataframe of dummy data
+
+    Inputs:
+    date_fields (list): list of column names to generate and populate with dates
+    month_field (str): name of single column from which to calculate a month ("YYYY-MM-01")
+    multiple_choice (dict): fields to generate, and lists of possible values to populate with. Note these can overlap i.e. patients can have several of the values given, and no patients in the output will have none
+    exclusive_choices (dict): fields to generate, and lists of possible values to populate with. Each row of data will be assigned one value.
+    size (int): number of patient IDs to initially generate
+    seed (int): seed for the random generator, so that runs are reproducible
+    start, end (str): range of dates to select from
+    '''
+    rng = np.random.default_rng(seed)
+
+    # create a list of numeric patient ids (starting from "1000")
+    patient_ids = np.arange(1000, 1000+size)
+    # create a list of dates to select randomly from (days between start and end, evenly spaced), held as offsets
+    # into a small lookup of date strings so that formatting doesn't have to be repeated for every row
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    day_labels = np.datetime_as_string(days, unit='D').astype(object)
+    dates = np.linspace(0, days.shape[0] - 1, size*2).astype(int)
+
+    if multiple_choice is None:
+        multiple_choice = {}
+
+    parts = []
+    patient_subset = patient_ids
+    for c in multiple_choice: # e.g. {"anticoag":["warfarin","doac"]} each patient can be duplicted here to have several of each choice
+        patient_subset = rng.choice(patient_subset, int(size*0.5), replace=True)
+        for item in multiple_choice[c]:
+            ids = rng.choice(patient_subset, patient_subset.shape[0]*5, replace=True)
+            parts.append(pd.DataFrame({"Patient_ID": ids, c: np.repeat(item, ids.shape[0])}))
+
+    if len(parts) > 0:
+        p2 = pd.concat(parts, ignore_index=True, sort=False)
+    else: # if no choices were supplied, begin populating df with the generated list of patient IDs
+        p2 = pd.DataFrame({"Patient_ID": patient_ids})
+    # sort now, before the remaining (independently random) columns are added, so there is less data to reorder.
+    # A stable sort means the output order doesn't depend on the sort algorithm
+    p2 = p2.sort_values(by="Patient_ID", kind="mergesort").reset_index(drop=True)
+
+    if exclusive_choices is None:
+        exclusive_choices = {}
+
+    for c in exclusive_choices: # e.g. {"flag":[0,1]}
+        p2[c] = np.asarray(exclusive_choices[c])[rng.integers(0, len(exclusive_choices[c]), p2.shape[0])]
+
+    picked = {}
+    for d in date_fields:    # assign dates from generated date list into each required date field
+        picked[d] = rng.choice(dates, p2.shape[0], replace=True)
+        p2[d] = day_labels[picked[d]]
+
+    # convert dates to first of month
+    if month_field is not None:
+        month_labels = np.array([label[:-2] + "01" for label in day_labels], dtype=object)
+        p2[f"{month_field}_month"] = month_labels[picked[month_field]]
+
+    return p2
+
+
+def insert_dummy_data(connection, dummy_data, table, rows=1000):
+    '''
+    Insert dummy data into specified SQL temp table, using multi-row parameterised inserts (see `DbSession.insert_rows`)
+
+    INPUTS:
+    connection (DbSession): session the temp table was built on
+    dummy_data (df): data to insert; column names must match the table
+    table (str): table to insert into
+    rows (int): maximum number of rows to insert (None for all)
+
+    OUTPUTS:
+    None
+    '''
+    if rows is not None:
+        dummy_data = dummy_data.head(rows)
+    # convert numpy values to python objects, which is what pyodbc expects as parameters
+    values = dummy_data.astype(object).where(dummy_data.notna(), None).values.tolist()
+    connection.insert_rows(table, [str(c) for c in dummy_data.columns], values)
+
+
+def month_keys(dates):
+    '''
+    Integer month keys (months since year 0, as `queries.month_key` computes in SQL) for a column of dummy dates,
+    for tables whose joins use the keys
+
+    INPUTS:
+    dates (series): dates, or "YYYY-MM-DD" strings
+
+    OUTPUTS:
+    keys (series): month key of each date
+    '''
+    dates = pd.to_datetime(pd.Series(dates))
+    return dates.dt.year*12 + dates.dt.month - 1
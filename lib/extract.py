@@ -0,0 +1,96 @@
+'''
+Streaming extraction of large (e.g. patient-level) result sets to Parquet.
+
+`read_sql` builds the whole result in memory, as pyodbc rows and then as a dataframe. Here rows are fetched from the
+open result set in bounded chunks (SQL Server streams a default result set to the client as it is read, so only the
+current chunk is ever held), converted to explicit dtypes, and appended to a Parquet dataset one part file at a time.
+
+Patient-level extracts must stay inside the secure environment: write them somewhere outside `output/`.
+'''
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def _chunk_rows(df, chunk, max_memory_mb):
+    '''Rows per chunk which keeps a chunk's dataframe within the memory ceiling, going by the size of this one'''
+    if max_memory_mb is None or len(df) == 0:
+        return chunk
+    per_row = df.memory_usage(deep=True, index=False).sum() / len(df)
+    return max(1, min(chunk, int(max_memory_mb * 2**20 / per_row)))
+
+
+def extract(connection, query, path, dtypes=None, params=None, chunk=100000, partition_cols=None, max_memory_mb=None,
+            report_every=10):
+    '''
+    Run a query and stream its results to a Parquet dataset, without holding more than one chunk in memory.
+
+    INPUTS:
+    connection (DbSession): session to run the query on (so it can read temp tables built earlier)
+    query (str): SQL returning the rows to extract
+    path (str): directory to write the dataset to; existing part files from a previous extract are replaced
+    dtypes (dict): pandas dtype for each column, e.g. {"Patient_ID": "int64", "month": "datetime64[ns]"}. Columns not
+                   given are inferred from the first chunk, and every later chunk is written with the same schema
+    params (list): values for any ? markers in the query
+    chunk (int): maximum rows fetched and written at a time
+    partition_cols (list): columns to partition the dataset by (hive-style directories, e.g. year=2020/)
+    max_memory_mb (int): ceiling on the size of a chunk's dataframe; the chunk size is reduced to stay under it
+    report_every (int): print progress (rows and rows/sec) every this many seconds, or None for no progress
+
+    OUTPUTS:
+    summary (dict): rows, parts written and seconds taken
+    '''
+    os.makedirs(path, exist_ok=True)
+    for root, _, files in os.walk(path):
+        for f in files:
+            if f.endswith(".parquet"):
+                os.remove(os.path.join(root, f))
+
+    # build any deferred temp tables the query reads from
+    connection.require(query)
+    cursor = connection.cursor()
+    if params:
+        cursor.execute(query, params)
+    else:
+        cursor.execute(query)
+    # skip past any row counts from statements before the final SELECT
+    while cursor.description is None and cursor.nextset():
+        pass
+    columns = [d[0] for d in cursor.description]
+
+    started = last_report = time.time()
+    rows = parts = 0
+    schema = None
+    size = chunk
+    while True:
+        records = cursor.fetchmany(size)
+        if len(records) == 0:
+            break
+        df = pd.DataFrame.from_records(records, columns=columns)
+        del records
+        if dtypes:
+            df = df.astype(dtypes)
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        if schema is None:
+            schema = table.schema
+            size = _chunk_rows(df, chunk, max_memory_mb)
+
+        if partition_cols:
+            pq.write_to_dataset(table, path, partition_cols=partition_cols)
+        else:
+            pq.write_table(table, os.path.join(path, f"part-{parts:05d}.parquet"))
+        rows += len(df)
+        parts += 1
+
+        if report_every is not None and time.time() - last_report >= report_every:
+            last_report = time.time()
+            print(f"{rows:,} rows, {rows / (last_report - started):,.0f} rows/sec")
+
+    cursor.close()
+    seconds = time.time() - started
+    if report_every is not None:
+        print(f"{rows:,} rows in {parts} parts, {seconds:.1f}s ({rows / max(seconds, 1e-9):,.0f} rows/sec)")
+    return {"rows": rows, "parts": parts, "seconds": seconds}
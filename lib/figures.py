@@ -0,0 +1,128 @@
+'''
+Batch rendering of the report figures, in parallel and only when they have changed.
+
+Regenerating the figures one `plot_line_chart` call at a time draws every chart in turn at 300dpi, whether or not its
+data has changed. Instead, the charts are listed as specs (their dataframes, titles, labels and filename) and rendered
+together: each spec is hashed - the data of its dataframes, its other arguments and the plotting code - and charts
+whose hashes match those recorded when their files in `output/` were drawn are skipped. The rest are drawn in a pool
+of processes with matplotlib's non-interactive Agg backend.
+
+    charts = [chart("warf_doac_issues", [out1], ["Warfarin and DOAC prescriptions issued"]),
+              chart("same_day", [dfp1, dfp2], titles, loc="upper left", formats=["png", "svg"])]
+    render(charts, workers=4)     # dataframe of each chart's status ("rendered"/"unchanged") and time taken
+
+The hashes are recorded (for every folder charts are rendered to) in `.cache/figures/figure_hashes.json`, rather than
+among the outputs. Pass `force=True` to redraw every chart regardless.
+'''
+import os
+import json
+import time
+import hashlib
+import inspect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from functions import plot_line_chart
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+OUTPUT_DIR = os.path.join(ROOT, "output")
+HASH_FILE = os.path.join(ROOT, ".cache", "figures", "figure_hashes.json")
+
+
+def chart(filename, dfs, titles, ylabels=None, loc='lower left', ymins=None, formats=("png",), dpi=300):
+    '''
+    A chart to render: the arguments of `plot_line_chart`, and the name (without extension) of the files to save.
+
+    OUTPUTS:
+    spec (dict)
+    '''
+    return {"filename": filename, "dfs": list(dfs), "titles": list(titles), "ylabels": ylabels or {}, "loc": loc,
+            "ymins": ymins or {}, "formats": list(formats), "dpi": dpi}
+
+
+def _data_hash(dfs):
+    '''Hash of the dataframes' values, index, columns and types'''
+    h = hashlib.sha256()
+    for df in dfs:
+        h.update(repr((list(df.columns), [str(t) for t in df.dtypes], str(df.index.dtype))).encode())
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def _spec_hash(spec):
+    '''Hash of the chart's other arguments, and of the plotting code (so a change to the chart style redraws all)'''
+    args = {k: v for k, v in spec.items() if k not in ("dfs", "filename")}
+    h = hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode())
+    h.update(inspect.getsource(plot_line_chart).encode())
+    return h.hexdigest()
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _render(spec, directory):
+    '''Draw one chart to its files (in a worker process), returning the seconds taken'''
+    start = time.perf_counter()
+    plot_line_chart(spec["dfs"], spec["titles"], ylabels=spec["ylabels"], loc=spec["loc"], ymins=spec["ymins"],
+                    filename=spec["filename"], show=False, directory=directory, formats=spec["formats"],
+                    dpi=spec["dpi"])
+    return time.perf_counter() - start
+
+
+def render(charts, directory=OUTPUT_DIR, workers=None, force=False):
+    '''
+    Render each chart whose data or spec has changed since its files were drawn (or whose files are missing).
+
+    INPUTS:
+    charts (list): chart specs (see `chart`)
+    directory (str): folder to save the figures in
+    workers (int): processes to draw with (by default one per CPU, up to the number of charts to draw)
+    force (bool): redraw every chart
+
+    OUTPUTS:
+    results (df): filename, status ("rendered" or "unchanged") and seconds taken by each chart
+    '''
+    names = [c["filename"] for c in charts]
+    duplicated = {n for n in names if names.count(n) > 1}
+    if duplicated:
+        raise ValueError(f"more than one chart would be saved as {sorted(duplicated)}")
+
+    os.makedirs(directory, exist_ok=True)
+    os.makedirs(os.path.dirname(HASH_FILE), exist_ok=True)
+    recorded = {}
+    if os.path.exists(HASH_FILE):
+        with open(HASH_FILE) as f:
+            recorded = json.load(f)
+
+    # charts are recorded by the path of their files relative to the repo, so each folder keeps its own hashes
+    paths = {n: os.path.relpath(os.path.join(directory, n), ROOT).replace(os.sep, "/") for n in names}
+    hashes = {c["filename"]: {"data": _data_hash(c["dfs"]), "spec": _spec_hash(c)} for c in charts}
+    todo = [c for c in charts
+            if force or recorded.get(paths[c["filename"]]) != hashes[c["filename"]]
+            or not all(os.path.exists(os.path.join(directory, f"{c['filename']}.{fmt}")) for fmt in c["formats"])]
+
+    seconds = {}
+    if todo:
+        workers = min(workers or os.cpu_count() or 1, len(todo))
+        # spawn rather than fork, so workers don't inherit the notebook's plotting backend or open connections
+        context = multiprocessing.get_context("spawn")
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+                times = executor.map(_render, todo, [directory]*len(todo))
+                for c, t in zip(todo, times):
+                    seconds[c["filename"]] = t
+                    recorded[paths[c["filename"]]] = hashes[c["filename"]]
+        finally:
+            # record the charts drawn, even if a later one failed
+            with open(HASH_FILE + ".tmp", "w") as f:
+                json.dump(recorded, f, indent=2, sort_keys=True)
+            os.replace(HASH_FILE + ".tmp", HASH_FILE)
+
+    return pd.DataFrame({"filename": names,
+                         "status": ["rendered" if n in seconds else "unchanged" for n in names],
+                         "seconds": [seconds.get(n, 0.0) for n in names]})
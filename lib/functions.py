@@ -8,7 +8,8 @@ import matplotlib.ticker as ticker
 
     
 
-def plot_line_chart(dfs, titles, ylabels=None, loc='lower left', ymins=None, filename=None):
+def plot_line_chart(dfs, titles, ylabels=None, loc='lower left', ymins=None, filename=None, show=True,
+                    directory=os.path.join("..","output"), formats=("png",), dpi=300):
     '''
     Plot a line chart for each df in list. Plots each column as a separate line. Index of each df should be individual months (datetimes). 
     
@@ -19,6 +20,10 @@ def plot_line_chart(dfs, titles, ylabels=None, loc='lower left', ymins=None, fil
     ylabels (dict): any ylabels to change from the default 'Number of patients', e.g. {1: 'Rate per 1000'}
     ymins (dict): adjust lower y axis limit if required
     filename(str): filename to save figure (optional)
+    show (bool): show the figure (else it is closed once saved, e.g. when rendering in a batch - see figures.py)
+    directory (str): folder to save figure in
+    formats (list): file formats to save, e.g. ["png", "svg"]
+    dpi (int): resolution of saved figure
     
     OUTPUTS:
     chart
@@ -132,9 +137,13 @@ def plot_line_chart(dfs, titles, ylabels=None, loc='lower left', ymins=None, fil
             pass
         
     if filename:
-        plt.savefig(os.path.join("..","output",f"{filename}.png"), format="png", dpi=300, bbox_inches="tight")
+        for fmt in formats:
+            plt.savefig(os.path.join(directory,f"{filename}.{fmt}"), format=fmt, dpi=dpi, bbox_inches="tight")
         
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
     
     
 
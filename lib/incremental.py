@@ -0,0 +1,181 @@
+'''
+Incremental month-by-month refresh of the monthly output series (one row per month, e.g. `warf_doac_issues.csv`).
+
+Each run of the notebook used to recompute every month from the start of the series, although only the newest
+month (and any records entered late for the months just before it) changes. In incremental mode a series records
+the last month which is final - old enough that late-arriving records are no longer expected. The next run then
+computes only the months after it, and merges them into the stored series:
+
+    series = MonthlySeries("2019-01-01", lookback=2)
+    start = series.start("warf_doac_issues")           # first month to compute, e.g. '20200801'
+    ... run the section's queries from `start` ...
+    out = series.merge("warf_doac_issues", out)         # stored months before `start` + the new months
+    series.to_csv("warf_doac_issues", out)              # write the series and record its final months
+
+The stored series, with their counts as computed, and the record of their final months are kept in `.cache/series/`
+(one file of each per series, so sections writing different series never overwrite each other's records). Only the
+CSVs in `output/` have small counts blanked out, so merged months are the same as in a full run.
+A series is computed in full if it has no record yet, its stored CSV is missing, or its first month has changed.
+'''
+import os
+import json
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "output")
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "series")
+
+# counts blanked out of the CSVs in output/
+SUPPRESS = (1, 2, 3, 4, 5)
+
+# most recent full months recomputed on every run, to pick up records entered late
+LOOKBACK = 2
+
+
+def month_start(value):
+    '''First of the month containing a date (or date string)'''
+    return pd.Timestamp(value).to_period("M").to_timestamp()
+
+
+def add_months(month, n):
+    '''The month `n` months after (or before, if negative) a month, as a 'YYYYMMDD' string for query parameters'''
+    return (month_start(month) + pd.DateOffset(months=n)).strftime("%Y%m%d")
+
+
+def months_between(first, last):
+    '''Number of whole months from the month of `first` to the month of `last`'''
+    first, last = month_start(first), month_start(last)
+    return (last.year - first.year)*12 + last.month - first.month
+
+
+class MonthlySeries:
+    '''
+    INPUTS:
+    first_month (str): first month of every series
+    lookback (int): most recent full months to recompute on every run, for late-arriving records
+    full (bool): ignore the stored series and recompute every month (the stored series are then replaced)
+    directory (str): where the series CSVs, with small counts blanked out, are written
+    state_dir (str): where the series as computed, and the records of their final months, are kept
+    today (date): date of the run (the current month is never complete, so is not computed)
+    '''
+
+    def __init__(self, first_month, lookback=LOOKBACK, full=False, directory=OUTPUT_DIR, state_dir=STATE_DIR,
+                 today=None):
+        self.first_month = month_start(first_month)
+        self.lookback = lookback
+        self.full = full
+        self.directory = directory
+        self.state_dir = state_dir
+        self.today = date.today() if today is None else today
+        self._starts = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".csv")
+
+    def _stored(self, name):
+        return os.path.join(self.state_dir, name + ".csv")
+
+    def _record(self, name):
+        path = os.path.join(self.state_dir, name + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _first_to_compute(self, name):
+        record = self._record(name)
+        if self.full or record is None or not os.path.exists(self._stored(name)):
+            return self.first_month
+        if month_start(record["first_month"]) != self.first_month:
+            return self.first_month
+        return max(self.first_month, month_start(record["final_through"]) + pd.DateOffset(months=1))
+
+    def start(self, *names):
+        '''
+        First month to compute for a section producing one or more series (the earliest month any of them needs).
+
+        INPUTS:
+        names (str): names of the series (their CSV file names, without ".csv")
+
+        OUTPUTS:
+        start (str): first month to compute, as 'YYYYMMDD' for query parameters
+        '''
+        start = min(self._first_to_compute(name) for name in names)
+        for name in names:
+            self._starts[name] = start
+        return start.strftime("%Y%m%d")
+
+    def merge(self, name, df, month=None):
+        '''
+        Merge newly computed months into the stored series.
+
+        INPUTS:
+        name (str): name of the series
+        df (df): newly computed series; any rows before the series' start month are ignored
+        month (str): column holding the month, or None if the months are the index
+
+        OUTPUTS:
+        df (df): stored months before the start month, followed by the newly computed months (as datetimes)
+        '''
+        def months(frame):
+            return pd.to_datetime(frame.index if month is None else frame[month])
+
+        def with_months(frame):
+            frame = frame.copy()
+            if month is None:
+                frame.index = months(frame)
+            else:
+                frame[month] = months(frame)
+            return frame
+
+        df = with_months(df)
+        start = self._starts.get(name)
+        if start is None:
+            start = self._first_to_compute(name)
+        if start == self.first_month:
+            return df
+
+        stored = with_months(pd.read_csv(self._stored(name), index_col=0))
+        out = pd.concat([stored[months(stored) < start], df[months(df) >= start]], sort=False)
+        out = out[stored.columns.union(df.columns, sort=False)]
+        if month is not None:
+            out = out.reset_index(drop=True)
+        return out
+
+    def to_csv(self, name, df, month=None, suppress=SUPPRESS):
+        '''
+        Write a series to its CSV in output/ (with small counts blanked out), keep it as computed for later merges, and
+        record the months of it which are now final.
+
+        INPUTS:
+        name (str): name of the series
+        df (df): the full series (see `merge`)
+        month (str): column holding the month, or None if the months are the index
+        suppress (list): counts blanked out of the CSV in output/
+
+        OUTPUTS:
+        None
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        os.makedirs(self.state_dir, exist_ok=True)
+        df.replace(list(suppress), np.nan).to_csv(self._path(name))
+        stored = self._stored(name)
+        df.to_csv(stored + ".tmp")
+        os.replace(stored + ".tmp", stored)
+
+        path = os.path.join(self.state_dir, name + ".json")
+        months = pd.to_datetime(df.index if month is None else df[month])
+        # months before the lookback window (and before the current, incomplete, month) won't change
+        final = month_start(self.today) - pd.DateOffset(months=self.lookback + 1)
+        if len(months) == 0 or min(months.max(), final) < self.first_month:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        record = {"first_month": self.first_month.strftime("%Y-%m-%d"),
+                  "final_through": min(months.max(), final).strftime("%Y-%m-%d")}
+        with open(path + ".tmp", "w") as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
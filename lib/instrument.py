@@ -0,0 +1,77 @@
+'''
+Instrumentation for the SQL run through `DbSession`, to find which statements dominate a notebook's runtime.
+
+Attach a log to a session with `connection.use_log(QueryLog(path))`. Every batch sent and every result read is then
+recorded as one JSON line, labelled with its template name (e.g. `switching/baseline`) or, for raw SQL, the current
+section and a counter (e.g. `switching/sql6`, see `DbSession.section`). Records include:
+
+label, session, kind ("build", "execute", "read" or "replay"), started, seconds, rows (rows read), tables (rows
+and KB of each temp table the batch built or filled), and, if plans are captured, the paths of the actual XML
+execution plans (saved as .sqlplan files, which open in SQL Server Management Studio).
+'''
+import os
+import json
+import time
+import threading
+
+import pandas as pd
+
+
+class QueryLog:
+    '''
+    INPUTS:
+    path (str): JSONL file to append records to
+    plans (bool): capture the actual execution plan of each batch (adds overhead; not available for reads)
+    '''
+
+    def __init__(self, path, plans=False):
+        self.path = path
+        self.plans = plans
+        self.records = []
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.plan_dir = os.path.join(directory, "plans")
+
+    def save_plans(self, label, plans):
+        '''Write captured XML plans to files, returning their paths'''
+        os.makedirs(self.plan_dir, exist_ok=True)
+        stem = label.replace("/", "_") + time.strftime("_%Y%m%d-%H%M%S")
+        paths = []
+        for i, plan in enumerate(plans):
+            path = os.path.join(self.plan_dir, f"{stem}_{i}.sqlplan")
+            with open(path, "w") as f:
+                f.write(plan)
+            paths.append(path)
+        return paths
+
+    def record(self, **fields):
+        with self._lock:
+            self.records.append(fields)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(fields, default=str) + "\n")
+
+    def summary(self, n=20):
+        '''
+        The slowest statements recorded.
+
+        INPUTS:
+        n (int): number of statements to show
+
+        OUTPUTS:
+        df (df): label, kind, seconds, % of total time, rows read and rows in the temp tables built
+        '''
+        if len(self.records) == 0:
+            return pd.DataFrame(columns=["label", "kind", "seconds", "% of total", "rows", "table rows"])
+        df = pd.DataFrame(self.records)
+        df["table rows"] = df["tables"].apply(lambda t: sum(v["rows"] or 0 for v in t.values()) if t else None)
+        df["% of total"] = (100*df["seconds"]/df["seconds"].sum()).round(1)
+        df["seconds"] = df["seconds"].round(2)
+        cols = ["label", "kind", "seconds", "% of total", "rows", "table rows"]
+        return df.sort_values("seconds", ascending=False)[cols].head(n).reset_index(drop=True)
+
+
+def read_log(path):
+    '''Load a JSONL query log (e.g. from a previous run) into a dataframe'''
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
@@ -0,0 +1,340 @@
+'''
+Embedded DuckDB engine, to run the notebook's T-SQL without a SQL Server - e.g. on a laptop, against the simulated
+tables from `simulate.py`, for testing and profiling. Use it by setting `DBCONN=duckdb:<path to database file>`
+(or `duckdb::memory:`).
+
+The T-SQL constructs the notebook uses are translated statement by statement:
+- #temp tables become connection-local TEMP tables (tmp_<name>), and ##global temp tables shared tables
+  (global_<name>) which are dropped when the connection closes
+- SELECT ... INTO, CREATE TABLE, IF OBJECT_ID(...) IS NOT NULL DROP TABLE, OBJECT_ID(...)
+- DECLARE and EXEC sp_executesql, with their typed parameters bound as ? markers
+- DATEFROMPARTS, DATEADD and DATEDIFF (on dates), CONVERT(VARCHAR, date, 23), GETDATE, STDEV and sys.all_columns
+  (as a source of row numbers), and 'YYYYMMDD' date literals
+- SET options, table hints and clustered indexes, which have no equivalent, are dropped
+PERCENT_RANK, ROW_NUMBER and the other window and aggregate functions are the same in both.
+'''
+import re
+import threading
+from datetime import datetime
+
+
+# DuckDB date functions for DATEADD date parts
+INTERVALS = {"year": "to_years", "yy": "to_years", "month": "to_months", "mm": "to_months", "m": "to_months",
+             "week": "to_weeks", "wk": "to_weeks", "day": "to_days", "dd": "to_days", "d": "to_days"}
+
+# (matched after temp table names are translated)
+SELECT_INTO = re.compile(r"^SELECT\s+(.*?)\s+INTO\s+(\w+)\s+FROM\b", re.IGNORECASE | re.DOTALL)
+CREATE_TABLE = re.compile(r"^CREATE\s+TABLE\s+(\w+)", re.IGNORECASE)
+DROP_IF_EXISTS = re.compile(r"^IF\s+OBJECT_ID\s*\(\s*'[^']*'\s*\)\s+IS\s+NOT\s+NULL\s+DROP\s+TABLE\s+(#{0,2}\w+)$",
+                            re.IGNORECASE)
+DECLARE = re.compile(r"^DECLARE\s+(.*)$", re.IGNORECASE | re.DOTALL)
+EXECUTESQL = re.compile(r"^EXEC(?:UTE)?\s+sp_executesql\s+N'((?:[^']|'')*)'\s*,\s*N'([^']*)'\s*,(.*)$",
+                        re.IGNORECASE | re.DOTALL)
+# SET options and indexes
+SKIPPED = re.compile(r"^(SET\s|CREATE\s+(CLUSTERED\s+|NONCLUSTERED\s+)?INDEX\b)", re.IGNORECASE)
+VARIABLE = re.compile(r"@(\w+)\s+([\w()]+)")
+DATE_LITERAL = re.compile(r"'(\d{4})(\d{2})(\d{2})'")
+DATE_VALUE = re.compile(r"^(\d{4})(\d{2})(\d{2})$")
+TEMP_TABLE = re.compile(r"(#{1,2})(\w+)")
+
+
+def _table(name):
+    '''Local name of a table: #x -> tmp_x, ##x -> global_x, others unchanged'''
+    if name.startswith("##"):
+        return "global_" + name[2:]
+    if name.startswith("#"):
+        return "tmp_" + name[1:]
+    return name
+
+
+def _scan(sql):
+    '''
+    Split SQL into statements (on semicolons), dropping comments. String literals are kept intact, so neither
+    semicolons nor comment markers inside them are treated as such.
+    '''
+    statements, current, i, n = [], [], 0, len(sql)
+    while i < n:
+        if sql[i] == "'":
+            j = i + 1
+            while j < n:
+                if sql[j] == "'" and j + 1 < n and sql[j + 1] == "'":
+                    j += 2
+                elif sql[j] == "'":
+                    break
+                else:
+                    j += 1
+            current.append(sql[i:j + 1])
+            i = j + 1
+        elif sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = n if end == -1 else end
+        elif sql.startswith("/*", i):
+            end = sql.find("*/", i)
+            i = n if end == -1 else end + 2
+        elif sql[i] == ";":
+            statements.append("".join(current).strip())
+            current = []
+            i += 1
+        else:
+            current.append(sql[i])
+            i += 1
+    statements.append("".join(current).strip())
+    return [s for s in statements if s]
+
+
+def _markers(sql):
+    '''Number of ? parameter markers in a statement (outside string literals)'''
+    return re.sub(r"'(?:[^']|'')*'", "", sql).count("?")
+
+
+def _calls(sql, name, rewrite):
+    '''Replace every call to a T-SQL function, name(args), with rewrite(args) (innermost calls first)'''
+    pattern = re.compile(r"\b" + name + r"\s*\(", re.IGNORECASE)
+    for match in reversed(list(pattern.finditer(sql))):
+        args, depth, start, i = [], 1, match.end(), match.end()
+        while depth > 0:
+            c = sql[i]
+            if c == "'":
+                i = sql.index("'", i + 1)
+            elif c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            elif c == "," and depth == 1:
+                args.append(sql[start:i].strip())
+                start = i + 1
+            i += 1
+        args.append(sql[start:i - 1].strip())
+        sql = sql[:match.start()] + rewrite(args) + sql[i:]
+    return sql
+
+
+def _object_id(args):
+    '''Subquery returning 1 if a table exists, e.g. for OBJECT_ID('tempdb..#x')'''
+    name = _table(args[0].strip("'").split(".")[-1]).lower()
+    return f"(SELECT 1 FROM duckdb_tables() WHERE lower(table_name) = '{name}' LIMIT 1)"
+
+
+def _date_literal(match):
+    '''Convert a 'YYYYMMDD' literal (which SQL Server reads as a date) to ISO format, if it is a valid date'''
+    try:
+        return "'" + datetime.strptime("".join(match.groups()), "%Y%m%d").strftime("%Y-%m-%d") + "'"
+    except ValueError:
+        return match.group(0)
+
+
+def _value(value, sql_type):
+    '''A parameter value as DuckDB will convert it to its declared T-SQL type'''
+    if isinstance(value, str) and sql_type.lower().startswith("date") and DATE_VALUE.match(value):
+        return "-".join(DATE_VALUE.match(value).groups())
+    return value
+
+
+def _expressions(sql):
+    '''Translate the T-SQL functions, literals and temp table names in a statement'''
+    sql = re.sub(r"\bWITH\s*\(\s*TABLOCK\s*\)", "", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\s+COLLATE\s+DATABASE_DEFAULT\b", "", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bGETDATE\s*\(\s*\)", "current_date", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bSTDEV\s*\(", "stddev_samp(", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bsys\.all_columns\b", "range(10000)", sql, flags=re.IGNORECASE)
+    sql = DATE_LITERAL.sub(_date_literal, sql)
+    sql = _calls(sql, "OBJECT_ID", _object_id)
+    sql = _calls(sql, "DATEFROMPARTS", lambda a: f"make_date({a[0]}, {a[1]}, {a[2]})")
+    sql = _calls(sql, "DATEADD",
+                 lambda a: f"CAST(({a[2]}) + {INTERVALS[a[0].lower()]}(CAST({a[1]} AS INTEGER)) AS DATE)")
+    sql = _calls(sql, "DATEDIFF",
+                 lambda a: f"date_diff('{a[0].lower()}', CAST({a[1]} AS DATE), CAST({a[2]} AS DATE))")
+    # style 23 is yyyy-mm-dd
+    sql = _calls(sql, "CONVERT", lambda a: f"strftime(CAST({a[1]} AS DATE), '%Y-%m-%d')" if a[2:] == ["23"]
+                 else f"CAST({a[1]} AS VARCHAR)")
+    return TEMP_TABLE.sub(lambda m: _table(m.group(0)), sql)
+
+
+def _bind(sql, types, values=None):
+    '''
+    Replace @variables with typed, named parameters (or typed NULLs, for DECLAREd variables with no value). Named
+    rather than ? parameters keep repeated expressions identical, e.g. for a GROUP BY to match its SELECT.
+
+    OUTPUTS:
+    sql (str): statement with the variables replaced
+    params (dict): values of the named parameters
+    '''
+    params = {}
+
+    def replace(match):
+        name = match.group(1)
+        if name not in types:
+            return match.group(0)
+        if values is None:
+            return f"CAST(NULL AS {types[name]})"
+        params[name] = _value(values[name], types[name])
+        return f"CAST(${name} AS {types[name]})"
+
+    return re.sub(r"@(\w+)", replace, sql), params
+
+
+def translate(batch, params=None):
+    '''
+    Translate a T-SQL batch into DuckDB statements.
+
+    INPUTS:
+    batch (str): T-SQL, one or more statements separated by semicolons
+    params (list): values for the ? markers in the batch
+
+    OUTPUTS:
+    statements (list): (sql, params) for each statement to run, in order. Params are a list for ? markers, or a
+                       dict for named parameters (from sp_executesql)
+    '''
+    params = list(params or [])
+    declared = {}
+    out = []
+    for statement in _scan(batch):
+        values = params[:_markers(statement)]
+        params = params[len(values):]
+
+        if SKIPPED.match(statement):
+            continue
+        dropped = DROP_IF_EXISTS.match(statement)
+        if dropped:
+            out.append((f"DROP TABLE IF EXISTS {_table(dropped.group(1))}", []))
+            continue
+        declare = DECLARE.match(statement)
+        if declare:
+            declared.update(VARIABLE.findall(declare.group(1)))
+            continue
+
+        execute = EXECUTESQL.match(statement)
+        if execute:
+            inner, declarations, assignments = execute.groups()
+            types = dict(VARIABLE.findall(declarations))
+            names = re.findall(r"@(\w+)\s*=\s*\?", assignments)
+            # the statement run by sp_executesql may itself be a batch
+            for sql, _ in translate(inner.replace("''", "'")):
+                out.append(_bind(sql, types, dict(zip(names, values))))
+            continue
+
+        statement = _expressions(statement)
+        selected = SELECT_INTO.match(statement)
+        created = CREATE_TABLE.match(statement)
+        if selected:
+            columns, table = selected.groups()
+            kind = "TABLE" if table.startswith("global_") else "TEMP TABLE"
+            statement = f"CREATE {kind} {table} AS SELECT {columns} FROM" + statement[selected.end():]
+        elif created and created.group(1).startswith("tmp_"):
+            statement = "CREATE TEMP TABLE" + statement[len("CREATE TABLE"):]
+        sql, _ = _bind(statement, declared)
+        out.append((sql, values))
+    return out
+
+
+##### DB-API connection ########
+
+class Error(Exception):
+    '''Base class of the engine's errors. As pyodbc's, their arguments are the SQLSTATE and the message'''
+
+
+class ProgrammingError(Error):
+    '''SQL which couldn't be translated or run'''
+
+
+# one database instance per file; each connection to it has its own temp tables
+_databases = {}
+_lock = threading.Lock()
+
+
+def _database(path):
+    import duckdb
+    with _lock:
+        if path not in _databases:
+            _databases[path] = duckdb.connect(path)
+        return _databases[path]
+
+
+def connect(path):
+    '''Open a connection to a local DuckDB database ("" or ":memory:" for an in-memory one)'''
+    return LocalConnection(path or ":memory:")
+
+
+class LocalCursor:
+    '''DB-API cursor which runs T-SQL batches on a `LocalConnection` (only the last result set is returned)'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.fast_executemany = False
+        self._result = None
+
+    def execute(self, sql, params=None):
+        import duckdb
+        self.description = None
+        con = self.connection._con
+        statement = sql
+        try:
+            for statement, values in translate(sql, params):
+                con.execute(statement, values)
+                if re.match(r"^\s*(SELECT|WITH)\b", statement, re.IGNORECASE):
+                    self.description = con.description
+                    self._result = con
+                elif re.match(r"^\s*CREATE\s+TABLE\s+(global_\w+)", statement):
+                    self.connection._globals.add(statement.split()[2])
+        except duckdb.Error as e:
+            # raise as the ODBC driver would, so errors are handled the same way for every backend
+            raise ProgrammingError("42000", f"{e}\n{statement}")
+        return self
+
+    def executemany(self, sql, rows):
+        statements = translate(sql, [None]*_markers(sql))
+        if len(statements) != 1:
+            raise ProgrammingError("42000", "executemany takes a single statement")
+        self.connection._con.executemany(statements[0][0], rows)
+
+    def append(self, table, df):
+        '''Insert a dataframe into a table directly (much faster than executemany)'''
+        cols = ", ".join(df.columns)
+        self.connection._con.register("frame", df)
+        self.connection._con.execute(f"INSERT INTO {_table(table)} ({cols}) SELECT {cols} FROM frame")
+        self.connection._con.unregister("frame")
+
+    def fetchone(self):
+        return self._result.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._result.fetchmany(size)
+
+    def fetchall(self):
+        return self._result.fetchall()
+
+    def nextset(self):
+        return False
+
+    def close(self):
+        self._result = None
+
+
+class LocalConnection:
+    '''DB-API connection to the local engine, in autocommit mode'''
+
+    def __init__(self, path):
+        self._con = _database(path).cursor()
+        # shared tables created on this connection, dropped when it closes (like ##temp tables)
+        self._globals = set()
+
+    def cursor(self):
+        return LocalCursor(self)
+
+    def table_size(self, table):
+        '''Rows and space used (KB) by a temp table (DuckDB doesn't report the space used by one table)'''
+        rows = self._con.execute(f"SELECT COUNT(*) FROM {_table(table)}").fetchone()[0]
+        return {"rows": rows, "kb": None}
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        for table in self._globals:
+            self._con.execute(f"DROP TABLE IF EXISTS {table}")
+        self._globals = set()
+        self._con.close()
@@ -0,0 +1,132 @@
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from db import get_pool
+from queries import get_template
+
+
+# a reference to a local temp table (#x, but not a global ##x)
+LOCAL_TABLE = re.compile(r"(?<![#\w])#\w+")
+
+
+def run_concurrently(dbconn, func, items, workers=2, prepare=None):
+    '''
+    Run the same analysis for several independent inputs (e.g. switching periods) at once, each on its own pooled
+    connection. The database does the work, and pyodbc releases the GIL while it waits, so threads are enough.
+
+    Temp tables belong to the connection that built them, so anything a job needs from the main session (codelists,
+    staged issues/repeats) must be made available on each worker by `prepare`: usually with
+    `worker.use_shared(main, STAGED)`, which reads global temp table copies of the main session's tables rather than
+    building them again. Worker sessions are kept in the pool, and templates run with the same parameters are not
+    rebuilt, so this is only paid the first time a worker is used.
+
+    INPUTS:
+    dbconn (str): ODBC connection string
+    func (function): called as func(connection, item) for each item, returning its results
+    items (list): inputs to run, e.g. lists of period dates
+    workers (int): maximum number of jobs (and connections) running at once
+    prepare (function): called as prepare(connection) on each worker session before its job (optional)
+
+    OUTPUTS:
+    results (list): results of func for each item, in the same order as items
+    '''
+    pool = get_pool(dbconn)
+    # allow the pool to open as many worker connections as there are workers
+    pool.size = max(pool.size, workers)
+
+    def job(item):
+        with pool.worker() as connection:
+            if prepare is not None:
+                prepare(connection)
+            return func(connection, item)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map returns results in the order submitted (not completed), and re-raises any job's error here
+        return list(executor.map(job, items))
+
+
+def _resolve(read):
+    '''Template and parameter values for a read, given as a template name or (template name, values)'''
+    if isinstance(read, str):
+        return get_template(read), {}
+    template, values = read
+    return get_template(template), values
+
+
+async def read_async(connection, reads, workers=3):
+    '''
+    Run independent reads from a session's temp tables at the same time, each on its own pooled connection, and
+    await them together, so a section takes as long as its slowest query rather than the sum of them.
+
+    Other connections can't see a session's temp tables, so each table read is first copied to a global temp table
+    (see `DbSession.share`), and the reads are run against the copies. Results are cached as for `DbSession.read`.
+
+    INPUTS:
+    connection (DbSession): session the temp tables were built on
+    reads (list): template names, or (template name, parameter values) pairs, e.g. ("ttr/split", {"start": ...})
+    workers (int): maximum number of reads (and connections) running at once
+
+    OUTPUTS:
+    results (list): dataframe of results for each read, in the same order as reads
+    '''
+    cache = connection.cache
+    results = [None]*len(reads)
+    todo = []
+    for i, read in enumerate(reads):
+        t, values = _resolve(read)
+        query, params = t.query(), t.values(values) or None
+        lineage = connection.lineage(query) if cache is not None else None
+        key = cache.key(query, params, lineage) if lineage is not None else None
+        if key is not None:
+            results[i] = cache.get(key)
+        if results[i] is None:
+            todo.append((i, t.name, query, params, key))
+
+    # build (on this session) and share every temp table the remaining reads need
+    shared = {}
+    for _, _, query, _, _ in todo:
+        connection.require(query)
+        for table in set(LOCAL_TABLE.findall(query)):
+            if table not in shared:
+                shared[table] = connection.share(table)
+
+    pool = get_pool(connection.dbconn)
+    pool.size = max(pool.size, workers)
+
+    def job(query, params, label):
+        with pool.worker() as worker:
+            worker.use_log(connection.log)
+            return worker.read_sql(LOCAL_TABLE.sub(lambda m: shared[m.group(0)], query), params=params, label=label)
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dfs = await asyncio.gather(*[loop.run_in_executor(executor, job, query, params, label)
+                                     for _, label, query, params, _ in todo])
+
+    for (i, label, query, _, key), df in zip(todo, dfs):
+        if key is not None:
+            cache.put(key, df, label=label, query=query)
+        results[i] = df
+    return results
+
+
+def read_concurrently(connection, reads, workers=3):
+    '''
+    Run independent reads from a session's temp tables at the same time (see `read_async`), from ordinary code.
+
+    INPUTS:
+    connection (DbSession): session the temp tables were built on
+    reads (list): template names, or (template name, parameter values) pairs
+    workers (int): maximum number of reads (and connections) running at once
+
+    OUTPUTS:
+    results (list): dataframe of results for each read, in the same order as reads
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(read_async(connection, reads, workers))
+    # already inside an event loop (e.g. a Jupyter kernel's), so run on a loop of its own in another thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, read_async(connection, reads, workers)).result()
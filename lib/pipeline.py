@@ -0,0 +1,493 @@
+'''
+Dependency-aware runner for the sections of the main notebook, as named stages.
+
+Re-running the notebook executes every section in order, although most of its outputs depend on only a few of the
+others: the DOAC types table needs the switching counts and the codelists, the costings need the DOAC types and
+switchers tables, and the issues, repeats, switching and INR sections are independent of each other once the
+codelists are resolved and the prescriptions staged. Here each section is a stage declaring the stages it requires,
+the files it reads and the files it writes:
+
+    codelists -> staging -> issues, repeats, doac_repeats, inr          (monthly series in output/)
+                         -> switching -> doac_types -> costings          (doac_switchers.csv, doac_types.csv, ...)
+
+The stages call the same functions as the notebook (see `sections.py`). A stage is hashed from the code it runs (this
+module, and the modules it calls, e.g. `sections.py`, `incremental.py` and `db.py`), the contents of its input files
+(codelist CSVs, the outputs of the stages it requires, the SQL in `queries.py` and `staging.py`), `DB_SNAPSHOT` and
+the database it reads. If the hash matches the one recorded when its outputs were last written (in
+`.cache/pipeline/pipeline_hashes.json`), and they are all still there, the stage is skipped. The other stages are
+run as soon as the stages they require are done, in a pool of processes:
+
+    python pipeline.py                          # every stage
+    python pipeline.py doac_types --workers 2   # doac_types and the stages it requires
+    python pipeline.py --list                   # the stages, their requirements and outputs
+
+Temp tables belong to the connection which built them, so "staging" is a session stage: it is run once, in the
+runner, on a session of its own, before the first stage which requires it, and the tables it builds are shared as
+global temp table copies (see `DbSession.share_tables`), which the workers read rather than staging again (see
+`DbSession.use_shared`). Workers write nothing to `output/`: stages return their outputs, which are written by the
+runner as each stage finishes, so the monthly series are never written by two processes at once. The TTR section
+only draws charts, so isn't a stage.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+import sections
+from db import get_pool
+from backends import single_process
+from queries import load_codelists
+from codelists import drug_codelist, file_hash
+from staging import stage, STAGED
+from cache import QueryCache
+from incremental import MonthlySeries, SUPPRESS, add_months
+from sections import FIRST_MONTH, SWITCHING_PERIODS, INR_SUPPRESS
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HASH_FILE = os.path.join(".cache", "pipeline", "pipeline_hashes.json")
+CODELIST_FILE = os.path.join(".cache", "pipeline", "codelists.json")
+DOAC_TYPE_COUNTS = os.path.join(".cache", "pipeline", "doac_type_counts.csv")
+
+CODELISTS = {
+    "warfarin": os.path.join("local_codelists", "warfarin_codelist.csv"),
+    "DOAC": os.path.join("local_codelists", "doac_codelist.csv"),
+    "inr": os.path.join("codelists", "opensafely-international-normalised-ratio-inr.csv"),
+    "high_inr": os.path.join("codelists", "opensafely-high-international-normalised-ratio-inr.csv"),
+}
+# files holding the SQL run by the database stages
+SQL = [os.path.join("lib", "queries.py"), os.path.join("lib", "staging.py")]
+# modules whose code the stages run, hashed with their inputs: this one for every stage, those sending statements to
+# the database for every database stage, and those each stage calls
+PIPELINE = os.path.join("lib", "pipeline.py")
+DATABASE_CODE = [os.path.join("lib", m) for m in ["db.py", "backends.py", "local.py", "parallel.py"]]
+CODE = {
+    "codelists": [os.path.join("lib", "codelists.py")],
+    "sections": [os.path.join("lib", m) for m in ["sections.py", "incremental.py", "dummy.py"]],
+}
+
+
+class Stage:
+    '''
+    A section of the analysis.
+
+    INPUTS:
+    name (str): registry key
+    func (function): called as func(connection, context), returning its outputs as a dict of {path: dataframe (or
+                     dict, for .json files)}, and of {series name: dataframe} for monthly series
+    requires (list): names of the stages which must be run first; their outputs are inputs of this stage
+    inputs (list): other files read, relative to the repository root
+    outputs (list): files written, relative to the repository root
+    series (dict): monthly series written to output/ (see `incremental.py`), and the column holding their months
+                   (None if the months are the index)
+    database (bool): reads the database, so is given a connection, and is re-run when the database changes
+    session (bool): builds temp tables for the stages which require it (once, in the runner), rather than outputs
+    '''
+
+    def __init__(self, name, func, requires=None, inputs=None, outputs=None, series=None, database=False,
+                 session=False):
+        self.name = name
+        self.func = func
+        self.requires = list(requires or [])
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.series = dict(series or {})
+        self.database = database or session
+        self.session = session
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+    def files(self):
+        '''Every file the stage writes, relative to the repository root'''
+        return self.outputs + [os.path.join("output", f"{name}.csv") for name in self.series]
+
+
+STAGES = {}
+
+def register_stage(name, func, requires=None, inputs=None, outputs=None, series=None, database=False, session=False):
+    '''Add a stage to the registry (after the stages it requires)'''
+    unknown = [r for r in requires or [] if r not in STAGES]
+    if unknown:
+        raise KeyError(f"Stage {name!r} requires unknown stages {unknown}")
+    STAGES[name] = Stage(name, func, requires=requires, inputs=inputs, outputs=outputs, series=series,
+                         database=database, session=session)
+    return STAGES[name]
+
+
+##### stages ########
+
+def _series(context):
+    return MonthlySeries(FIRST_MONTH, lookback=context["lookback"], full=not context["incremental"])
+
+
+def _dummy(context):
+    '''Whether the database is the dummy database, into whose working tables the sections insert dummy rows'''
+    return 'OPENCoronaExport' in context["dbconn"]
+
+
+def _read_codelists():
+    with open(os.path.join(ROOT, CODELIST_FILE)) as f:
+        return json.load(f)
+
+
+def _codelists(connection, context):
+    path = os.path.join(ROOT, CODELISTS["warfarin"])
+    _, warf = drug_codelist(path, context["dbconn"], snapshot=context["snapshot"])
+    path = os.path.join(ROOT, CODELISTS["DOAC"])
+    doac_full, doac = drug_codelist(path, context["dbconn"], snapshot=context["snapshot"])
+    # Multilex IDs with their chemical, for the DOAC types table
+    chemicals = doac_full.merge(pd.read_csv(path)[["id", "chemical"]], left_on="DMD_ID", right_on="id")
+    ctv3 = {group: pd.read_csv(os.path.join(ROOT, CODELISTS[group]))["id"].astype(str).tolist()
+            for group in ["inr", "high_inr"]}
+    return {CODELIST_FILE: {"warfarin": list(warf), "DOAC": list(doac), **ctv3,
+                            "chemicals": dict(zip(chemicals["MultilexDrug_ID"], chemicals["chemical"]))}}
+
+
+def _staging(connection, context):
+    codes = _read_codelists()
+    load_codelists(connection, drugs={"warfarin": tuple(codes["warfarin"]), "DOAC": tuple(codes["DOAC"])},
+                   ctv3={"inr": codes["inr"], "high_inr": codes["high_inr"]})
+    stage(connection)
+
+
+def _issues(connection, context):
+    # the reads are run one after another, as the other stages are using the pooled connections
+    out, same_day = sections.issues(connection, _series(context), dummy=_dummy(context), concurrent=False)
+    return {"warf_doac_issues": out, "same_day_issues": same_day}
+
+
+def _repeats(connection, context):
+    out, same_day = sections.repeats(connection, _series(context), dummy=_dummy(context))
+    return {"warf_doac_repeats": out, "same_day_repeats": same_day}
+
+
+def _doac_repeats(connection, context):
+    return {"doac_repeats": sections.doac_repeats(connection, _series(context), dummy=_dummy(context))}
+
+
+def _switching(connection, context):
+    dummy_doacs = _read_codelists()["DOAC"] if _dummy(context) else None
+    summaries, types = [], []
+    for period, dates in SWITCHING_PERIODS.items():
+        summary, doac_types = sections.switching(connection, dates, dummy_doacs=dummy_doacs)
+        summaries.append(sections.summarise_switching(summary, period))
+        types.append(doac_types.assign(period=period))
+    # the DOAC type counts (before rounding) are kept out of output/, for the doac_types stage
+    return {os.path.join("output", "doac_switchers.csv"): pd.concat(summaries),
+            DOAC_TYPE_COUNTS: pd.concat(types, ignore_index=True)}
+
+
+def _doac_types(connection, context):
+    counts = pd.read_csv(os.path.join(ROOT, DOAC_TYPE_COUNTS), dtype={"year": str, "first_doac_type": str})
+    chemicals = pd.Series(_read_codelists()["chemicals"], name="chemical").rename_axis("MultilexDrug_ID")
+    doacs = [sections.doac_types(counts.loc[counts["period"] == period].drop(columns="period"), period,
+                                 chemicals.reset_index())
+             for period in SWITCHING_PERIODS]
+    return {os.path.join("output", "doac_types.csv"): pd.concat(doacs).sort_index()}
+
+
+def _inr(connection, context):
+    tests, high = sections.inr_testing(connection, _series(context), dummy=_dummy(context),
+                                       last_month=context["last_month"])
+    return {"inr_testing": tests, "high_inr": high}
+
+
+def _costings(connection, context):
+    # warfarin tablets and TPP list sizes are BigQuery results cached by the DOAC costings notebook
+    out = sections.costings(*[pd.read_csv(os.path.join(ROOT, "output", f)) for f in
+                              ["doac_types.csv", "doac_switchers.csv", "warf_df.csv", "tpp_df.csv"]])
+    return {os.path.join("output", "doac_costings.csv"): out.to_frame().round(4)}
+
+
+register_stage("codelists", _codelists, inputs=CODE["codelists"] + [CODELISTS[c] for c in CODELISTS],
+               outputs=[CODELIST_FILE], database=True)
+register_stage("staging", _staging, requires=["codelists"], inputs=SQL, session=True)
+register_stage("issues", _issues, requires=["staging"], inputs=SQL + CODE["sections"],
+               series={"warf_doac_issues": None, "same_day_issues": None}, database=True)
+register_stage("repeats", _repeats, requires=["staging"], inputs=SQL + CODE["sections"],
+               series={"warf_doac_repeats": None, "same_day_repeats": None}, database=True)
+register_stage("doac_repeats", _doac_repeats, requires=["staging"], inputs=SQL + CODE["sections"],
+               series={"doac_repeats": None}, database=True)
+register_stage("switching", _switching, requires=["staging"], inputs=SQL + CODE["sections"],
+               outputs=[os.path.join("output", "doac_switchers.csv"), DOAC_TYPE_COUNTS], database=True)
+register_stage("doac_types", _doac_types, requires=["codelists", "switching"], inputs=CODE["sections"],
+               outputs=[os.path.join("output", "doac_types.csv")])
+register_stage("inr", _inr, requires=["staging"], inputs=SQL + CODE["sections"],
+               series={"inr_testing": "INR_month", "high_inr": "high_INR_month"}, database=True)
+register_stage("costings", _costings, requires=["switching", "doac_types"],
+               inputs=CODE["sections"] + [os.path.join("output", "warf_df.csv"),
+                                          os.path.join("output", "tpp_df.csv")],
+               outputs=[os.path.join("output", "doac_costings.csv")])
+
+
+##### running ########
+
+def requirements(names):
+    '''The stages named, and every stage they require, in the order they were registered'''
+    unknown = set(names) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    needed = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(STAGES[name].requires)
+    return [name for name in STAGES if name in needed]
+
+
+def stage_hash(name, hashes, context):
+    '''
+    Hash of the code a stage runs (this module, the modules it calls and, if it reads the database, those sending its
+    statements), the contents of its other inputs (including the outputs of the stages it requires), the hashes of the
+    session stages it requires and, if it reads the database, the database and its snapshot.
+
+    INPUTS:
+    name (str): stage
+    hashes (dict): hashes of the stages it requires
+    context (dict): settings of the run (see `run`)
+
+    OUTPUTS:
+    hash (str)
+    '''
+    s = STAGES[name]
+    h = hashlib.sha256(name.encode())
+    inputs = [PIPELINE] + (DATABASE_CODE if s.database else []) + s.inputs
+    inputs += [f for r in s.requires for f in STAGES[r].files()]
+    for path in inputs:
+        full = os.path.join(ROOT, path)
+        h.update(f"{path}:{file_hash(full) if os.path.exists(full) else 'missing'}".encode())
+    for r in s.requires:
+        if STAGES[r].session:
+            h.update(hashes[r].encode())
+    if s.database:
+        h.update(hashlib.sha256(context["dbconn"].encode()).digest())
+        h.update(context["snapshot"].encode())
+    if s.series:
+        h.update(json.dumps([FIRST_MONTH, context["lookback"], context["incremental"], context["last_month"]]).encode())
+    return h.hexdigest()
+
+
+def _use_cache(connection, context):
+    '''Cache a session's results, when DB_SNAPSHOT identifies the version of the database'''
+    if connection.cache is None and context["snapshot"]:
+        codelists = [os.path.join(ROOT, p) for p in CODELISTS.values()]
+        connection.use_cache(QueryCache(context["dbconn"], codelists=codelists, snapshot=context["snapshot"]))
+
+
+def _prepare(names, context):
+    '''
+    Run session stages in the runner, on its own session, and share the tables they build (as global temp table
+    copies) for the stages run in the workers to read.
+
+    OUTPUTS:
+    seconds (dict): time taken by each session stage
+    '''
+    connection = get_pool(context["dbconn"]).session("pipeline")
+    _use_cache(connection, context)
+    seconds = {}
+    for name in names:
+        started = time.perf_counter()
+        STAGES[name].func(connection, context)
+        seconds[name] = time.perf_counter() - started
+    started = time.perf_counter()
+    context["shared"] = connection.share_tables(STAGED)
+    seconds[names[-1]] += time.perf_counter() - started
+    return seconds
+
+
+def _run_stage(name, context):
+    '''
+    Run one stage (in a worker), reading the tables built by the session stages from their shared copies.
+
+    OUTPUTS:
+    outputs (dict): the stage's outputs
+    seconds (float): time taken by the stage
+    '''
+    s = STAGES[name]
+    if not s.database:
+        started = time.perf_counter()
+        outputs = s.func(None, context)
+        return outputs, time.perf_counter() - started
+
+    pool = get_pool(context["dbconn"])
+    pool.size = max(pool.size, context["workers"])
+    with pool.worker() as connection:
+        _use_cache(connection, context)
+        if any(STAGES[r].session for r in s.requires):
+            connection.use_shared(context["shared"])
+        started = time.perf_counter()
+        outputs = s.func(connection, context)
+        return outputs, time.perf_counter() - started
+
+
+def _write(name, outputs, series):
+    '''Write a stage's outputs (in the runner, so no two processes write output/ at once)'''
+    s = STAGES[name]
+    missing = set(s.outputs + list(s.series)) - set(outputs)
+    if missing:
+        raise ValueError(f"Stage {name!r} didn't return {sorted(missing)}")
+    for key, value in outputs.items():
+        if key in s.series:
+            # INR series blank out zero counts too
+            series.to_csv(key, value, month=s.series[key],
+                          suppress=INR_SUPPRESS if key in ("inr_testing", "high_inr") else SUPPRESS)
+            continue
+        path = os.path.join(ROOT, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.endswith(".json"):
+            with open(path + ".tmp", "w") as f:
+                json.dump(value, f, indent=2, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        else:
+            value.to_csv(path)
+
+
+def _record(recorded):
+    path = os.path.join(ROOT, HASH_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(recorded, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def run(dbconn, stages=None, workers=None, force=False, snapshot=None, incremental=False, lookback=2,
+        last_month=None):
+    '''
+    Run the stages named (and those they require) whose inputs have changed, each as soon as the stages it requires
+    are done, in a pool of processes (or of threads, for databases only one process can open).
+
+    INPUTS:
+    dbconn (str): connection string of the database
+    stages (list): names of the stages to run (all by default)
+    workers (int): stages to run at once (by default one per CPU)
+    force (bool): run every stage, whether or not its inputs have changed
+    snapshot (str): identifier of the database version (`DB_SNAPSHOT`); stages reading the database are re-run when
+                    it changes
+    incremental (bool): only compute months of the monthly series which aren't yet final (see `incremental.py`)
+    lookback (int): most recent full months of the series recomputed on every run
+    last_month (str): last month of the INR series (by default the last full month)
+
+    OUTPUTS:
+    results (df): status ("run", "unchanged", "failed" or "blocked", if a stage it requires failed), seconds and
+                  error of each stage, indexed by stage
+    '''
+    names = requirements(list(STAGES) if stages is None else stages)
+    workers = workers or os.cpu_count() or 1
+    if last_month is None:
+        last_month = add_months(pd.Timestamp.today(), -1)
+    context = {"dbconn": dbconn, "snapshot": "" if snapshot is None else str(snapshot), "workers": workers,
+               "incremental": bool(incremental), "lookback": lookback,
+               "last_month": add_months(last_month, 0)}
+    series = _series(context)
+
+    path = os.path.join(ROOT, HASH_FILE)
+    recorded = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            recorded = json.load(f)
+
+    hashes, status, seconds, errors = {}, {}, {}, {}
+    pending = list(names)
+    running = {}
+    if single_process(dbconn):
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        # spawn rather than fork, so workers don't inherit open connections
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    with executor:
+        while pending or running:
+            # stages are registered after the stages they require, so one pass reaches every stage now ready
+            for name in list(pending):
+                s = STAGES[name]
+                if any(status.get(r) in ("failed", "blocked") for r in s.requires):
+                    status[name] = "blocked"
+                    pending.remove(name)
+                    continue
+                if not all(status.get(r) in ("run", "unchanged") for r in s.requires):
+                    continue
+                pending.remove(name)
+                hashes[name] = stage_hash(name, hashes, context)
+                if s.session:
+                    # run in the runner before the first stage which requires it; "run" if any is
+                    status[name] = "unchanged"
+                    continue
+                files = [os.path.join(ROOT, f) for f in s.files()]
+                if not force and recorded.get(name) == hashes[name] and all(os.path.exists(f) for f in files):
+                    status[name] = "unchanged"
+                    continue
+                sessions = [r for r in s.requires if STAGES[r].session]
+                if sessions and "shared" not in context:
+                    try:
+                        seconds.update(_prepare(sessions, context))
+                    except Exception as e:
+                        for r in sessions:
+                            status[r] = "failed"
+                            errors[r] = f"{type(e).__name__}: {e}"
+                        status[name] = "blocked"
+                        continue
+                    for r in sessions:
+                        status[r] = "run"
+                future = executor.submit(_run_stage, name, context)
+                running[future] = name
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outputs, seconds[name] = future.result()
+                    _write(name, outputs, series)
+                except Exception as e:
+                    status[name] = "failed"
+                    errors[name] = f"{type(e).__name__}: {e}"
+                    # a stage which failed part-way may have written some of its outputs
+                    recorded.pop(name, None)
+                    _record(recorded)
+                    continue
+                status[name] = "run"
+                recorded[name] = hashes[name]
+                _record(recorded)
+
+    return pd.DataFrame({"status": [status[n] for n in names],
+                         "seconds": [seconds.get(n, 0.0) for n in names],
+                         "error": [errors.get(n, "") for n in names]}, index=pd.Index(names, name="stage"))
+
+
+def describe():
+    '''The stages, the stages each requires and the files each writes'''
+    return pd.DataFrame({"requires": [", ".join(s.requires) for s in STAGES.values()],
+                         "writes": [", ".join(s.files()) or "(temp tables)" for s in STAGES.values()]},
+                        index=pd.Index(list(STAGES), name="stage"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stages of the analyses whose inputs have changed")
+    parser.add_argument("stages", nargs="*", help="stages to run, with those they require (all by default)")
+    parser.add_argument("--dbconn", default=os.environ.get("DBCONN", ""), help="connection string (default DBCONN)")
+    parser.add_argument("--workers", type=int, default=None, help="stages run at once (default one per CPU)")
+    parser.add_argument("--force", action="store_true", help="run the stages even if their inputs are unchanged")
+    parser.add_argument("--last-month", default=None, help="last month of the INR series (default the last full month)")
+    parser.add_argument("--list", action="store_true", help="list the stages and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print(describe().to_string())
+        sys.exit(0)
+    dbconn = args.dbconn.strip('"')
+    if not dbconn:
+        parser.error("no connection string: set DBCONN or pass --dbconn")
+    results = run(dbconn, stages=args.stages or None, workers=args.workers, force=args.force,
+                  snapshot=os.environ.get("DB_SNAPSHOT", None), incremental=os.environ.get("INCREMENTAL") == "1",
+                  lookback=int(os.environ.get("REFRESH_LOOKBACK", 2)), last_month=args.last_month)
+    print(results.round({"seconds": 3}).to_string())
+    sys.exit(1 if (results["status"] == "failed").any() else 0)
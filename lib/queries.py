@@ -0,0 +1,795 @@
+'''
+Registry of the SQL run by the Warfarin_DOAC_rpt notebook.
+
+Codelists are loaded once per session into keyed temp tables (`#anticoag_codes`, `#ctv3_codes`) which queries join to,
+and anything that varies between runs (dates, months) is a bound parameter sent via `sp_executesql`. This keeps the
+text of every statement constant so SQL Server can cache and reuse its plans.
+
+Templates are registered as `section/name`. Those with `into` build a temp table; the rest return a result set.
+'''
+
+
+class Template:
+    '''
+    A named SQL statement with typed parameters.
+
+    INPUTS:
+    name (str): registry key, "section/name"
+    sql (str): a single SELECT, referring to parameters as @name
+    into (str): temp table the results are stored in (optional)
+    params (dict): parameter names and their T-SQL types, e.g. {"start": "date"}
+    index (str): columns for a clustered index on the temp table, created once it is filled (optional)
+    '''
+
+    def __init__(self, name, sql, into=None, params=None, index=None):
+        self.name = name
+        self.sql = sql.strip()
+        self.into = into
+        self.params = params or {}
+        self.index = index
+
+    def __repr__(self):
+        return f"Template({self.name!r})"
+
+    def values(self, values):
+        '''Parameter values in declaration order, checking nothing is missing or unexpected'''
+        missing = set(self.params) - set(values)
+        extra = set(values) - set(self.params)
+        if missing or extra:
+            raise ValueError(f"{self.name}: missing parameters {sorted(missing)}, unexpected {sorted(extra)}")
+        return [values[p] for p in self.params]
+
+    def _declarations(self):
+        return ", ".join(f"@{p} {t}" for p, t in self.params.items())
+
+    def _executesql(self, sql):
+        '''Wrap a statement in sp_executesql, with one ? marker per parameter for pyodbc to bind'''
+        escaped = sql.replace("'", "''")
+        assignments = ", ".join(f"@{p} = ?" for p in self.params)
+        return f"EXEC sp_executesql N'{escaped}',\nN'{self._declarations()}',\n{assignments}"
+
+    def select_into(self):
+        '''Statement building the temp table directly (templates without parameters)'''
+        return f"SELECT * INTO {self.into} FROM (\n{self.sql}\n) q"
+
+    def shell(self):
+        '''
+        Statement creating an empty copy of the temp table. Temp tables created inside sp_executesql are dropped when
+        it returns, so parameterised templates build the table at session level first and then fill it.
+        '''
+        nulls = ", ".join(f"@{p} {t} = NULL" for p, t in self.params.items())
+        return f"DECLARE {nulls};\nSELECT * INTO {self.into} FROM (\n{self.sql}\n) q WHERE 1 = 0"
+
+    def fill(self):
+        '''Parameterised statement inserting the results into the temp table created by `shell()`'''
+        return self._executesql(f"INSERT INTO {self.into} WITH (TABLOCK)\n{self.sql}")
+
+    def create_index(self):
+        '''Statement creating the clustered index on the temp table, if there is one'''
+        if self.index is None:
+            return None
+        return f"CREATE CLUSTERED INDEX ix_{self.into[1:]} ON {self.into} ({self.index})"
+
+    def query(self):
+        '''Parameterised statement returning the results'''
+        if not self.params:
+            return self.sql
+        return self._executesql(self.sql)
+
+
+TEMPLATES = {}
+
+def month_key(column):
+    '''
+    SQL for the integer month key of a date column (months since year 0), as used by #calendar. Working tables carry
+    this as a column, so joins can compare and offset months without applying date functions to indexed columns.
+    '''
+    return f"YEAR({column})*12 + MONTH({column}) - 1"
+
+
+def register(name, sql, into=None, params=None, index=None):
+    '''Add a template to the registry'''
+    TEMPLATES[name] = Template(name, sql, into=into, params=params, index=index)
+    return TEMPLATES[name]
+
+
+def get_template(name):
+    '''Look up a template by name (templates are passed through unchanged)'''
+    if isinstance(name, Template):
+        return name
+    if name not in TEMPLATES:
+        raise KeyError(f"No SQL template named {name!r}")
+    return TEMPLATES[name]
+
+
+def _keyed_rows(groups, kind):
+    '''
+    (code, group) rows for a keyed codelist table. Several dm+d codes can map to one Multilex ID, so codes are
+    de-duplicated, but a code in more than one group can't be given just one, so is an error.
+    '''
+    rows = {}
+    overlaps = set()
+    for group, codes in groups.items():
+        for code in codes:
+            code = str(code)
+            if rows.setdefault(code, group) != group:
+                overlaps.add(code)
+    if overlaps:
+        raise ValueError(f"{kind} in more than one codelist: {sorted(overlaps)}")
+    return sorted(rows.items())
+
+
+def load_codelists(connection, drugs, ctv3=None):
+    '''
+    Load codelists into keyed temp tables for queries to join to. Each code must be in only one of the lists.
+
+    INPUTS:
+    connection (DbSession): session to create the tables on
+    drugs (dict): Multilex drug IDs for each anticoagulant class, e.g. {"warfarin": warf, "DOAC": doac}
+    ctv3 (dict): CTV3 codes for each group of coded events, e.g. {"inr": inr_codes, "high_inr": high_inr}
+
+    OUTPUTS:
+    None
+    '''
+    if ctv3 is None:
+        ctv3 = {}
+    drug_rows = _keyed_rows(drugs, "Multilex drug IDs")
+    ctv3_rows = _keyed_rows(ctv3, "CTV3 codes")
+
+    # collate to the database default so joins to the main tables don't hit tempdb collation conflicts
+    connection.execute(
+        '''CREATE TABLE #anticoag_codes (
+        MultilexDrug_ID VARCHAR(100) COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY,
+        anticoag VARCHAR(8) COLLATE DATABASE_DEFAULT NOT NULL)''',
+        '''CREATE TABLE #ctv3_codes (
+        CTV3Code VARCHAR(16) COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY,
+        code_group VARCHAR(16) COLLATE DATABASE_DEFAULT NOT NULL)''',
+        reuse=False)
+
+    connection.insert_rows("#anticoag_codes", ["MultilexDrug_ID", "anticoag"], drug_rows)
+    connection.mark_built("#anticoag_codes", drug_rows)
+    connection.insert_rows("#ctv3_codes", ["CTV3Code", "code_group"], ctv3_rows)
+    connection.mark_built("#ctv3_codes", ctv3_rows)
+
+
+##### Staging: every anticoagulant issue and repeat, extracted once ########
+
+# calendar month dimension: one row per month, keyed by month_key (see `month_key`)
+register("staging/calendar", into="#calendar", index="month_key", sql=f'''
+SELECT
+{month_key("m.month_start")} AS month_key,
+m.month_start,
+DATEADD(month, 1, m.month_start) AS month_end
+FROM (
+  SELECT DATEADD(month, ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1, CAST('20150101' AS date)) AS month_start
+  FROM sys.all_columns
+) m
+WHERE m.month_start < '20310101'
+''')
+
+# all warfarin and DOAC issues, with drug class and issue month
+register("staging/issues", into="#ac_issues", params={"start": "date"}, index="Patient_ID, anticoag, Startmonth_key",
+         sql=f'''
+SELECT DISTINCT
+i.Patient_ID,
+i.MultilexDrug_ID,
+c.anticoag,
+i.StartDate,
+i.EndDate,
+DATEFROMPARTS(YEAR(i.StartDate),MONTH(i.StartDate),1) AS Startmonth,
+{month_key("i.StartDate")} AS Startmonth_key
+FROM
+  MedicationIssue i
+  INNER JOIN #anticoag_codes c ON c.MultilexDrug_ID = i.MultilexDrug_ID
+WHERE
+  i.StartDate >= @start
+''')
+
+# all warfarin and DOAC repeats which were live in the period of interest, with drug class and start/end months
+register("staging/repeats", into="#ac_repeats", params={"end_from": "date", "start_from": "date"},
+         index="Patient_ID, anticoag, Startmonth_key", sql=f'''
+SELECT DISTINCT
+r.Patient_ID,
+c.anticoag,
+r.StartDate,
+r.EndDate,
+DATEFROMPARTS(YEAR(r.StartDate),MONTH(r.StartDate),1) AS Startmonth,
+DATEFROMPARTS(YEAR(r.EndDate),MONTH(r.EndDate),1) AS Endmonth,
+{month_key("r.StartDate")} AS Startmonth_key,
+{month_key("r.EndDate")} AS Endmonth_key
+FROM
+  MedicationRepeat r
+  INNER JOIN #anticoag_codes c ON c.MultilexDrug_ID = r.MultilexDrug_ID
+WHERE
+  r.EndDate >= @end_from OR r.StartDate >= @start_from
+''')
+
+
+##### Total patients with anticoagulants per month, and duplicate issues ########
+
+# Warfarin and DOAC patients
+register("issues/allpts", into="#allpts", params={"start": "date"}, sql='''
+SELECT
+Patient_ID,
+anticoag,
+StartDate,
+Startmonth,
+MAX(EndDate) AS EndDate
+FROM
+  #ac_issues
+WHERE
+  StartDate >= @start AND
+  StartDate < DATEFROMPARTS(YEAR(GETDATE()),MONTH(GETDATE()),1) -- select only issues occurring up to end of last full month
+GROUP BY
+Patient_ID,
+anticoag,
+StartDate,
+Startmonth
+''')
+
+## total patients with each anticoagulant issued each month
+register("issues/by_anticoag", '''
+SELECT Startmonth, anticoag, COUNT(DISTINCT Patient_ID) AS patient_count FROM #allpts
+GROUP BY Startmonth, anticoag
+''')
+
+## total patients with ANY anticoagulant issued each month
+register("issues/total", '''
+SELECT Startmonth, COUNT(DISTINCT Patient_ID) AS patient_count FROM #allpts
+GROUP BY Startmonth
+''')
+
+# total patients with doac and warfarin issued same day
+register("issues/same_day", '''
+SELECT d.Startmonth, COUNT(DISTINCT d.Patient_ID) AS Duplicate_issues,
+SUM(CASE WHEN w.StartDate = w.EndDate OR d.StartDate = d.EndDate THEN 1 ELSE 0 END) AS one_cancelled
+FROM #allpts d
+INNER JOIN (SELECT * FROM #allpts WHERE anticoag = 'warfarin') w
+  ON d.Patient_ID = w.Patient_ID and d.StartDate = w.StartDate
+WHERE d.anticoag = 'DOAC'
+GROUP BY d.Startmonth
+ORDER BY d.Startmonth
+''')
+
+
+##### Patients with DOAC and warfarin repeats ########
+
+# all patients with either a doac or warfarin issued, per month
+register("repeats/temp", into="#temp", params={"start": "date"}, index="Patient_ID, issuemonth_key", sql='''
+SELECT DISTINCT
+Patient_ID,
+Startmonth AS issuemonth,
+Startmonth_key AS issuemonth_key
+FROM
+  #ac_issues
+WHERE
+  StartDate >= @start AND
+  StartDate < DATEFROMPARTS(YEAR(GETDATE()),MONTH(GETDATE()),1) -- select only issues occurring up to end of last full month
+''')
+
+# Repeat prescriptions to temp table
+register("repeats/rpts2", into="#rpts2", params={"start": "date"}, index="Patient_ID, anticoag, Startmonth_key", sql='''
+SELECT DISTINCT
+Patient_ID,
+anticoag,
+StartDate,
+EndDate,
+Startmonth_key,
+Endmonth_key
+FROM
+  #ac_repeats
+WHERE
+  EndDate >= @start
+''')
+
+# join repeats to patients
+register("repeats/results", into="#results", sql='''
+SELECT
+a.Patient_ID,
+a.issueMonth,
+CASE WHEN d.StartDate IS NOT NULL THEN 1 ELSE 0 END AS doac_repeat,
+CASE WHEN w.StartDate IS NOT NULL THEN 1 ELSE 0 END AS warf_repeat,
+CASE WHEN d.EndDate >= '99990101' THEN 1 ELSE 0 END AS doac_open_ended,
+CASE WHEN w.EndDate >= '99990101' THEN 1 ELSE 0 END AS warf_open_ended,
+CASE WHEN d.EndDate >= '99990101' AND w.EndDate >= '99990101' THEN 1 ELSE 0 END AS both_open_ended,
+CASE WHEN w.StartDate = d.Startdate THEN 1 ELSE 0 END AS started_same_date,
+CASE WHEN w.StartDate = d.Startdate AND (w.StartDate = w.EndDate) THEN 1 ELSE 0 END AS started_same_date_warf_cancelled,
+CASE WHEN w.StartDate = d.Startdate AND (d.StartDate = d.EndDate) THEN 1 ELSE 0 END AS started_same_date_doac_cancelled,
+CASE WHEN d.Endmonth_key = a.issuemonth_key THEN 1 ELSE 0 END AS doac_ended_this_month,
+CASE WHEN w.Endmonth_key = a.issuemonth_key THEN 1 ELSE 0 END AS warf_ended_this_month
+FROM #temp a
+LEFT JOIN #rpts2 d ON a.Patient_ID = d.Patient_ID AND d.anticoag = 'DOAC'
+AND d.Startmonth_key <= a.issuemonth_key AND d.Endmonth_key >= a.issuemonth_key
+LEFT JOIN #rpts2 w ON a.Patient_ID = w.Patient_ID AND w.anticoag = 'warfarin'
+AND w.Startmonth_key <= a.issuemonth_key AND w.Endmonth_key >= a.issuemonth_key
+''')
+
+register("repeats/summary", '''
+SELECT
+issuemonth,
+COUNT(DISTINCT Patient_ID) AS total_patients,
+SUM(doac_repeat) AS doac_repeat,
+SUM(warf_repeat) AS warf_repeat,
+SUM(started_same_date) AS started_same_date,
+SUM(started_same_date_warf_cancelled) AS warfarin_cancelled,
+SUM(started_same_date_doac_cancelled) AS doac_cancelled
+FROM #results
+GROUP BY issuemonth
+ORDER BY issuemonth
+''')
+
+
+##### Patients starting a DOAC repeat per month, and of whom, how many switched from Warfarin ########
+
+# DOAC repeats initiated per month
+register("doac_repeats/doacR", into="#doacR", params={"start": "date"}, index="Patient_ID, doacStartmonth_key", sql='''
+SELECT
+Patient_ID,
+Startmonth AS doacStartmonth,
+Startmonth_key AS doacStartmonth_key,
+MAX(StartDate) AS latest_start
+FROM
+  #ac_repeats
+WHERE
+  anticoag = 'DOAC' AND
+  StartDate >= @start AND
+  StartDate < DATEFROMPARTS(YEAR(GETDATE()),MONTH(GETDATE()),1) -- select only repeats occurring up to end of last full month
+GROUP BY
+Patient_ID,
+Startmonth,
+Startmonth_key
+''')
+
+# Check which patients had previous Warfarin and DOAC repeats
+register("doac_repeats/warfdoac", into="#warfdoac", params={"start": "date"}, index="Patient_ID, anticoag, Endmonth_key",
+         sql='''
+SELECT DISTINCT
+Patient_ID,
+anticoag,
+Endmonth,
+Endmonth_key,
+MIN(StartDate) AS earliest_start
+FROM
+  #ac_repeats
+WHERE
+  EndDate >= @start AND
+  StartDate < DATEFROMPARTS(YEAR(GETDATE()),MONTH(GETDATE()),1) -- select only repeats occurring up to end of last full month
+GROUP BY
+Patient_ID,
+anticoag,
+Endmonth,
+Endmonth_key
+''')
+
+# join DOAC repeats to previous warfarin and DOAC repeats
+register("doac_repeats/out", into="#out", sql='''
+SELECT d.Patient_ID,
+doacStartmonth,
+MAX(CASE WHEN w.Endmonth IS NOT NULL THEN 1 ELSE 0 END) AS switch_flag, -- indicates patient was on warfarin
+MIN(CASE WHEN d2.Endmonth IS NULL THEN 1 ELSE 0 END) AS new_flag -- indicates patient was not previously on doac
+FROM #doacR d
+LEFT JOIN #warfdoac d2
+    ON d.Patient_ID = d2.Patient_ID AND d2.anticoag = 'DOAC'
+    AND d2.Endmonth_key BETWEEN d.doacStartmonth_key - 3 AND d.doacStartmonth_key --- only count as a new repeat where no previous repeat ended within 3mo
+    AND d.latest_start != d2.earliest_start  --- if one repeat ends in same month, don't count it as a previous repeat
+LEFT JOIN #warfdoac w
+    ON d.Patient_ID = w.Patient_ID AND w.anticoag = 'warfarin'
+    AND w.Endmonth_key BETWEEN d.doacStartmonth_key - 3 AND d.doacStartmonth_key  --- only count as a switch where doac repeat started within 3mo of warf repeat end
+GROUP BY d.Patient_ID, doacStartmonth
+''')
+
+register("doac_repeats/summary", '''
+SELECT
+doacStartmonth, switch_flag, new_flag, COUNT(DISTINCT Patient_ID) AS patient_count
+FROM #out
+GROUP BY doacStartmonth, switch_flag, new_flag
+''')
+
+
+##### Patients on Warfarin during baseline and how many switched to DOAC ########
+
+# baseline and follow-up periods for the current year ("2020") and the comparison year ("2019")
+PERIODS = {"b_start_2020": "date", "b_end_2020": "date", "f_end_2020": "date",
+           "b_start_2019": "date", "b_end_2019": "date", "f_end_2019": "date"}
+
+# Warfarin and DOAC patients in baseline period
+register("switching/baseline", into="#baseline", params=PERIODS, sql='''
+SELECT
+i.Patient_ID,
+CASE WHEN i.StartDate >= @b_start_2020 AND i.StartDate < @b_end_2020 THEN '2020' ELSE '2019' END AS year,
+i.anticoag,
+MAX(i.StartDate) AS LatestIssue
+FROM
+  #ac_issues i
+WHERE
+  ((i.StartDate >= @b_start_2019 AND i.StartDate < @b_end_2019) OR (i.StartDate >= @b_start_2020 AND i.StartDate < @b_end_2020))
+GROUP BY i.Patient_ID, CASE WHEN i.StartDate >= @b_start_2020 AND i.StartDate < @b_end_2020 THEN '2020' ELSE '2019' END,
+  i.anticoag
+''')
+
+# DOAC patients in follow up period - detailed
+register("switching/doac_fu", into="#doac_fu", params=PERIODS, sql='''
+SELECT DISTINCT
+i.Patient_ID,
+CASE WHEN i.StartDate BETWEEN @b_end_2020 AND @f_end_2020 THEN '2020' ELSE '2019' END AS year,
+i.MultilexDrug_ID,
+i.StartDate
+FROM
+  #ac_issues i
+WHERE
+  i.anticoag = 'DOAC' AND
+  (i.StartDate BETWEEN @b_end_2019 AND @f_end_2019 OR i.StartDate BETWEEN @b_end_2020 AND @f_end_2020)
+''')
+
+# DOAC patients in follow up period - summarised
+register("switching/doac", into="#doac", sql='''
+SELECT
+Patient_ID,
+year,
+MIN(StartDate) AS doacStart
+FROM
+  #doac_fu
+GROUP BY Patient_ID, year
+''')
+
+# DOAC patients - which types of DOACs are used
+register("switching/doac_type_a", into="#doac_type_a", sql='''
+SELECT
+Patient_ID,
+year,
+MultilexDrug_ID, -- there may be multiple per person so remove duplicates in next step using row_number
+-- (ties on the same day go to the lowest drug ID, so the first type is deterministic)
+ROW_NUMBER() OVER (PARTITION BY Patient_ID, year ORDER BY StartDate ASC, MultilexDrug_ID ASC) AS doacStartRank
+FROM
+  #doac_fu
+''')
+
+register("switching/doac_type_b", into="#doac_type_b", sql='''
+SELECT -- fetch only the first DOAC prescribed per person to avoid creating duplicate rows
+Patient_ID,
+year,
+MultilexDrug_ID
+FROM
+  #doac_type_a
+WHERE
+  doacStartRank = 1
+''')
+
+# Warf patients in follow up period - to check who was still receiving warfarin
+register("switching/warf2", into="#warf2", params=PERIODS, sql='''
+SELECT
+i.Patient_ID,
+CASE WHEN i.StartDate BETWEEN @b_end_2020 AND @f_end_2020 THEN '2020' ELSE '2019' END AS year,
+MAX(i.StartDate) AS WarfLatestIssue
+FROM
+  #ac_issues i
+WHERE
+  i.anticoag = 'warfarin' AND
+  (i.StartDate BETWEEN @b_end_2019 AND @f_end_2019 OR i.StartDate BETWEEN @b_end_2020 AND @f_end_2020)
+GROUP BY i.Patient_ID, CASE WHEN i.StartDate BETWEEN @b_end_2020 AND @f_end_2020 THEN '2020' ELSE '2019' END
+''')
+
+# INR tests, high INR values & TTRs (to count which patients had one in 3 month period)
+register("switching/inr", into="#inr", params=PERIODS, sql='''
+select
+Patient_ID,
+CASE WHEN ConsultationDate BETWEEN @b_end_2020 AND @f_end_2020 THEN '2020' ELSE '2019' END AS year,
+CASE WHEN CTV3Code = '42QE.' THEN 'INR' ELSE 'TTR' END AS test,
+MAX(CASE WHEN CTV3Code = '42QE.' AND NumericValue>=8 THEN 1 ELSE 0 END) AS high_inr_value
+FROM CodedEvent e
+WHERE e.CTV3Code IN ('42QE.', 'Xaa68')
+AND (ConsultationDate BETWEEN @b_end_2019 AND @f_end_2019 OR ConsultationDate BETWEEN @b_end_2020 AND @f_end_2020)
+GROUP BY Patient_ID,
+CASE WHEN ConsultationDate BETWEEN @b_end_2020 AND @f_end_2020 THEN '2020' ELSE '2019' END,
+CASE WHEN CTV3Code = '42QE.' THEN 'INR' ELSE 'TTR' END
+''')
+
+# join warfarin and doac patients
+register("switching/out", into="#out", sql='''
+SELECT w.Patient_ID, w.year,
+w.LatestIssue AS WarfLatestIssue,
+CASE WHEN w2.Patient_ID IS NOT NULL AND doacStart IS NULL THEN 1 ELSE 0 END AS continued_warfarin_flag,
+CASE WHEN d.doacStart IS NOT NULL THEN 1 ELSE 0 END AS switch_flag,
+CASE WHEN w2.WarfLatestIssue > doacStart THEN 1 ELSE 0 END AS switch_back_flag,
+DATEFROMPARTS(YEAR(d.doacStart),MONTH(d.doacStart),1) AS doacStartmonth,
+CASE WHEN i.Patient_ID IS NOT NULL THEN 1 ELSE 0 END AS inr_flag,
+CASE WHEN ttr.Patient_ID IS NOT NULL THEN 1 ELSE 0 END AS ttr_flag,
+CASE WHEN w2.Patient_ID IS NOT NULL AND doacStart IS NULL AND i.Patient_ID IS NOT NULL THEN 1 ELSE 0 END AS continued_warfarin_had_inr,
+CASE WHEN w2.Patient_ID IS NOT NULL AND doacStart IS NULL AND i.high_inr_value>0 THEN 1 ELSE 0 END AS continued_warfarin_had_high_inr,
+CASE WHEN w2.Patient_ID IS NOT NULL AND doacStart IS NULL AND ttr.Patient_ID IS NOT NULL THEN 1 ELSE 0 END AS continued_warfarin_had_ttr,
+t.MultilexDrug_ID AS first_doac_type
+FROM #baseline w
+LEFT JOIN #baseline dp ON dp.Patient_ID = w.Patient_ID AND dp.year = w.year AND dp.anticoag = 'DOAC' -- doac in baseline period (exclude these patients)
+LEFT JOIN #doac d ON d.Patient_ID = w.Patient_ID AND d.year = w.year -- doac in follow up period
+LEFT JOIN #warf2 w2 ON w.Patient_ID = w2.Patient_ID AND w.year = w2.year -- warfarin in follow up period
+LEFT JOIN #doac_type_b t ON w.Patient_ID = t.Patient_ID AND w.year = t.year-- doac type
+LEFT JOIN #inr i ON w.Patient_ID = i.Patient_ID AND i.test='INR'  AND w.year = i.year   -- INR tests
+LEFT JOIN #inr ttr ON w.Patient_ID = ttr.Patient_ID AND ttr.test='TTR'  AND w.year = ttr.year   -- INR TTRs recorded
+WHERE w.anticoag = 'warfarin' AND
+  dp.Patient_ID IS NULL -- exclude pts who have already had doacs in baseline period
+''')
+
+# output summary data for switching and testing
+register("switching/summary", '''
+SELECT
+year,
+COUNT(DISTINCT Patient_ID) AS baseline_warfarin_patients,
+SUM(continued_warfarin_flag) AS continued_warfarin_flag,
+SUM(switch_flag) AS switch_flag,
+SUM(switch_back_flag) AS switch_back_flag,
+SUM(inr_flag) AS inr_count,
+SUM(ttr_flag) AS ttr_count,
+SUM(continued_warfarin_had_inr) AS continued_warfarin_had_inr,
+SUM(continued_warfarin_had_high_inr) AS continued_warfarin_had_high_inr,
+SUM(continued_warfarin_had_ttr) AS continued_warfarin_had_ttr
+FROM #out
+GROUP BY year
+''')
+
+# output summary of doac types
+register("switching/doac_types", '''
+SELECT
+first_doac_type,
+year,
+COUNT(DISTINCT Patient_ID) AS patient_count
+FROM #out
+WHERE switch_flag = 1
+GROUP BY first_doac_type, year
+''')
+
+
+##### High INRs - code checks ########
+
+register("inr_codes/check", params={"start": "date"}, sql='''
+select
+DATEFROMPARTS(YEAR(e.ConsultationDate), MONTH(e.ConsultationDate),1) AS month,
+c.code_group AS codedevent,
+CASE WHEN c.code_group = 'inr' AND e.NumericValue > 100 THEN 'over 100'
+  WHEN c.code_group = 'inr' AND e.NumericValue > 8 THEN 'over 8'
+  WHEN c.code_group = 'inr' AND e.NumericValue = 8 THEN '8 exactly'
+  WHEN c.code_group = 'inr' AND e.NumericValue IN (0,-1) THEN 'no value'
+  WHEN c.code_group = 'inr' AND e.NumericValue < 8 THEN 'under 8'
+  WHEN c.code_group = 'inr' AND e.NumericValue IS NULL THEN 'no value'
+  ELSE 'high-INR' END AS classification,
+COUNT (DISTINCT e.Patient_ID) AS pt_count,
+COUNT(*) as count
+FROM CodedEvent e
+INNER JOIN #ctv3_codes c ON c.CTV3Code = e.CTV3Code AND c.code_group IN ('inr', 'high_inr')
+WHERE e.ConsultationDate >= @start
+GROUP BY
+DATEFROMPARTS(YEAR(e.ConsultationDate), MONTH(e.ConsultationDate),1),
+c.code_group,
+CASE WHEN c.code_group = 'inr' AND e.NumericValue > 100 THEN 'over 100'
+  WHEN c.code_group = 'inr' AND e.NumericValue > 8 THEN 'over 8'
+  WHEN c.code_group = 'inr' AND e.NumericValue = 8 THEN '8 exactly'
+  WHEN c.code_group = 'inr' AND e.NumericValue IN (0,-1) THEN 'no value'
+  WHEN c.code_group = 'inr' AND e.NumericValue < 8 THEN 'under 8'
+  WHEN c.code_group = 'inr' AND e.NumericValue IS NULL THEN 'no value'
+  ELSE 'high-INR' END
+''')
+
+
+##### INR testing ########
+
+# INR tests
+register("inr_testing/inr_all", into="#inr_all", params={"start": "date"}, index="month_key, Patient_ID", sql=f'''
+select
+e.Patient_ID,
+e.ConsultationDate,
+{month_key("e.ConsultationDate")} AS month_key,
+MAX(e.NumericValue) AS highest_value,
+COUNT(*) AS test_count
+FROM CodedEvent e
+INNER JOIN #ctv3_codes c ON c.CTV3Code = e.CTV3Code AND c.code_group = 'inr'
+WHERE e.ConsultationDate >= @start
+GROUP BY e.Patient_ID, e.ConsultationDate
+''')
+
+# months to report on, from the calendar. When considering who is a warfarin patient we look over the last 3 months
+# as well, to account for the gap between a prescription and blood test
+register("inr_testing/months", into="#inr_months", params={"first_month": "date", "months": "int"}, sql='''
+SELECT month_key, month_start, month_end
+FROM #calendar
+WHERE month_start >= @first_month AND month_start < DATEADD(month, @months, @first_month)
+''')
+
+# latest warfarin and DOAC issue for every patient in each month's lookback (range join of issues to the months)
+register("inr_testing/warf", into="#inr_warf", index="month_start, Patient_ID", sql='''
+SELECT
+m.month_start,
+i.Patient_ID,
+MAX(CASE WHEN i.anticoag = 'warfarin' THEN i.StartDate END) AS WarfLatestIssue,
+MAX(CASE WHEN i.anticoag = 'DOAC' THEN i.StartDate END) AS doacLatestIssue
+FROM #inr_months m
+INNER JOIN #ac_issues i ON i.Startmonth_key BETWEEN m.month_key - 3 AND m.month_key
+GROUP BY m.month_start, i.Patient_ID
+''')
+
+# INR tests for every patient in each month
+register("inr_testing/inr", into="#inr_tests", index="month_start, Patient_ID", sql='''
+select
+m.month_start,
+t.Patient_ID,
+MAX(CASE WHEN t.highest_value >8 THEN 1 ELSE 0 END) AS high_inr_over_8,
+MAX(CASE WHEN t.highest_value =8 THEN 1 ELSE 0 END) AS high_inr_8,
+SUM(t.test_count) AS test_count
+FROM #inr_months m
+INNER JOIN #inr_all t ON t.month_key = m.month_key
+GROUP BY m.month_start, t.Patient_ID
+''')
+
+# join tests and high INRs to patients on warfarin, for every month at once
+register("inr_testing/summary", '''
+SELECT
+CONVERT(VARCHAR(10), m.month_start, 23) AS INR_month,
+SUM(inr.test_count) AS test_count,
+COUNT(DISTINCT inr.Patient_ID) AS patient_count,
+COUNT(DISTINCT CASE WHEN inr.high_inr_over_8 = 1 THEN inr.Patient_ID END) AS patient_count_over_8,
+COUNT(DISTINCT CASE WHEN inr.high_inr_8 = 1 THEN inr.Patient_ID END) AS patient_count_equal_8,
+COUNT(DISTINCT w.Patient_ID) AS denominator
+FROM #inr_months m
+LEFT JOIN #inr_warf w ON w.month_start = m.month_start
+  AND w.WarfLatestIssue IS NOT NULL
+  AND (w.doacLatestIssue IS NULL OR w.doacLatestIssue <= w.WarfLatestIssue) -- exclude pts from denominator if they had doac more recently than warfarin
+LEFT JOIN #inr_tests AS inr ON inr.month_start = w.month_start AND inr.Patient_ID = w.Patient_ID  -- iNR tests
+GROUP BY m.month_start
+ORDER BY m.month_start
+''')
+
+
+##### Time in therapeutic range ########
+
+# check for presence of each possible INR and TTR code
+register("ttr/code_check", '''
+select ctv3code, count(*) from CodedEvent
+where ctv3code IN ('42QE.','YavzQ', '42QE2', 'Xaa68', '.42QE','Y7FIy',
+'XaZqW', '66Q80', -- above range
+'XaPfs', '9k25.', -- below range
+'XaPBw', '9k22.') -- within range
+AND YEAR(ConsultationDate) = 2020
+GROUP BY ctv3code
+''')
+
+# recorded TTR values for INR tests
+register("ttr/ttr", into="#ttr", params={"start": "date", "end": "date"}, index="Patient_ID, month_key", sql=f'''
+SELECT  -- coded events for INR TTR
+Patient_ID, NumericValue,
+DATEFROMPARTS(YEAR(ConsultationDate), MONTH(ConsultationDate),1) AS month,
+{month_key("ConsultationDate")} AS month_key
+FROM CodedEvent
+WHERE CTV3Code = 'Xaa68' -- INR Time in therapeutic range
+AND ConsultationDate BETWEEN @start AND @end
+''')
+
+# Warfarin patients and all issue dates
+register("ttr/warfissue", into="#warfissue", params={"start": "date", "end": "date"}, index="Patient_ID, month_key",
+         sql='''
+SELECT
+Patient_ID,
+Startmonth AS month,
+Startmonth_key AS month_key
+FROM
+  #ac_issues
+WHERE
+  anticoag = 'warfarin' AND
+  StartDate BETWEEN @start AND @end
+GROUP BY Patient_ID, Startmonth, Startmonth_key
+''')
+
+# join tests to patients on warfarin
+register("ttr/warftests", into="#warftests", index="Patient_ID, month_key", sql='''
+SELECT DISTINCT -- use distinct here to resolve duplicates introduced in join
+t.month AS month,
+t.month_key,
+t.Patient_ID,
+t.NumericValue
+FROM #ttr AS t
+INNER JOIN #warfissue w ON t.Patient_ID = w.Patient_ID
+  AND w.month_key >= t.month_key - 3 -- test within 3 months of a warfarin issue
+''')
+
+# join tests to tests occurring in the following month
+register("ttr/out", into="#out", sql='''
+SELECT
+t.month AS month,
+t.Patient_ID,
+t.NumericValue,
+PERCENT_RANK() OVER (PARTITION BY t.month ORDER BY t.NumericValue) AS current_rank,
+CASE WHEN p.Patient_ID IS NULL THEN 0 ELSE 1 END AS tested_next_month
+FROM #warftests AS t
+LEFT JOIN (SELECT Patient_ID, month_key, AVG(NumericValue) AS mean_value FROM #warftests GROUP BY Patient_ID, month_key) p
+  ON t.Patient_ID = p.Patient_ID
+  AND p.month_key = t.month_key + 1 -- test following month
+''')
+
+register("ttr/split", '''
+SELECT
+month,
+tested_next_month,
+AVG(current_rank) AS rank,
+AVG(NumericValue) AS mean_value,
+STDEV(NumericValue) AS stdev,
+COUNT(*) AS test_count,
+COUNT(DISTINCT Patient_ID) AS patient_count
+FROM #out
+GROUP BY month, tested_next_month
+''')
+
+register("ttr/overall", '''
+SELECT
+month,
+AVG(NumericValue) AS mean_value,
+STDEV(NumericValue) AS stdev,
+COUNT(*) AS test_count,
+COUNT(DISTINCT Patient_ID) AS patient_count
+FROM #out
+GROUP BY month
+''')
+
+register("ttr/binned", '''
+SELECT
+month,
+tested_next_month,
+CASE WHEN NumericValue < 50 THEN '0-<50'
+  WHEN NumericValue < 60 THEN '50-<60'
+  WHEN NumericValue < 70 THEN '60-<70'
+  WHEN NumericValue < 80 THEN '70-<80'
+  WHEN NumericValue < 90 THEN '80-<90'
+  ELSE '90-100' END AS value,
+COUNT(*) AS test_count,
+COUNT(DISTINCT Patient_ID) AS patient_count
+FROM #out
+GROUP BY month,tested_next_month,
+CASE WHEN NumericValue < 50 THEN '0-<50'
+  WHEN NumericValue < 60 THEN '50-<60'
+  WHEN NumericValue < 70 THEN '60-<70'
+  WHEN NumericValue < 80 THEN '70-<80'
+  WHEN NumericValue < 90 THEN '80-<90'
+  ELSE '90-100' END
+''')
+
+
+##### Value distributions, for the quantile sketches in sketches.py ########
+
+# TTR values (with how often each occurs) for each month, split by whether the patient was tested again the next
+# month (from ttr/out)
+register("sketches/ttr", '''
+SELECT month, tested_next_month, NumericValue, COUNT(*) AS n
+FROM #out
+GROUP BY month, tested_next_month, NumericValue
+''')
+
+# INR values (with how often each occurs) for each month
+register("sketches/inr", params={"start": "date"}, sql='''
+SELECT
+DATEFROMPARTS(YEAR(e.ConsultationDate), MONTH(e.ConsultationDate),1) AS month,
+e.NumericValue,
+COUNT(*) AS n
+FROM CodedEvent e
+INNER JOIN #ctv3_codes c ON c.CTV3Code = e.CTV3Code AND c.code_group = 'inr'
+WHERE e.ConsultationDate >= @start AND e.NumericValue IS NOT NULL
+GROUP BY DATEFROMPARTS(YEAR(e.ConsultationDate), MONTH(e.ConsultationDate),1), e.NumericValue
+''')
+
+##### Patient timelines, for the in-memory engines in timelines.py ########
+
+# anticoagulant issues
+register("timelines/issues", params={"start": "date"}, sql='''
+SELECT Patient_ID, MultilexDrug_ID, anticoag, StartDate
+FROM #ac_issues
+WHERE StartDate >= @start
+''')
+
+# anticoagulant repeats
+register("timelines/repeats", sql='''
+SELECT Patient_ID, anticoag, StartDate, EndDate
+FROM #ac_repeats
+''')
+
+# INR tests and TTRs
+register("timelines/events", params={"start": "date"}, sql='''
+SELECT e.Patient_ID, e.CTV3Code, e.ConsultationDate, e.NumericValue
+FROM CodedEvent e
+WHERE e.CTV3Code IN ('42QE.', 'Xaa68')
+AND e.ConsultationDate >= @start
+''')
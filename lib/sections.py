@@ -0,0 +1,409 @@
+'''
+The sections of the main notebook which produce its outputs, as functions of a session, so that the notebook and the
+stages of `pipeline.py` run the same code:
+
+    issues, repeats, doac_repeats, inr_testing      monthly series (merged with the months already final)
+    switching -> summarise_switching, doac_types    doac_switchers.csv, doac_types.csv
+    costings                                        annual cost of the switches (as in the DOAC costings notebook)
+
+Each builds its section's temp tables from the staged prescriptions (see `staging.py`) and returns its results;
+writing them (e.g. `series.to_csv`), displaying them and drawing charts is left to the caller. On the dummy database
+(`dummy=True`), where the real tables don't contain linkable patients, dummy rows are inserted into the working tables
+as the notebook always did.
+'''
+import numpy as np
+import pandas as pd
+
+from queries import PERIODS
+from incremental import add_months, months_between
+from parallel import read_concurrently
+from dummy import generate_dummy_data, insert_dummy_data, month_keys
+
+
+# first month of the monthly series
+FIRST_MONTH = '2019-01-01'
+
+# counts blanked out of the INR series (zero counts too)
+INR_SUPPRESS = (0, 1, 2, 3, 4, 5)
+
+# switching comparison periods: baseline start and end, and follow-up end, in 2020 then 2019
+SWITCHING_PERIODS = {
+    ## baseline Dec-Feb, follow-up March-May
+    "March-May": ['20191201', '20200301', '20200531', '20181201', '20190301', '20190531'],
+    ## baseline March-May, follow-up June-Aug
+    "June-Aug": ['20200301', '20200601', '20200831', '20190301', '20190601', '20190831'],
+}
+
+# DOAC prices, for the annual cost per patient
+DOAC_PRICES = pd.DataFrame({"chemical": ["Edoxaban", "Apixaban", "Rivaroxaban", "Dabigatran etexilate"],
+                            "cost_per_pack": [49, 53.2, 50.4, 51],
+                            "pack_size": [28, 56, 28, 60],
+                            "daily_doses": [1, 2, 1, 2]})
+# adjustment from list price to actual cost (7.11% average reduction)
+ACTUAL_COST = 0.9289
+
+
+def _reads(connection, reads, concurrent):
+    '''Run independent reads at the same time on pooled connections, or one after another on this session'''
+    if concurrent:
+        return read_concurrently(connection, reads)
+    return [connection.read(r) for r in reads]
+
+
+##### monthly series ########
+
+def issues(connection, series, dummy=False, concurrent=True):
+    '''
+    Patients with each anticoagulant issued each month, and patients with warfarin and a DOAC issued on the same day.
+
+    INPUTS:
+    connection (DbSession): session with the staged prescriptions
+    series (MonthlySeries): series to merge the months computed into
+    dummy (bool): insert linkable dummy data (on the dummy database)
+    concurrent (bool): run the independent reads at the same time, on pooled connections
+
+    OUTPUTS:
+    out (df): warf_doac_issues series
+    same_day (df): same_day_issues series, with low values suppressed
+    '''
+    start = series.start("warf_doac_issues", "same_day_issues")
+    # Warfarin and DOAC patients
+    connection.run("issues/allpts", start=start)
+
+    if dummy:
+        date_fields = ["StartDate", "EndDate"]
+        choices = {"anticoag": ["warfarin", "DOAC"]}
+        dummy_data = generate_dummy_data(date_fields, month_field="StartDate", multiple_choice=choices)
+        # small fixes to dummy data:
+        dummy_data = dummy_data.rename(columns={"StartDate_month": "Startmonth"})
+        dummy_data["EndDate"] = np.where(dummy_data["EndDate"] < dummy_data["StartDate"], dummy_data["StartDate"],
+                                         dummy_data["EndDate"])
+        insert_dummy_data(connection, dummy_data, "#allpts")
+
+    ## total patients with each anticoagulant issued each month,
+    ## total patients with ANY anticoagulant issued each month,
+    ## and total patients with doac and warfarin issued same day
+    df1, df2, df3 = _reads(connection, ["issues/by_anticoag", "issues/total", "issues/same_day"], concurrent)
+
+    out = df1.set_index(["Startmonth", "anticoag"]).unstack().droplevel(0, axis=1)
+    out = out.rename(columns={"doac": "doac_patients", "warf": "warf_patients"})
+    out = out.join(df2.set_index("Startmonth")).rename(columns={"patient_count": "total_anticoag_patients"})
+    out = series.merge("warf_doac_issues", out)
+
+    # patients having both warfarin and DOAC prescriptions issued on the same day
+    out3 = df3.set_index("Startmonth")
+    out3.index = pd.to_datetime(out3.index)
+    same_day = out.join(out3)[["Duplicate_issues", "one_cancelled"]].replace([1, 2, 3, 4, 5], 3)
+    same_day = same_day.rename(columns={"Duplicate_issues": "Issued same day", "one_cancelled": "one ended same day"})
+    same_day = series.merge("same_day_issues", same_day)
+    return out, same_day
+
+
+def repeats(connection, series, dummy=False):
+    '''
+    Of patients who had either anticoagulant issued each month, who had repeats, and whether they were started
+    together.
+
+    INPUTS:
+    connection (DbSession): session with the staged prescriptions
+    series (MonthlySeries): series to merge the months computed into
+    dummy (bool): insert linkable dummy data (on the dummy database)
+
+    OUTPUTS:
+    out (df): warf_doac_repeats series
+    same_day (df): same_day_repeats series, with low values suppressed
+    '''
+    start = series.start("warf_doac_repeats", "same_day_repeats")
+    # all patients with either a doac or warfarin issued, per month
+    connection.run("repeats/temp", start=start)
+    # Repeat prescriptions to temp table
+    connection.run("repeats/rpts2", start=start)
+
+    if dummy:
+        date_fields = ["issue"]
+        dummy_data = generate_dummy_data(date_fields, month_field="issue")
+        # small fixes to dummy data:
+        dummy_data = dummy_data.rename(columns={"issue_month": "issuemonth"}).drop("issue", axis=1)
+        dummy_data["issuemonth_key"] = month_keys(dummy_data["issuemonth"])
+        insert_dummy_data(connection, dummy_data, "#temp")
+
+        date_fields = ["StartDate", "EndDate"]
+        choices = {"anticoag": ["warfarin", "DOAC"]}
+        dummy_data = generate_dummy_data(date_fields, multiple_choice=choices)
+        # small fixes to dummy data:
+        dummy_data["EndDate"] = np.where(dummy_data["EndDate"] < dummy_data["StartDate"], dummy_data["StartDate"],
+                                         dummy_data["EndDate"])
+        dummy_data["Startmonth_key"] = month_keys(dummy_data["StartDate"])
+        dummy_data["Endmonth_key"] = month_keys(dummy_data["EndDate"])
+        insert_dummy_data(connection, dummy_data, "#rpts2")
+
+    # join repeats to patients
+    connection.run("repeats/results")
+    out = connection.read("repeats/summary")
+    out["issuemonth"] = pd.to_datetime(out["issuemonth"])
+    out = out.set_index("issuemonth")
+
+    # repeats started on the same day
+    same_day = out[["started_same_date", "warfarin_cancelled", "doac_cancelled"]].replace([1, 2, 3, 4, 5], 3)
+    same_day = same_day.rename(columns={"started_same_date": "Repeats started same day",
+                                        "warfarin_cancelled": "Warfarin ended same day",
+                                        "doac_cancelled": "DOAC ended same day"})
+    out = series.merge("warf_doac_repeats", out)
+    same_day = series.merge("same_day_repeats", same_day)
+    return out, same_day
+
+
+def doac_repeats(connection, series, dummy=False):
+    '''
+    Patients starting a DOAC repeat each month, and of whom, how many were previously taking warfarin.
+
+    INPUTS:
+    connection (DbSession): session with the staged prescriptions
+    series (MonthlySeries): series to merge the months computed into
+    dummy (bool): insert linkable dummy data (on the dummy database)
+
+    OUTPUTS:
+    out (df): doac_repeats series
+    '''
+    start = series.start("doac_repeats")
+    # DOAC repeats initiated per month
+    connection.run("doac_repeats/doacR", start=start)
+    # Check which patients had previous Warfarin and DOAC repeats
+    connection.run("doac_repeats/warfdoac", start=add_months(start, -7))
+
+    if dummy:
+        date_fields = ["latest_start"]
+        dummy_data = generate_dummy_data(date_fields, month_field="latest_start")
+        # small fixes to dummy data:
+        dummy_data = dummy_data.rename(columns={"latest_start_month": "doacStartmonth"})
+        dummy_data["doacStartmonth_key"] = month_keys(dummy_data["doacStartmonth"])
+        insert_dummy_data(connection, dummy_data, "#doacR")
+
+        date_fields = ["earliest_start", "EndDate"]
+        choices = {"anticoag": ["warfarin", "DOAC"]}
+        dummy_data = generate_dummy_data(date_fields, month_field="EndDate", multiple_choice=choices)
+        # small fixes to dummy data:
+        dummy_data = dummy_data.rename(columns={"EndDate_month": "Endmonth"})
+        dummy_data["Endmonth_key"] = month_keys(dummy_data["Endmonth"])
+        dummy_data["earliest_start"] = np.where(dummy_data["EndDate"] < dummy_data["earliest_start"],
+                                                dummy_data["EndDate"], dummy_data["earliest_start"])
+        dummy_data = dummy_data.drop("EndDate", axis=1)
+        insert_dummy_data(connection, dummy_data, "#warfdoac")
+
+    # join DOAC repeats to previous warfarin and DOAC repeats
+    connection.run("doac_repeats/out")
+    df = connection.read("doac_repeats/summary")
+
+    out = df.loc[df["new_flag"] == 1]
+    out = out.groupby(["doacStartmonth", "switch_flag"])[["patient_count"]].sum().unstack().droplevel(0, axis=1)
+    out = out.rename(columns={0: "not previously taking warfarin", 1: "previously taking warfarin"})
+    out["total"] = out.sum(axis=1)
+    return series.merge("doac_repeats", out)
+
+
+def inr_testing(connection, series, dummy=False, last_month=None):
+    '''
+    INR tests and high INRs each month, for patients on warfarin (and not a DOAC) in the previous 3 months.
+
+    INPUTS:
+    connection (DbSession): session with the staged prescriptions
+    series (MonthlySeries): series to merge the months computed into
+    dummy (bool): insert linkable dummy data (on the dummy database)
+    last_month (str): last month to report (by default the last full month)
+
+    OUTPUTS:
+    tests (df): inr_testing series (months in the INR_month column)
+    high (df): high_inr series (months in the high_INR_month column)
+    '''
+    # months not yet final, of those reported
+    start = series.start("inr_testing", "high_inr")
+    if last_month is None:
+        last_month = add_months(pd.Timestamp.today(), -1)
+    months = max(0, months_between(start, last_month) + 1)
+
+    # INR tests
+    connection.run("inr_testing/inr_all", start=start)
+    # months to report, from the shared calendar
+    connection.run("inr_testing/months", first_month=start, months=months)
+    # warfarin patients (and their latest DOAC issue) in each month's lookback, and INR tests in each month.
+    # All months are computed together in one pass over the staged issues and INR tests
+    connection.run("inr_testing/warf")
+    connection.run("inr_testing/inr")
+    if dummy:
+        connection.execute('''INSERT INTO #inr_warf (month_start, Patient_ID, WarfLatestIssue, doacLatestIssue)
+        VALUES ('20200201', '1486439', '20200201', '20200301')''')
+        connection.execute('''INSERT INTO #inr_tests (month_start, Patient_ID)
+        VALUES ('20200201', '1486439')''')
+    # join tests, and high INRs, to patients on warfarin
+    df = connection.read("inr_testing/summary")
+
+    tests = df[["INR_month", "test_count", "patient_count", "denominator"]]
+    high = df.rename(columns={"INR_month": "high_INR_month"})[
+        ["high_INR_month", "patient_count_over_8", "patient_count_equal_8", "denominator"]]
+    tests = series.merge("inr_testing", tests, month="INR_month")
+    high = series.merge("high_inr", high, month="high_INR_month")
+    return tests, high
+
+
+##### switching ########
+
+def switching(connection, dates, dummy_doacs=None):
+    '''
+    Patients on warfarin during a baseline period, and how many switched to a DOAC during follow-up, in 2020 and
+    2019.
+
+    INPUTS:
+    connection (DbSession): session with the staged prescriptions
+    dates (list): baseline start and end, and follow-up end, in 2020 then 2019 (see SWITCHING_PERIODS)
+    dummy_doacs (list): DOAC Multilex IDs to insert linkable dummy data with (on the dummy database)
+
+    OUTPUTS:
+    summary (df): summary figures for switching and testing, without percentages
+    types (df): patients switched to each DOAC (first DOAC prescribed per person)
+    '''
+    periods = dict(zip(PERIODS, dates))
+
+    # Warfarin and DOAC patients in baseline period
+    connection.run("switching/baseline", **periods)
+    # DOAC patients in follow up period - detailed, then summarised
+    connection.run("switching/doac_fu", **periods)
+    connection.run("switching/doac")
+    # DOAC patients - which types of DOACs are used (first DOAC prescribed per person)
+    connection.run("switching/doac_type_a")
+    connection.run("switching/doac_type_b")
+    # Warf patients in follow up period - to check who was still receiving warfarin
+    connection.run("switching/warf2", **periods)
+    # INR tests, high INR values & TTRs (to count which patients had one in 3 month period)
+    connection.run("switching/inr", **periods)
+
+    if dummy_doacs is not None:
+        # #out table (not very useful but faster than adding to several temp tables!)
+        date_fields = ["WarfLatestIssue", "doacStart"]
+        multiple_choice = {"year": ['2019', '2020']}
+        exclusive_choices = {"continued_warfarin_flag": [0, 1], "switch_flag": [0, 1], "switch_back_flag": [0, 1],
+                             "inr_flag": [0, 1], "ttr_flag": [0, 1], "continued_warfarin_had_inr": [0, 1],
+                             "continued_warfarin_had_high_inr": [0, 1], "continued_warfarin_had_ttr": [0, 1],
+                             "first_doac_type": list(dummy_doacs)}
+        dummy_data = generate_dummy_data(date_fields, month_field="doacStart", multiple_choice=multiple_choice,
+                                         exclusive_choices=exclusive_choices)
+        # small fixes to dummy data:
+        dummy_data = dummy_data.rename(columns={"doacStart_month": "doacStartmonth"}).drop("doacStart", axis=1)
+        insert_dummy_data(connection, dummy_data, "#out")
+
+    # join warfarin and doac patients
+    connection.run("switching/out")
+    # output summary data for switching and testing, and summary of doac types
+    return connection.read("switching/summary"), connection.read("switching/doac_types")
+
+
+def summarise_switching(df, period):
+    '''
+    Summarise patients on Warfarin during baseline and how many switched to DOAC during follow-up, for 2019 vs 2020
+
+    INPUTS:
+    df (dataframe): summary figures without percentages (from `switching`)
+    period (str): name of the period (a key of SWITCHING_PERIODS)
+
+    OUTPUTS:
+    out (df): summary data
+    '''
+    out = df.copy()
+    out["period"] = period
+    out["baseline warfarin patients (thousands)"] = (out["baseline_warfarin_patients"]/1000).round(1)
+    out["switched (thousands)"] = (out["switch_flag"]/1000).round(1)
+
+    for c in ["switch_flag", "continued_warfarin_flag"]:
+        c2 = c.replace("_flag", "")
+        out[f"{c2} (%)"] = (100*out[c]/out["baseline_warfarin_patients"]).round(1)
+
+    out["switched back (thousands)"] = (out["switch_back_flag"]/1000).round(1)
+    out["switched back (% of switchers)"] = (100*out["switch_back_flag"]/out["switch_flag"]).round(1)
+
+    for c in ["continued_warfarin_had_inr", "continued_warfarin_had_ttr", "continued_warfarin_had_high_inr"]:
+        c2 = c.replace("continued_warfarin_", "")
+        out[f"{c} (thousands)"] = (out[c]/1000).round(1)
+        out[f"{c2} (% of continued)"] = (100*out[c]/out["continued_warfarin_flag"]).round(1)
+
+    out = out.drop(columns=["continued_warfarin_had_inr", "continued_warfarin_had_ttr",
+                            "continued_warfarin_had_high_inr", "switch_flag", "switch_back_flag",
+                            "baseline_warfarin_patients", "continued_warfarin_flag", "inr_count", "ttr_count"])
+    return out.sort_values(by="year")
+
+
+def doac_types(df, period, chemicals):
+    '''
+    Summarise which DOACs Warfarin patients are switched to
+
+    INPUTS:
+    df (dataframe): patients switched to each DOAC (from `switching`)
+    period (str): name of the period (a key of SWITCHING_PERIODS)
+    chemicals (df): MultilexDrug_ID and chemical of each DOAC
+
+    OUTPUTS:
+    out (df): patient counts (rounded to 10) and percentages, indexed by period, year and chemical
+    '''
+    out = df.copy()
+    out["period"] = period
+    out = out.merge(chemicals, left_on="first_doac_type", right_on="MultilexDrug_ID")
+    out = out[["year", "period", "chemical", "patient_count"]].groupby(["year", "period", "chemical"]).sum()
+    out = out.sort_values(by="patient_count", ascending=False).unstack(level=0)
+    for year in ["2019", "2020"]:
+        out[("%", year)] = (100*out[("patient_count", year)]/out[("patient_count", year)].sum()).round(1)
+    out["patient_count"] = 10*(out["patient_count"]/10).round(0)
+    # one row per year: chemicals not switched to in a year have no row for it
+    out = out.stack(level=1).dropna(how="all")
+    return out.reset_index().set_index(["period", "year", "chemical"])
+
+
+##### costings ########
+
+def doac_costs(doac_types):
+    '''
+    Annual actual cost per patient of each DOAC, weighted by the proportion of switches to it, March-May 2020.
+
+    INPUTS:
+    doac_types (df): contents of output/doac_types.csv
+
+    OUTPUTS:
+    costs (df): prices, annual_net_cost and proportion_cost of each DOAC
+    '''
+    doac_df = doac_types.loc[(doac_types["year"].astype(str) == "2020") & (doac_types["period"] == "March-May")]
+    doac_df = DOAC_PRICES.merge(doac_df.drop(columns=["period", "year"]))
+    doses_per_pack = doac_df["pack_size"]/doac_df["daily_doses"]
+    doac_df["annual_net_cost"] = 365 * ACTUAL_COST * doac_df["cost_per_pack"]/doses_per_pack
+    doac_df["proportion_cost"] = doac_df["annual_net_cost"]*doac_df["%"]/100
+    return doac_df
+
+
+def costings(doac_types, switchers, warf_df, tpp_df):
+    '''
+    Estimated annual cost of the switches from warfarin to DOACs, March-May 2020, in TPP practices and in England.
+
+    INPUTS:
+    doac_types (df): contents of output/doac_types.csv
+    switchers (df): contents of output/doac_switchers.csv
+    warf_df (df): actual cost of warfarin tablets in TPP practices, Dec 2019 - Feb 2020 (BigQuery)
+    tpp_df (df): list sizes of all practices and of TPP practices, December 2018 (BigQuery)
+
+    OUTPUTS:
+    out (series): costs per patient, patients switched, and switch costs, indexed by measure
+    '''
+    doac_cost = doac_costs(doac_types)["proportion_cost"].sum()
+    warf_cost = warf_df["actual_cost"].sum()
+    prop_tpp = tpp_df["tpp_list_size"].sum()/tpp_df["list_size"].sum()
+
+    switchers = switchers.loc[(switchers["year"].astype(str) == "2020") & (switchers["period"] == "March-May")]
+    warfarin_pts = 1000*switchers["baseline warfarin patients (thousands)"].sum()
+    switched_pts = 1000*switchers["switched (thousands)"].sum()
+
+    # annual costs, from 3 months of warfarin
+    warf_cost_per_patient = 4*warf_cost/warfarin_pts
+    doac_diff = doac_cost - warf_cost_per_patient
+    tpp_switch_costs = switched_pts*doac_diff
+    return pd.Series({"doac_annual_cost_per_patient": doac_cost,
+                      "warfarin_annual_cost_per_patient": warf_cost_per_patient,
+                      "annual_cost_difference_per_patient": doac_diff,
+                      "switched_patients": switched_pts,
+                      "tpp_annual_switch_costs": tpp_switch_costs,
+                      "tpp_proportion": prop_tpp,
+                      "national_annual_switch_costs": tpp_switch_costs/prop_tpp}, name="value").rename_axis("measure")
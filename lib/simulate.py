@@ -0,0 +1,321 @@
+'''
+Simulated TPP-shaped data for testing the notebooks offline and at scale.
+
+Unlike `generate_dummy_data()` (uniform random rows inserted into temp tables), this simulates patient timelines month
+by month - patients staying on warfarin for years, switching to DOACs, switching back, stopping, and having INR tests
+and TTR values recorded - and writes the underlying tables the notebooks query:
+
+MedicationIssue: Patient_ID, MultilexDrug_ID, StartDate, EndDate
+MedicationRepeat: Patient_ID, MultilexDrug_ID, StartDate, EndDate
+CodedEvent: Patient_ID, CTV3Code, ConsultationDate, NumericValue
+MedicationDictionary: MultilexDrug_ID, DMD_ID, FullName
+
+Drugs are the real codelist entries (using Multilex IDs from the local codelist cache where it has them), and
+switching, testing and DOAC type rates are calibrated to the published outputs, so joins have realistic selectivity.
+
+Usage, e.g. against the local SQL Server container (mssql/):
+    python simulate.py --patients 500000 --dbconn "DRIVER={ODBC Driver 17 for SQL Server};SERVER=...;DATABASE=Test_OPENCoronaExport;..."
+or into an embedded DuckDB database, to run the notebook without a SQL Server (see `local.py`):
+    python simulate.py --patients 100000 --dbconn "duckdb:../.cache/local.duckdb"
+'''
+import os
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from db import session
+from codelists import cached_lookup
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# months simulated: from the earliest date any section looks back to, to the end of the latest follow-up period
+START = '2018-06-01'
+END = '2020-11-01'
+
+INR_CODE = '42QE.'
+TTR_CODE = 'Xaa68'
+
+TABLES = {
+    "MedicationIssue": '''CREATE TABLE MedicationIssue (
+    Patient_ID BIGINT NOT NULL,
+    MultilexDrug_ID VARCHAR(767) NOT NULL,
+    StartDate DATETIME NOT NULL,
+    EndDate DATETIME NULL)''',
+    "MedicationRepeat": '''CREATE TABLE MedicationRepeat (
+    Patient_ID BIGINT NOT NULL,
+    MultilexDrug_ID VARCHAR(767) NOT NULL,
+    StartDate DATETIME NOT NULL,
+    EndDate DATETIME NULL)''',
+    "CodedEvent": '''CREATE TABLE CodedEvent (
+    Patient_ID BIGINT NOT NULL,
+    CTV3Code VARCHAR(50) NOT NULL,
+    ConsultationDate DATETIME NOT NULL,
+    NumericValue REAL NULL)''',
+    "MedicationDictionary": '''CREATE TABLE MedicationDictionary (
+    MultilexDrug_ID VARCHAR(767) NOT NULL,
+    DMD_ID BIGINT NOT NULL,
+    FullName VARCHAR(1000) NULL)''',
+}
+
+
+##### drugs and calibration ########
+
+def drugs():
+    '''
+    Warfarin and DOAC products from the local codelists, with a Multilex ID for each. IDs already resolved against
+    the real MedicationDictionary (see `codelists.py`) are used where cached; otherwise a stand-in ID is assigned.
+
+    OUTPUTS:
+    out (df): MultilexDrug_ID, DMD_ID, FullName, anticoag ("warfarin"/"DOAC") and chemical for each product
+    '''
+    out = []
+    stand_in = 900000
+    for anticoag, name in [("warfarin", "warfarin_codelist.csv"), ("DOAC", "doac_codelist.csv")]:
+        path = os.path.join(ROOT, "local_codelists", name)
+        codelist = pd.read_csv(path)
+        codelist = codelist.rename(columns={"id": "DMD_ID", "nm": "FullName"})
+        if "chemical" not in codelist.columns:
+            codelist["chemical"] = "Warfarin"
+        cached = cached_lookup(path)
+        if cached is not None:
+            codelist = codelist.merge(cached, on="DMD_ID", how="left")
+        else:
+            codelist["MultilexDrug_ID"] = None
+        missing = codelist["MultilexDrug_ID"].isnull()
+        codelist.loc[missing, "MultilexDrug_ID"] = [str(stand_in + i) for i in range(missing.sum())]
+        stand_in += missing.sum()
+        codelist["anticoag"] = anticoag
+        out.append(codelist[["MultilexDrug_ID", "DMD_ID", "FullName", "anticoag", "chemical"]])
+    return pd.concat(out, ignore_index=True)
+
+
+def _per_month(p):
+    '''Convert the probability of an event within 3 months to a monthly probability'''
+    return 1 - (1 - np.clip(p, 0, 1))**(1/3)
+
+
+def calibrate(switchers=None, types=None):
+    '''
+    Monthly transition and testing rates, from the published switching outputs. Rates for the March-May and June-Aug
+    follow-up periods of 2019 and 2020 are taken from those rows; other months use the average of the 2019 rows.
+
+    INPUTS:
+    switchers (str): path to doac_switchers.csv
+    types (str): path to doac_types.csv
+
+    OUTPUTS:
+    rates (df): monthly probabilities (switch, stop, switch_back, inr, ttr, high_inr), indexed by month
+    chemicals (series): share of new DOAC patients on each DOAC
+    '''
+    if switchers is None:
+        switchers = os.path.join(ROOT, "output", "doac_switchers.csv")
+    if types is None:
+        types = os.path.join(ROOT, "output", "doac_types.csv")
+
+    s = pd.read_csv(switchers, index_col=0)
+    s["switch"] = _per_month(s["switch (%)"]/100)
+    s["stop"] = _per_month((100 - s["switch (%)"] - s["continued_warfarin (%)"])/100)
+    s["switch_back"] = _per_month(s["switched back (% of switchers)"]/100)
+    s["inr"] = _per_month(s["had_inr (% of continued)"]/100)
+    s["ttr"] = _per_month(s["had_ttr (% of continued)"]/100)
+    s["high_inr"] = _per_month(s["had_high_inr (% of continued)"]/100)
+    cols = ["switch", "stop", "switch_back", "inr", "ttr", "high_inr"]
+    periods = {"March-May": [3, 4, 5], "June-Aug": [6, 7, 8]}
+
+    months = pd.date_range(START, END, freq="MS")[:-1]
+    rates = pd.DataFrame([s.loc[s["year"] == 2019, cols].mean()]*len(months), index=months)
+    for _, row in s.iterrows():
+        for m in periods[row["period"]]:
+            rates.loc[pd.Timestamp(int(row["year"]), m, 1), cols] = row[cols].values
+
+    t = pd.read_csv(types)
+    chemicals = t.groupby("chemical")["patient_count"].sum()
+    return rates, chemicals/chemicals.sum()
+
+
+##### simulation ########
+
+def simulate(patients=100000, seed=1, doac_share=0.66, new_doac_share=0.85, tests_per_month=2.2):
+    '''
+    Simulate anticoagulant timelines for a population of patients.
+
+    Each month every treated patient is issued their drug (occasionally twice, sometimes on the same day); warfarin
+    patients may switch to a DOAC (a few being issued both on the day they switch), and recent switchers may switch
+    back; anyone may stop, and untreated patients start at a rate which keeps the treated population roughly stable.
+    Warfarin patients are INR tested, with occasional high values and recorded TTRs. A repeat prescription covers each
+    continuous spell on one drug.
+
+    INPUTS:
+    patients (int): number of patients (roughly 20 issues are generated per patient)
+    seed (int): seed for the random generator, so that runs are reproducible
+    doac_share (float): share of initially treated patients on a DOAC (rather than warfarin)
+    new_doac_share (float): share of new starters who start on a DOAC
+    tests_per_month (float): mean number of INR tests for patients tested in a month
+
+    OUTPUTS:
+    tables (dict): dataframe for each table, keyed by table name
+    '''
+    rng = np.random.default_rng(seed)
+    products = drugs()
+    rates, chemicals = calibrate()
+    warf_ids = np.flatnonzero(products["anticoag"] == "warfarin")
+    doac_ids = np.flatnonzero(products["anticoag"] == "DOAC")
+    # pick DOAC products so that each chemical gets its calibrated share of patients
+    doac_chem = products["chemical"].iloc[doac_ids].map(chemicals).fillna(0).values
+    doac_weights = doac_chem / products["chemical"].iloc[doac_ids].map(
+        products["chemical"].iloc[doac_ids].value_counts()).values
+    doac_weights = doac_weights / doac_weights.sum()
+
+    def new_drug(n, anticoag):
+        if anticoag == 1:
+            return rng.choice(warf_ids, n)
+        return rng.choice(doac_ids, n, p=doac_weights)
+
+    # state per patient: 0 untreated, 1 warfarin, 2 DOAC
+    ids = np.arange(1, patients + 1, dtype=np.int64)
+    state = np.zeros(patients, dtype=np.int8)
+    treated = rng.random(patients) < 0.8
+    state[treated] = np.where(rng.random(treated.sum()) < doac_share, 2, 1)
+    drug = np.full(patients, -1, dtype=np.int32)
+    for s in (1, 2):
+        drug[state == s] = new_drug((state == s).sum(), s)
+    # start of the current spell (days since epoch), and when the patient last switched to a DOAC
+    spell_start = np.where(state > 0, np.datetime64(START, 'D').astype(np.int64) - rng.integers(0, 720, patients), -1)
+    switched = np.full(patients, -1, dtype=np.int32)
+
+    issues, repeats, events = [], [], []
+
+    def end_spells(ending, day):
+        if ending.any():
+            repeats.append((ids[ending], drug[ending], spell_start[ending], np.full(ending.sum(), day)))
+
+    for m, (month, r) in enumerate(rates.iterrows()):
+        first = np.datetime64(month.date(), 'D').astype(np.int64)
+
+        # transitions happen at the start of each month
+        u = rng.random(patients)
+        on_warf, on_doac = state == 1, state == 2
+        switch = on_warf & (u < r["switch"])
+        back = on_doac & (switched >= m - 3) & (switched >= 0) & (u < r["switch_back"])
+        stop = (on_warf | on_doac) & ~switch & ~back & (u > 1 - r["stop"])
+        n_treated = (state > 0).sum()
+        start = (state == 0) & (rng.random(patients) < r["stop"] * n_treated / max(1, patients - n_treated))
+
+        end_spells(switch | back | stop, first - 1)
+        state[switch], state[back], state[stop] = 2, 1, 0
+        switched[switch] = m
+        start_doac = start & (rng.random(patients) < new_doac_share)
+        state[start_doac], state[start & ~start_doac] = 2, 1
+        for s in (1, 2):
+            changed = (switch | back | start) & (state == s)
+            drug[changed] = new_drug(changed.sum(), s)
+        spell_start[switch | back | start] = first + rng.integers(0, 28, (switch | back | start).sum())
+        drug[stop] = -1
+
+        # issues: one a month for most treated patients, some twice (a few of those on the same day)
+        on = np.flatnonzero((state > 0) & (rng.random(patients) < 0.95))
+        day = np.maximum(first + rng.integers(0, 28, on.shape[0]), spell_start[on])
+        issues.append((ids[on], drug[on], day))
+        twice = on[rng.random(on.shape[0]) < 0.2]
+        same_day = rng.random(twice.shape[0]) < 0.1
+        issues.append((ids[twice], drug[twice],
+                       np.where(same_day, day[np.searchsorted(on, twice)], first + rng.integers(0, 28, twice.shape[0]))))
+        # a few switchers are also issued warfarin on the day their DOAC is started
+        overlap = np.flatnonzero(switch & (rng.random(patients) < 0.04))
+        issues.append((ids[overlap], new_drug(overlap.shape[0], 1), spell_start[overlap]))
+
+        # INR tests and TTRs for warfarin patients
+        warf = np.flatnonzero(state == 1)
+        tested = warf[rng.random(warf.shape[0]) < r["inr"]]
+        n_tests = 1 + rng.poisson(tests_per_month - 1, tested.shape[0])
+        pt = np.repeat(tested, n_tests)
+        value = np.round(np.exp(rng.normal(np.log(2.5), 0.3, pt.shape[0])), 1)
+        # high values, calibrated so that the share of tested patients with one matches the published rate
+        high = rng.random(pt.shape[0]) < r["high_inr"] / max(r["inr"], 1e-9) / tests_per_month
+        value[high] = np.where(rng.random(high.sum()) < 0.4, 8, rng.uniform(8.1, 12, high.sum()).round(1))
+        events.append((ids[pt], np.full(pt.shape[0], INR_CODE, dtype=object), first + rng.integers(0, 28, pt.shape[0]), value))
+        ttr = warf[rng.random(warf.shape[0]) < r["ttr"]]
+        events.append((ids[ttr], np.full(ttr.shape[0], TTR_CODE, dtype=object), first + rng.integers(0, 28, ttr.shape[0]),
+                       np.round(100 * rng.beta(5, 2, ttr.shape[0]))))
+
+    # spells still going at the end: repeats end some time after the simulated period
+    ongoing = state > 0
+    end_spells(ongoing, np.datetime64(END, 'D').astype(np.int64) + 180)
+
+    multilex = products["MultilexDrug_ID"].values.astype(object)
+
+    def frame(parts, columns):
+        cols = [np.concatenate([p[i] for p in parts]) for i in range(len(columns))]
+        return pd.DataFrame(dict(zip(columns, cols)))
+
+    issue = frame(issues, ["Patient_ID", "drug", "StartDate"])
+    issue["MultilexDrug_ID"] = multilex[issue.pop("drug")]
+    issue["EndDate"] = issue["StartDate"] + 28
+    repeat = frame(repeats, ["Patient_ID", "drug", "StartDate", "EndDate"])
+    repeat["MultilexDrug_ID"] = multilex[repeat.pop("drug")]
+    event = frame(events, ["Patient_ID", "CTV3Code", "ConsultationDate", "NumericValue"])
+
+    for df in (issue, repeat, event):
+        for c in df.columns:
+            if c.endswith("Date"):
+                df[c] = df[c].values.astype("datetime64[D]")
+
+    return {
+        "MedicationIssue": issue[["Patient_ID", "MultilexDrug_ID", "StartDate", "EndDate"]],
+        "MedicationRepeat": repeat[["Patient_ID", "MultilexDrug_ID", "StartDate", "EndDate"]],
+        "CodedEvent": event,
+        "MedicationDictionary": products[["MultilexDrug_ID", "DMD_ID", "FullName"]],
+    }
+
+
+##### loading ########
+
+def load(dbconn, tables, replace=True, chunk=100000):
+    '''
+    Write simulated tables to a database (e.g. the local SQL Server stand-in), using pyodbc's fast_executemany to
+    send each chunk of rows as one bulk parameter array.
+
+    INPUTS:
+    dbconn (str): ODBC connection string, or "duckdb:<path>" for the local engine
+    tables (dict): dataframe for each table, as returned by `simulate()`
+    replace (bool): drop and recreate the tables first (otherwise rows are appended to the existing tables)
+    chunk (int): rows sent per round trip
+
+    OUTPUTS:
+    None
+    '''
+    with session(dbconn, name="simulate") as connection:
+        for table, df in tables.items():
+            if replace:
+                connection.execute(f"IF OBJECT_ID('{table}') IS NOT NULL DROP TABLE {table}", TABLES[table])
+            started = time.time()
+            cols = ", ".join(df.columns)
+            sql = f"INSERT INTO {table} ({cols}) VALUES ({', '.join('?' for c in df.columns)})"
+            cursor = connection.cursor()
+            cursor.fast_executemany = True
+            if hasattr(cursor, "append"):
+                # the local engine (see `local.py`) loads dataframes directly
+                cursor.append(table, df)
+            else:
+                for i in range(0, len(df), chunk):
+                    part = df.iloc[i:i + chunk]
+                    # convert numpy values (and NaN) to the python objects pyodbc expects
+                    part = part.astype(object).where(part.notna(), None)
+                    cursor.executemany(sql, part.values.tolist())
+            cursor.close()
+            print(f"{table}: {len(df):,} rows in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a simulated TPP-shaped dataset into a local database")
+    parser.add_argument("--patients", type=int, default=100000, help="number of patients (~20 issues each)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dbconn", default=os.environ.get("DBCONN", "").strip('"'),
+                        help="ODBC connection string, or duckdb:<path>")
+    args = parser.parse_args()
+
+    tables = simulate(patients=args.patients, seed=args.seed)
+    load(args.dbconn, tables)
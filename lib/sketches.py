@@ -0,0 +1,299 @@
+'''
+Mergeable quantile sketches of the TTR and INR value distributions.
+
+The TTR section ranks every value within its month (`PERCENT_RANK() OVER (PARTITION BY month ...)`) and counts
+values in fixed bins, which sorts each month on the server, and has to be re-run for any other percentile or binning.
+Instead, each month's values (and each month's values split by whether the patient was tested again the next month)
+are summarised as a t-digest: a few hundred weighted centroids, accurate at the tails, from which percentiles,
+ranks and counts in any bins can be estimated. Digests merge, so months can be combined (e.g. into quarters or
+pre/post periods), and sketches built by separate runs or workers can be added together, without reading the
+values again.
+
+    sketches = MonthlySketches("ttr")
+    sketches.update(connection.read("sketches/ttr"), by=["month", "tested_next_month"])
+    sketches.save()
+    sketches.get(month="2020-04-01", tested_next_month=1).quantile([0.25, 0.5, 0.75])
+    sketches.combine(tested_next_month=1).bins([0, 50, 60, 70, 80, 90])
+
+Values are sent from the database as (value, count) pairs, so repeated values (TTRs are whole percentages) are only
+transferred once. A digest with no more distinct values than its compression keeps each value as its own centroid,
+so the ranks and bins of TTRs (and of INRs, recorded to one decimal place) are exact rather than estimated.
+'''
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+SKETCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "sketches")
+
+# larger values keep more centroids: more accurate, but larger sketches
+COMPRESSION = 200
+
+
+class TDigest:
+    '''
+    A merging t-digest (Dunning & Ertl) of weighted values.
+
+    INPUTS:
+    compression (int): scale of the digest; it keeps about this many centroids at most
+    '''
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+        # whether each centroid is still a single distinct value (so counts and quantiles are exact)
+        self.exact = True
+
+    def __repr__(self):
+        return f"TDigest(count={self.count:g}, centroids={len(self.means)})"
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def _k(self, q):
+        '''Scale function: centroids are small (few values) near q = 0 and 1, large in the middle'''
+        return self.compression / np.pi * np.arcsin(2*np.clip(q, 0, 1) - 1)
+
+    def _compress(self, means, weights):
+        # identical values always share a centroid
+        means, ids = np.unique(means, return_inverse=True)
+        weights = np.bincount(ids.reshape(-1), weights=weights)
+        total = weights.sum()
+        if len(means) <= self.compression or total == 0:
+            # few enough distinct values to keep each exactly
+            self.means, self.weights = means, weights
+            return
+        self.exact = False
+        # otherwise each centroid spans at most one unit of the scale function, values being assigned by where their
+        # midpoint falls
+        mid = (np.cumsum(weights) - weights/2) / total
+        group = np.floor(self._k(mid)).astype(np.int64)
+        ids = np.cumsum(np.concatenate([[True], group[1:] != group[:-1]])) - 1
+        self.weights = np.bincount(ids, weights=weights)
+        self.means = np.bincount(ids, weights=means*weights) / self.weights
+
+    def add(self, values, weights=None):
+        '''
+        Add values to the digest.
+
+        INPUTS:
+        values (array): values to add (missing values are ignored)
+        weights (array): number of times each value occurs (1 each by default)
+
+        OUTPUTS:
+        self
+        '''
+        values = np.asarray(values, dtype=float)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float)
+        keep = ~np.isnan(values) & (weights > 0)
+        values, weights = values[keep], weights[keep]
+        if len(values) > 0:
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, weights]))
+        return self
+
+    def merge(self, *others):
+        '''Combine this digest with others (as if all their values had been added to one digest), returning a new one'''
+        out = TDigest(self.compression)
+        out.min = min([self.min] + [o.min for o in others])
+        out.max = max([self.max] + [o.max for o in others])
+        out.exact = self.exact and all(o.exact for o in others)
+        out._compress(np.concatenate([self.means] + [o.means for o in others]),
+                      np.concatenate([self.weights] + [o.weights for o in others]))
+        return out
+
+    def _points(self):
+        '''Piecewise-linear cumulative distribution: the minimum, each centroid at its midpoint, and the maximum'''
+        cum = np.cumsum(self.weights) - self.weights/2
+        return (np.concatenate([[self.min], self.means, [self.max]]),
+                np.concatenate([[0], cum, [self.count]]))
+
+    def quantile(self, q):
+        '''
+        Estimated value(s) at quantile(s) q (0 to 1)
+
+        INPUTS:
+        q (float or list): quantiles, e.g. [0.25, 0.5, 0.75]
+
+        OUTPUTS:
+        values (float or array): estimated value at each quantile (NaN if the digest is empty)
+        '''
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        if self.exact:
+            # the first value reaching the quantile, as PERCENTILE_DISC
+            cum = np.cumsum(self.weights)
+            pos = np.searchsorted(cum, np.asarray(q, dtype=float) * self.count - 1e-9*self.count)
+            return self.means[np.minimum(pos, len(self.means) - 1)]
+        x, cum = self._points()
+        return np.interp(np.asarray(q, dtype=float) * self.count, cum, x)
+
+    def below(self, x):
+        '''
+        Estimated number of values strictly less than x (exact for values held alone in a centroid, e.g. while the
+        digest holds few enough distinct values).
+        '''
+        x = np.asarray(x, dtype=float)
+        if self.count == 0:
+            return np.zeros(x.shape)
+        if self.exact:
+            return np.concatenate([[0], np.cumsum(self.weights)])[np.searchsorted(self.means, x)]
+        points, cum = self._points()
+        estimate = np.interp(x, points, cum, left=0, right=self.count)
+        # at a centroid's own value, count only the centroids before it
+        pos = np.searchsorted(self.means, x)
+        inside = pos < len(self.means)
+        exact = np.zeros(x.shape, dtype=bool)
+        exact[inside] = self.means[pos[inside]] == x[inside]
+        before = np.concatenate([[0], np.cumsum(self.weights)])[pos]
+        return np.where(exact, before, np.where(x > self.max, self.count, estimate))
+
+    def percent_rank(self, x):
+        '''Estimated PERCENT_RANK() of value(s) x among the values: (number less than x) / (count - 1)'''
+        return self.below(x) / max(self.count - 1, 1)
+
+    def bins(self, edges, labels=None):
+        '''
+        Estimated number of values in each bin [edges[i], edges[i+1]), with the last bin open-ended (as the CASE
+        bands of ttr/binned, e.g. edges [0, 50, 60, 70, 80, 90] for "0-<50" ... "90-100").
+
+        OUTPUTS:
+        counts (series): estimated count in each bin
+        '''
+        edges = np.asarray(edges, dtype=float)
+        below = np.concatenate([self.below(edges), [self.count]])
+        below[0] = 0
+        if labels is None:
+            labels = [f"{a:g}-<{b:g}" for a, b in zip(edges[:-1], edges[1:])] + [f"{edges[-1]:g}+"]
+        return pd.Series(np.diff(below), index=labels)
+
+    def mean(self):
+        return float((self.means * self.weights).sum() / self.count) if self.count else np.nan
+
+    def to_dict(self):
+        return {"compression": self.compression, "min": self.min, "max": self.max, "exact": self.exact,
+                "means": self.means.tolist(), "weights": self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        out = cls(d["compression"])
+        out.min, out.max, out.exact = d["min"], d["max"], d["exact"]
+        out.means, out.weights = np.array(d["means"], dtype=float), np.array(d["weights"], dtype=float)
+        return out
+
+
+def _key(values):
+    '''Key of a sketch in the store, from its month and split values, e.g. "2020-04-01|1"'''
+    return "|".join(pd.Timestamp(v).strftime("%Y-%m-%d") if i == 0 else str(v) for i, v in enumerate(values))
+
+
+class MonthlySketches:
+    '''
+    A digest of a series' values for each month (and split), kept under `.cache/sketches/`.
+
+    INPUTS:
+    name (str): name of the series, e.g. "ttr"
+    directory (str): where the sketches are kept
+    compression (int): compression of new digests
+    '''
+
+    def __init__(self, name, directory=SKETCH_DIR, compression=COMPRESSION):
+        self.name = name
+        self.path = os.path.join(directory, name + ".json")
+        self.compression = compression
+        self.by = None
+        self.sketches = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                stored = json.load(f)
+            self.by = stored["by"]
+            self.sketches = {k: TDigest.from_dict(v) for k, v in stored["sketches"].items()}
+
+    def __repr__(self):
+        return f"MonthlySketches({self.name!r}, {len(self.sketches)} sketches)"
+
+    def update(self, df, by, value="NumericValue", weight="n"):
+        '''
+        Build a digest for each month (and split) in the results, replacing any stored for the same months.
+
+        INPUTS:
+        df (df): values and their counts, e.g. from `sketches/ttr`
+        by (list): month column then any split columns, e.g. ["month", "tested_next_month"]
+        value (str): column of values
+        weight (str): column with the number of times each value occurs (None if each row is one value)
+
+        OUTPUTS:
+        None
+        '''
+        if self.by is not None and self.by != list(by):
+            raise ValueError(f"{self.name} sketches are split by {self.by}, not {list(by)}")
+        self.by = list(by)
+        for values, group in df.groupby(self.by):
+            values = values if isinstance(values, tuple) else (values,)
+            weights = None if weight is None else group[weight].values
+            self.sketches[_key(values)] = TDigest(self.compression).add(group[value].values, weights)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"by": self.by, "sketches": {k: v.to_dict() for k, v in self.sketches.items()}}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def months(self):
+        return sorted({pd.Timestamp(k.split("|")[0]) for k in self.sketches})
+
+    def get(self, month, **split):
+        '''The digest for one month and split, e.g. get("2020-04-01", tested_next_month=1)'''
+        return self.combine(months=[month], **split)
+
+    def combine(self, months=None, **split):
+        '''
+        Merge the digests of several months and/or splits into one.
+
+        INPUTS:
+        months (list): months to combine (all by default)
+        split: values of split columns to keep, e.g. tested_next_month=1 (all values by default)
+
+        OUTPUTS:
+        TDigest
+        '''
+        months = None if months is None else {pd.Timestamp(m) for m in months}
+        unknown = set(split) - set(self.by or [])
+        if unknown:
+            raise ValueError(f"{self.name} sketches are not split by {sorted(unknown)}")
+        chosen = []
+        for k, digest in self.sketches.items():
+            values = dict(zip(self.by, k.split("|")))
+            if months is not None and pd.Timestamp(values[self.by[0]]) not in months:
+                continue
+            if any(values[c] != str(v) for c, v in split.items()):
+                continue
+            chosen.append(digest)
+        return TDigest(self.compression).merge(*chosen)
+
+    def table(self, quantiles=(0.25, 0.5, 0.75), **split):
+        '''
+        Count, mean and quantiles for each month (and split), as a dataframe indexed by month
+
+        INPUTS:
+        quantiles (list): quantiles to estimate
+        split: values of split columns to keep (others are shown as columns)
+        '''
+        rows = []
+        for k, digest in sorted(self.sketches.items()):
+            values = dict(zip(self.by, k.split("|")))
+            if any(values[c] != str(v) for c, v in split.items()):
+                continue
+            row = {c: v for c, v in values.items() if c not in split}
+            row[self.by[0]] = pd.Timestamp(values[self.by[0]])
+            row.update({"count": digest.count, "mean": digest.mean()})
+            row.update({f"p{round(100*q):02d}": v for q, v in zip(quantiles, digest.quantile(list(quantiles)))})
+            rows.append(row)
+        return pd.DataFrame(rows).set_index(self.by[0]) if rows else pd.DataFrame()
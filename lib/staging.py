@@ -0,0 +1,45 @@
+'''
+Staging layer for the anticoagulant analyses.
+
+MedicationIssue and MedicationRepeat are the two largest tables, and every section of the report needs the same
+warfarin/DOAC rows from them. They are scanned once here into indexed working tables, which carry the drug class
+and precomputed months, and every downstream query in `queries.py` reads from these instead:
+
+#ac_issues: Patient_ID, MultilexDrug_ID, anticoag, StartDate, EndDate, Startmonth, Startmonth_key
+#ac_repeats: Patient_ID, anticoag, StartDate, EndDate, Startmonth, Endmonth, Startmonth_key, Endmonth_key
+#calendar: month_key, month_start, month_end
+
+Months are carried both as dates (for output) and as integer keys (`queries.month_key`), which the joins between
+working tables use: comparing and offsetting the keys lets SQL Server seek on the indexes rather than evaluating
+DATEFROMPARTS/DATEDIFF for every pair of rows.
+'''
+
+# the codelist and staging tables every section reads, e.g. for other connections to read shared copies of
+STAGED = ["#anticoag_codes", "#ctv3_codes", "#calendar", "#ac_issues", "#ac_repeats"]
+
+# earliest issue date needed by any section (INR testing looks back 3 months from Jan 2019, switching from Dec 2018)
+ISSUES_FROM = '20180901'
+# repeats are needed if they ended after this date (previous repeats before a new DOAC repeat) ...
+REPEATS_END_FROM = '20180601'
+# ... or started after this date (new DOAC repeats)
+REPEATS_START_FROM = '20190101'
+
+
+def stage(connection, issues_from=ISSUES_FROM, repeats_end_from=REPEATS_END_FROM,
+          repeats_start_from=REPEATS_START_FROM):
+    '''
+    Extract all anticoagulant issues and repeats into the staging tables. Requires the codelist tables to have been
+    loaded first (see `queries.load_codelists`). Tables already staged with the same dates are not rebuilt.
+
+    INPUTS:
+    connection (DbSession): session to build the tables on
+    issues_from (str): earliest issue date to extract
+    repeats_end_from (str): extract repeats ending on or after this date
+    repeats_start_from (str): extract repeats starting on or after this date
+
+    OUTPUTS:
+    None
+    '''
+    connection.run("staging/calendar")
+    connection.run("staging/issues", start=issues_from)
+    connection.run("staging/repeats", end_from=repeats_end_from, start_from=repeats_start_from)
@@ -0,0 +1,205 @@
+'''
+Columnar, memory-mapped store of patient timelines.
+
+Each analysis reconstructs patient histories (issues before and after baseline, repeats ending within 3 months, INR
+tests within 3 months of an issue) with SQL self-joins, and `Timelines.extract` reads them from the database again in
+each session. The store keeps the extracted timelines on disk in a CSR ("compressed sparse row") layout: the sorted
+patient IDs, and for each of issues, repeats and events an offsets array giving where each patient's rows start in
+that table's arrays, which are sorted by patient then date. Dates are int32 days since 1970 and drugs and CTV3 codes
+are int16 codes, so an issue takes 6 bytes and a repeat 9 (an event, with its value, 14).
+
+    TimelineStore.write(Timelines.extract(connection))      # once, after staging
+    store = TimelineStore()                                 # in any session or process, without the database
+    timelines = store.timelines()                           # for the engines in timelines.py and cohorts.py
+    store.patient(1234)                                     # one patient's issues, repeats and events
+
+The arrays are opened with `np.load(mmap_mode="r")`, so opening the store reads nothing until rows are used, and
+processes using the same store share its pages in the OS page cache rather than each holding a copy. Workers can each
+take a block of patients with `store.timelines(first, last)` (see `partitions`).
+'''
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from timelines import Timelines, INR_CODE, TTR_CODE
+
+
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "timelines")
+
+CODES = [INR_CODE, TTR_CODE]
+
+# missing dates (e.g. a repeat with no end date) as int32 days
+NO_DATE = np.iinfo(np.int32).min
+
+# the rows of each table: its columns and their types on disk
+TABLES = {
+    "issue": {"date": np.int32, "drug": np.int16},
+    "repeat": {"start": np.int32, "end": np.int32, "doac": np.bool_},
+    "event": {"date": np.int32, "code": np.int16, "value": np.float64},
+}
+
+
+def _to_days(dates):
+    '''datetime64[D] dates as int32 days since 1970'''
+    days = dates.astype("datetime64[D]").astype(np.int64)
+    return np.where(np.isnat(dates), NO_DATE, days).astype(np.int32)
+
+
+def _from_days(days):
+    '''int32 days since 1970 as datetime64[D] dates'''
+    dates = days.astype(np.int64).astype("datetime64[D]")
+    dates[days == NO_DATE] = np.datetime64("NaT")
+    return dates
+
+
+class TimelineStore:
+    '''
+    Patient timelines in CSR layout, memory-mapped from a directory of .npy arrays.
+
+    INPUTS:
+    path (str): directory of the store
+    '''
+
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.drugs = np.array(meta["drugs"])
+        self.drug_doac = np.array(meta["drug_doac"], dtype=bool)
+        self.codes = meta["codes"]
+        self.patients = self._open("patients")
+        self.offsets = {table: self._open(f"{table}_offsets") for table in TABLES}
+        self.columns = {table: {c: self._open(f"{table}_{c}") for c in columns} for table, columns in TABLES.items()}
+
+    def _open(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __repr__(self):
+        rows = ", ".join(f"{self.offsets[t][-1]} {t}s" for t in TABLES)
+        return f"TimelineStore({len(self)} patients, {rows})"
+
+    @classmethod
+    def write(cls, timelines, path=STORE_DIR):
+        '''
+        Write extracted timelines to a store, replacing any already there.
+
+        INPUTS:
+        timelines (Timelines): extracted timelines (see `Timelines.extract`)
+        path (str): directory of the store
+
+        OUTPUTS:
+        TimelineStore: the new store, opened
+        '''
+        t = timelines
+        if len(t.drugs) > np.iinfo(np.int16).max:
+            raise ValueError(f"{len(t.drugs)} drugs can't be held as int16 codes")
+        patients = np.unique(np.concatenate([t.issue_patient, t.repeat_patient, t.event_patient]))
+        drug_doac = np.zeros(len(t.drugs), dtype=bool)
+        drug_doac[t.issue_drug[t.issue_doac]] = True
+        arrays = {
+            "patients": patients,
+            "issue_offsets": np.append(np.searchsorted(t.issue_patient, patients), len(t.issue_patient)),
+            "issue_date": _to_days(t.issue_date),
+            "issue_drug": t.issue_drug,
+            "repeat_offsets": np.append(np.searchsorted(t.repeat_patient, patients), len(t.repeat_patient)),
+            "repeat_start": _to_days(t.repeat_start),
+            "repeat_end": _to_days(t.repeat_end),
+            "repeat_doac": t.repeat_doac,
+            "event_offsets": np.append(np.searchsorted(t.event_patient, patients), len(t.event_patient)),
+            "event_date": _to_days(t.event_date),
+            # events are either INR tests or TTRs (the codes extracted by timelines/events)
+            "event_code": np.where(t.event_ttr, CODES.index(TTR_CODE), CODES.index(INR_CODE)),
+            "event_value": t.event_value,
+        }
+        dtypes = {f"{table}_{c}": dtype for table, columns in TABLES.items() for c, dtype in columns.items()}
+        dtypes.update({f"{table}_offsets": np.int64 for table in TABLES}, patients=np.int64)
+
+        # write to a new directory and swap it in, so an open store is never seen half-written
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), np.asarray(values, dtype=dtypes[name]))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"drugs": t.drugs.tolist(), "drug_doac": drug_doac.tolist(), "codes": CODES}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        return cls(path)
+
+    def partitions(self, n):
+        '''
+        Split the patients into n contiguous blocks of about the same number of rows, e.g. one per worker process.
+
+        OUTPUTS:
+        blocks (list): (first, last) patient positions of each block, to pass to `timelines(first, last)`
+        '''
+        rows = sum(self.offsets[t].astype(np.int64) for t in TABLES)
+        bounds = np.searchsorted(rows, np.linspace(0, rows[-1], n + 1)[1:-1])
+        bounds = np.unique(np.concatenate([[0], bounds, [len(self)]]))
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def _rows(self, table, first, last):
+        '''Slices of a table's columns holding the rows of patients first to last (positions), and their patients'''
+        offsets = self.offsets[table]
+        a, b = int(offsets[first]), int(offsets[last])
+        patient = np.repeat(self.patients[first:last], np.diff(offsets[first:last + 1]))
+        return patient, {c: v[a:b] for c, v in self.columns[table].items()}
+
+    def timelines(self, first=0, last=None):
+        '''
+        The timelines of the patients at positions first to last (all by default), for the engines in `timelines.py`.
+
+        OUTPUTS:
+        Timelines
+        '''
+        last = len(self) if last is None else last
+        issue_patient, issues = self._rows("issue", first, last)
+        repeat_patient, repeats = self._rows("repeat", first, last)
+        event_patient, events = self._rows("event", first, last)
+        return Timelines.from_arrays(
+            self.drugs,
+            issue_patient=issue_patient,
+            issue_date=_from_days(issues["date"]),
+            issue_doac=self.drug_doac[issues["drug"]],
+            issue_drug=np.asarray(issues["drug"]),
+            repeat_patient=repeat_patient,
+            repeat_start=_from_days(repeats["start"]),
+            repeat_end=_from_days(repeats["end"]),
+            repeat_doac=np.asarray(repeats["doac"]),
+            event_patient=event_patient,
+            event_date=_from_days(events["date"]),
+            event_inr=np.asarray(events["code"]) == self.codes.index(INR_CODE),
+            event_ttr=np.asarray(events["code"]) == self.codes.index(TTR_CODE),
+            event_value=np.asarray(events["value"]),
+        )
+
+    def patient(self, patient_id):
+        '''
+        One patient's issues, repeats and events.
+
+        OUTPUTS:
+        timeline (dict): a dataframe of each of "issues", "repeats" and "events" (empty if the patient has none)
+        '''
+        pos = np.searchsorted(self.patients, patient_id)
+        found = pos < len(self) and self.patients[pos] == patient_id
+        first, last = (pos, pos + 1) if found else (0, 0)
+        _, issues = self._rows("issue", first, last)
+        _, repeats = self._rows("repeat", first, last)
+        _, events = self._rows("event", first, last)
+        return {
+            "issues": pd.DataFrame({"MultilexDrug_ID": self.drugs[issues["drug"]],
+                                    "anticoag": np.where(self.drug_doac[issues["drug"]], "DOAC", "warfarin"),
+                                    "StartDate": _from_days(issues["date"])}),
+            "repeats": pd.DataFrame({"anticoag": np.where(repeats["doac"], "DOAC", "warfarin"),
+                                     "StartDate": _from_days(repeats["start"]),
+                                     "EndDate": _from_days(repeats["end"])}),
+            "events": pd.DataFrame({"CTV3Code": np.array(self.codes)[events["code"]],
+                                    "ConsultationDate": _from_days(events["date"]),
+                                    "NumericValue": np.asarray(events["value"])}),
+        }
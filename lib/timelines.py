@@ -0,0 +1,664 @@
+'''
+In-memory engine for the switching analyses, over patient timelines held as sorted columnar arrays.
+
+The switching comparison (`switching/*` in `queries.py`) and the DOAC repeat analysis (`doac_repeats/*`) are chains
+of temp tables LEFT JOINed on patient and year/month, so trying a different window rule means another round trip
+through the database. Here the anticoagulant issues, repeats and INR/TTR events are extracted once, sorted by patient
+and date, and the same flags are computed with vectorised operations: a boolean mask selects the rows in each window,
+the earliest/latest row per patient is the first/last of each run of the same patient (since rows are sorted), and
+patients are matched between tables with `searchsorted` rather than joins.
+
+    timelines = Timelines.extract(connection)       # after `stage(connection)`
+    out = timelines.switching(dates1)               # same rows and flags as #out from switching/out
+    switching_summary(out), doac_types(out)         # same as switching/summary and switching/doac_types
+
+    windows = rolling_windows("2018-06-01", "2020-06-01", baseline=3, followup=3, step=1)
+    windows_summary(timelines.switching_windows(windows), windows)     # every window in one pass, as a long table
+
+Results match the SQL exactly. Dates are compared as days, as the TPP date columns hold no time of day.
+'''
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from queries import PERIODS
+
+
+INR_CODE = '42QE.'
+TTR_CODE = 'Xaa68'
+
+# earliest date extracted (the earliest any switching or DOAC repeat window looks at)
+EXTRACT_FROM = '20180601'
+
+# a patient (as a rank) and a month key are packed into one sortable int64 as rank * MONTHS + month key
+MONTHS = 1 << 20
+
+# the columnar arrays of a Timelines (besides `drugs`, the sorted drug IDs that `issue_drug` codes index)
+ARRAYS = ["issue_patient", "issue_date", "issue_doac", "issue_drug",
+          "repeat_patient", "repeat_start", "repeat_end", "repeat_doac",
+          "event_patient", "event_date", "event_inr", "event_ttr", "event_value"]
+
+
+##### array helpers ########
+
+def _days(values):
+    '''Dates (or date strings) as datetime64[D] arrays; missing dates become NaT'''
+    return pd.to_datetime(pd.Series(values)).values.astype("datetime64[D]")
+
+
+def _runs(patient, mask):
+    '''
+    Runs of consecutive selected rows belonging to the same patient, in sorted arrays.
+
+    OUTPUTS:
+    ids (array): patient of each run (sorted, unique)
+    first (array): index of the first row of each run (the earliest, since rows are sorted by date within patient)
+    last (array): index of the last row of each run (the latest)
+    '''
+    rows = np.flatnonzero(mask)
+    p = patient[rows]
+    new = np.ones(len(rows), dtype=bool)
+    new[1:] = p[1:] != p[:-1]
+    end = np.ones(len(rows), dtype=bool)
+    end[:-1] = new[1:]
+    return p[new], rows[new], rows[end]
+
+
+def _lookup(keys, values):
+    '''Position of each value in the sorted unique keys, and whether it was found there'''
+    pos = np.searchsorted(keys, values)
+    found = np.zeros(len(values), dtype=bool)
+    inside = pos < len(keys)
+    found[inside] = keys[pos[inside]] == values[inside]
+    return np.where(found, pos, 0), found
+
+
+def _month_keys(days):
+    '''Integer month keys (months since year 0, as `queries.month_key`) of datetime64[D] dates'''
+    months = days.astype("datetime64[M]").astype(np.int64)
+    return months + 1970*12
+
+
+def _months(keys):
+    '''Month keys back to (first of the month) datetimes'''
+    return pd.to_datetime((keys - 1970*12).astype("datetime64[M]"))
+
+
+def _current_month(today=None):
+    '''First day of the current month, before which the SQL counts prescriptions (the GETDATE() cut-offs)'''
+    return _days([date.today() if today is None else today])[0].astype("datetime64[M]").astype("datetime64[D]")
+
+
+def _covered(opened, closed, points):
+    '''
+    Sweep-line coverage of patient-months by intervals of months, without pairing points with intervals.
+
+    INPUTS:
+    opened (array): packed key (see MONTHS) of the first month of each interval
+    closed (array): packed key of the last month of each interval (for the same patient, and not before the first)
+    points (array): packed keys of the patient-months to test
+
+    OUTPUTS:
+    covered (array): whether each point is within at least one interval
+    '''
+    # intervals open at a point are those opened by it less those closed before it (the intervals of earlier patients
+    # are both opened and closed before it, so cancel out)
+    return np.searchsorted(np.sort(opened), points, "right") - np.searchsorted(np.sort(closed), points, "left") > 0
+
+
+class Timelines:
+    '''
+    Anticoagulant issues, repeats and INR/TTR events as columnar arrays, each sorted by patient then date.
+
+    INPUTS:
+    issues (df): Patient_ID, MultilexDrug_ID, anticoag ("warfarin"/"DOAC") and StartDate of each issue
+    repeats (df): Patient_ID, anticoag, StartDate and EndDate of each repeat prescription (optional)
+    events (df): Patient_ID, CTV3Code, ConsultationDate and NumericValue of each INR test and TTR (optional)
+    '''
+
+    def __init__(self, issues, repeats=None, events=None):
+        # drugs are held as codes into the sorted list of drug IDs, so comparing codes compares the IDs
+        self.drugs, drug = np.unique(issues["MultilexDrug_ID"].astype(str).values, return_inverse=True)
+        patient = issues["Patient_ID"].values.astype(np.int64)
+        day = _days(issues["StartDate"])
+        # within a day, rows are ordered by drug, so the first row of a run is also the lowest drug ID on that day
+        order = np.lexsort((drug, day, patient))
+        self.issue_patient = patient[order]
+        self.issue_date = day[order]
+        self.issue_doac = (issues["anticoag"].values == "DOAC")[order]
+        self.issue_drug = drug.reshape(-1)[order]
+
+        if repeats is None:
+            repeats = pd.DataFrame(columns=["Patient_ID", "anticoag", "StartDate", "EndDate"])
+        patient = repeats["Patient_ID"].values.astype(np.int64)
+        start, end = _days(repeats["StartDate"]), _days(repeats["EndDate"])
+        order = np.lexsort((start, patient))
+        self.repeat_patient = patient[order]
+        self.repeat_start = start[order]
+        self.repeat_end = end[order]
+        self.repeat_doac = (repeats["anticoag"].values == "DOAC")[order]
+
+        if events is None:
+            events = pd.DataFrame(columns=["Patient_ID", "CTV3Code", "ConsultationDate", "NumericValue"])
+        patient = events["Patient_ID"].values.astype(np.int64)
+        day = _days(events["ConsultationDate"])
+        order = np.lexsort((day, patient))
+        code = events["CTV3Code"].values[order]
+        self.event_patient = patient[order]
+        self.event_date = day[order]
+        self.event_inr = code == INR_CODE
+        self.event_ttr = code == TTR_CODE
+        self.event_value = events["NumericValue"].values.astype(float)[order]
+
+    @classmethod
+    def from_arrays(cls, drugs, **arrays):
+        '''
+        Timelines from arrays already sorted as above (e.g. from a `store.TimelineStore`), used without copying.
+
+        INPUTS:
+        drugs (array): sorted drug IDs
+        arrays: each of ARRAYS
+        '''
+        out = cls.__new__(cls)
+        out.drugs = drugs
+        for name in ARRAYS:
+            setattr(out, name, arrays[name])
+        return out
+
+    @classmethod
+    def extract(cls, connection, start=EXTRACT_FROM):
+        '''
+        Extract the timelines from the staged tables (see `staging.py`) and CodedEvent.
+
+        INPUTS:
+        connection (DbSession): session the staged tables were built on
+        start (str): earliest issue and event date to extract
+
+        OUTPUTS:
+        Timelines
+        '''
+        return cls(connection.read("timelines/issues", start=start),
+                   connection.read("timelines/repeats"),
+                   connection.read("timelines/events", start=start))
+
+    ##### switching: patients on warfarin during baseline, and how many switched to DOAC ########
+
+    def switching(self, dates):
+        '''
+        Baseline warfarin patients and their switching and testing flags, as built by `switching/out`.
+
+        INPUTS:
+        dates (list): b_start_2020, b_end_2020, f_end_2020, b_start_2019, b_end_2019, f_end_2019 (as in the notebook)
+
+        OUTPUTS:
+        out (df): one row per baseline warfarin patient and year, with the columns of #out
+        '''
+        d = dict(zip(PERIODS, _days(dates)))
+        out = []
+        for year in ("2019", "2020"):
+            out.append(self._switching_year(year, d))
+        return pd.concat(out, ignore_index=True)
+
+    def _windows(self, days, year, d):
+        '''Rows in the baseline and follow-up windows of a year, with the year assigned as the SQL CASEs do'''
+        base_2020 = (days >= d["b_start_2020"]) & (days < d["b_end_2020"])
+        base = base_2020 | ((days >= d["b_start_2019"]) & (days < d["b_end_2019"]))
+        fu_2020 = (days >= d["b_end_2020"]) & (days <= d["f_end_2020"])
+        fu = fu_2020 | ((days >= d["b_end_2019"]) & (days <= d["f_end_2019"]))
+        if year == "2020":
+            return base_2020, fu_2020
+        return base & ~base_2020, fu & ~fu_2020
+
+    def _switching_year(self, year, d):
+        patient, days, doac = self.issue_patient, self.issue_date, self.issue_doac
+        base, fu = self._windows(days, year, d)
+
+        # baseline warfarin patients (#baseline), excluding any who also had a DOAC in the baseline period
+        ids, _, last = _runs(patient, base & ~doac)
+        excluded = _lookup(_runs(patient, base & doac)[0], ids)[1]
+        ids, latest = ids[~excluded], days[last[~excluded]]
+
+        # first DOAC (and its type) in follow-up (#doac, #doac_type_b), latest warfarin in follow-up (#warf2)
+        doac_ids, doac_first, _ = _runs(patient, fu & doac)
+        pos, switched = _lookup(doac_ids, ids)
+        doac_start = np.where(switched, days[doac_first[pos]], np.datetime64("NaT"))
+        first_type = np.where(switched, self.drugs[self.issue_drug[doac_first[pos]]], None)
+        warf_ids, _, warf_last = _runs(patient, fu & ~doac)
+        pos, continued = _lookup(warf_ids, ids)
+        warf_latest = np.where(continued, days[warf_last[pos]], np.datetime64("NaT"))
+
+        # INR tests (and whether any was high) and TTRs in follow-up (#inr)
+        e_fu = self._windows(self.event_date, year, d)[1]
+        had_inr = _lookup(_runs(self.event_patient, e_fu & self.event_inr)[0], ids)[1]
+        had_high = _lookup(_runs(self.event_patient, e_fu & self.event_inr & (self.event_value >= 8))[0], ids)[1]
+        had_ttr = _lookup(_runs(self.event_patient, e_fu & self.event_ttr)[0], ids)[1]
+
+        continued_only = continued & ~switched
+        return pd.DataFrame({
+            "Patient_ID": ids,
+            "year": year,
+            "WarfLatestIssue": pd.to_datetime(latest),
+            "continued_warfarin_flag": continued_only.astype(int),
+            "switch_flag": switched.astype(int),
+            "switch_back_flag": (continued & switched & (warf_latest > doac_start)).astype(int),
+            "doacStartmonth": pd.to_datetime(doac_start.astype("datetime64[M]")),
+            "inr_flag": had_inr.astype(int),
+            "ttr_flag": had_ttr.astype(int),
+            "continued_warfarin_had_inr": (continued_only & had_inr).astype(int),
+            "continued_warfarin_had_high_inr": (continued_only & had_high).astype(int),
+            "continued_warfarin_had_ttr": (continued_only & had_ttr).astype(int),
+            "first_doac_type": first_type,
+        })
+
+    ##### switching over any number of baseline/follow-up windows ########
+
+    def switching_windows(self, windows):
+        '''
+        Baseline warfarin patients and their switching and testing flags (as `switching`) for every window at once.
+        Each window is on its own: unlike the two years of `switching`, windows may overlap (e.g. rolling windows).
+
+        Rather than masking the issues once per window, each table is sorted once by a packed (patient, day) key.
+        The candidates are the patients with a warfarin issue in each baseline. For every candidate and window, the
+        earliest or latest issue (or whether there is one) between two dates is then found by binary search.
+
+        INPUTS:
+        windows (df): window (label), b_start, b_end and f_end of each window (see `rolling_windows`); the baseline
+                      is from b_start up to b_end, the follow-up from b_end to f_end inclusive
+
+        OUTPUTS:
+        out (df): one row per baseline warfarin patient and window, with the columns of `switching` (window in place
+                  of year)
+        '''
+        labels = windows["window"].values
+        b_start, b_end, f_end = (_days(windows[c]).astype(np.int64) for c in ("b_start", "b_end", "f_end"))
+        patient, days, doac = self.issue_patient, self.issue_date, self.issue_doac
+        ids = _runs(patient, np.ones(len(patient), dtype=bool))[0]
+
+        # packed keys: patient rank * span + day, so keys sort by patient then day
+        dated = ~np.isnat(days)
+        e_dated = ~np.isnat(self.event_date)
+        day, e_day = days.astype(np.int64), self.event_date.astype(np.int64)
+        known = np.concatenate([day[dated], e_day[e_dated], b_start, f_end])
+        lo, span = known.min(), known.max() - known.min() + 2
+        key = np.searchsorted(ids, patient) * span + day - lo
+        warf_rows, doac_rows = np.flatnonzero(dated & ~doac), np.flatnonzero(dated & doac)
+        k_warf, k_doac = key[warf_rows], key[doac_rows]
+        e_rank, e_found = _lookup(ids, self.event_patient)
+        e_key = e_rank * span + e_day - lo
+        e_known = e_found & e_dated
+
+        def keys(mask):
+            return e_key[e_known & mask]
+
+        k_inr, k_ttr = keys(self.event_inr), keys(self.event_ttr)
+        k_high = keys(self.event_inr & (self.event_value >= 8))
+
+        # candidates: patients with a warfarin issue in each baseline (found from the warfarin issues ordered by day)
+        by_day = np.argsort(day[warf_rows], kind="stable")
+        sorted_days = day[warf_rows][by_day]
+        first, last = np.searchsorted(sorted_days, b_start), np.searchsorted(sorted_days, b_end)
+        n = last - first
+        rows = by_day[np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(first, n)]
+        # packed as rank * windows + window, so candidates are ordered by patient and the searches below go through
+        # the keys in order
+        count = max(len(labels), 1)
+        pairs = np.sort(np.searchsorted(ids, patient[warf_rows[rows]]) * count + np.repeat(np.arange(len(labels)), n))
+        pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])] if len(pairs) else pairs
+        rank, w = pairs // count, pairs % count
+        base = rank * span - lo
+
+        def any_between(k, start, end):
+            '''Whether each candidate has a key from day start up to (not including) day end'''
+            return np.searchsorted(k, base + end) > np.searchsorted(k, base + start)
+
+        # baseline warfarin patients (#baseline), excluding any who also had a DOAC in the baseline period
+        keep = ~any_between(k_doac, b_start[w], b_end[w])
+        w, rank, base = w[keep], rank[keep], base[keep]
+        latest = k_warf[np.searchsorted(k_warf, base + b_end[w]) - 1] - base
+
+        # first DOAC (the lowest drug ID, on its first day) and latest warfarin in follow-up
+        pos = np.searchsorted(k_doac, base + b_end[w])
+        switched = pos < len(k_doac)
+        switched[switched] = k_doac[pos[switched]] <= base[switched] + f_end[w][switched]
+        pos = np.where(switched, pos, 0)
+        doac_start = np.where(switched, k_doac[pos] - base, 0).astype("datetime64[D]")
+        doac_start[~switched] = np.datetime64("NaT")
+        first_type = np.where(switched, self.drugs[self.issue_drug[doac_rows[pos]]] if len(doac_rows) else None, None)
+        pos = np.searchsorted(k_warf, base + f_end[w], "right") - 1
+        continued = k_warf[pos] >= base + b_end[w]
+        warf_latest = k_warf[pos] - base
+
+        # INR tests (and whether any was high) and TTRs in follow-up
+        had_inr = any_between(k_inr, b_end[w], f_end[w] + 1)
+        had_high = any_between(k_high, b_end[w], f_end[w] + 1)
+        had_ttr = any_between(k_ttr, b_end[w], f_end[w] + 1)
+
+        continued_only = continued & ~switched
+        out = pd.DataFrame({
+            "Patient_ID": ids[rank],
+            "window": labels[w],
+            "WarfLatestIssue": pd.to_datetime(latest.astype("datetime64[D]")),
+            "continued_warfarin_flag": continued_only.astype(int),
+            "switch_flag": switched.astype(int),
+            "switch_back_flag": (continued & switched & (warf_latest > doac_start.astype(np.int64))).astype(int),
+            "doacStartmonth": pd.to_datetime(doac_start.astype("datetime64[M]")),
+            "inr_flag": had_inr.astype(int),
+            "ttr_flag": had_ttr.astype(int),
+            "continued_warfarin_had_inr": (continued_only & had_inr).astype(int),
+            "continued_warfarin_had_high_inr": (continued_only & had_high).astype(int),
+            "continued_warfarin_had_ttr": (continued_only & had_ttr).astype(int),
+            "first_doac_type": first_type,
+        })
+        return out.iloc[np.argsort(w, kind="stable")].reset_index(drop=True)
+
+    ##### repeats active in each month a patient was issued an anticoagulant ########
+
+    def repeats(self, start, today=None):
+        '''
+        For each patient and month with an anticoagulant issued, whether they had DOAC and warfarin repeats covering the
+        month, and whether a warfarin and a DOAC repeat covering it started on the same date (and whether one of those
+        was cancelled - ended the day it started). These are the flags of `repeats/results`, but with exactly one row
+        per patient and month: the SQL joins every repeat covering a month, so a patient with several is counted more
+        than once in `repeats/summary`.
+
+        Rather than pairing months with repeats, each is swept once: repeats are intervals of months, and a month is
+        covered if more intervals of the patient have opened by it than closed before it.
+
+        INPUTS:
+        start (str): first month (the `start` of repeats/temp and repeats/rpts2)
+        today (date): date of the run; only issues before the current month are counted
+
+        OUTPUTS:
+        out (df): Patient_ID, issuemonth and the flags (0/1) for each patient and month
+        '''
+        start = _days([start])[0]
+        current = _current_month(today)
+
+        # #temp: patient-months with an anticoagulant issued
+        rows = np.flatnonzero((self.issue_date >= start) & (self.issue_date < current))
+        patients = np.unique(np.concatenate([self.issue_patient[rows], self.repeat_patient]))
+        points = np.unique(np.searchsorted(patients, self.issue_patient[rows]) * MONTHS
+                           + _month_keys(self.issue_date[rows]))
+
+        # #rpts2: repeats as intervals of months (any ending before they start can't cover a month)
+        rank = np.searchsorted(patients, self.repeat_patient) * MONTHS
+        first, last = _month_keys(self.repeat_start), _month_keys(self.repeat_end)
+        valid = (self.repeat_end >= start) & (last >= first)
+        doac = self.repeat_doac
+        flags = {"doac_repeat": _covered(rank[valid & doac] + first[valid & doac],
+                                         rank[valid & doac] + last[valid & doac], points),
+                 "warf_repeat": _covered(rank[valid & ~doac] + first[valid & ~doac],
+                                         rank[valid & ~doac] + last[valid & ~doac], points)}
+
+        # repeats started on the same date: a warfarin and a DOAC repeat both cover the months from their start until
+        # the earlier of their ends, so together all the pairs starting on a date cover the months until the earlier
+        # of the latest DOAC and latest warfarin ends. A cancelled repeat only covers its start month
+        rows = np.flatnonzero(valid)
+        same = np.zeros(len(points), dtype=bool)
+        warf_cancelled, doac_cancelled = same.copy(), same.copy()
+        if len(rows) > 0:
+            new = np.ones(len(rows), dtype=bool)
+            new[1:] = ((self.repeat_patient[rows][1:] != self.repeat_patient[rows][:-1])
+                       | (self.repeat_start[rows][1:] != self.repeat_start[rows][:-1]))
+            groups = np.flatnonzero(new)
+            cancelled = self.repeat_end[rows] == self.repeat_start[rows]
+
+            def latest(mask):
+                return np.maximum.reduceat(np.where(mask, last[rows], -1), groups)
+
+            doac_last, warf_last = latest(doac[rows]), latest(~doac[rows])
+            any_doac_cancelled = latest(doac[rows] & cancelled) >= 0
+            any_warf_cancelled = latest(~doac[rows] & cancelled) >= 0
+            opened = (rank + first)[rows][groups]
+            both = (doac_last >= 0) & (warf_last >= 0)
+            # packed key of the last month each date's pairs cover
+            closed = opened - first[rows][groups] + np.minimum(doac_last, warf_last)
+            same = _covered(opened[both], closed[both], points)
+            warf_cancelled = _covered(opened[both & any_warf_cancelled], opened[both & any_warf_cancelled], points)
+            doac_cancelled = _covered(opened[both & any_doac_cancelled], opened[both & any_doac_cancelled], points)
+        flags["started_same_date"] = same
+        flags["started_same_date_warf_cancelled"] = warf_cancelled
+        flags["started_same_date_doac_cancelled"] = doac_cancelled
+
+        out = pd.DataFrame({"Patient_ID": patients[points // MONTHS], "issuemonth": _months(points % MONTHS)})
+        for name, flag in flags.items():
+            out[name] = flag.astype(int)
+        return out
+
+    ##### DOAC repeats initiated per month, and of whom, how many switched from warfarin ########
+
+    def doac_repeats(self, start, warfdoac_start=None, today=None):
+        '''
+        New DOAC repeats per patient and month, flagged as switches from warfarin and as new to DOACs, as built by
+        `doac_repeats/out`.
+
+        INPUTS:
+        start (str): first month of DOAC repeats (the `start` of doac_repeats/doacR)
+        warfdoac_start (str): earliest end date of previous repeats (the `start` of doac_repeats/warfdoac); by default
+                              7 months before `start`, as in the notebook
+        today (date): date of the run; only repeats started before the current month are counted
+
+        OUTPUTS:
+        out (df): Patient_ID, doacStartmonth, switch_flag and new_flag for each patient starting a DOAC repeat
+        '''
+        if warfdoac_start is None:
+            warfdoac_start = (_days([start])[0].astype("datetime64[M]") - 7).astype("datetime64[D]")
+        gaps = self.doac_repeat_gaps(start, 3, warfdoac_start, today)
+        return pd.DataFrame({
+            "Patient_ID": gaps["Patient_ID"],
+            "doacStartmonth": gaps["doacStartmonth"],
+            # within the DOAC start month and the 3 before it, as the BETWEEN joins on month keys
+            "switch_flag": (gaps["warfarin_gap"] <= 3).astype(int),
+            "new_flag": (gaps["doac_gap"] > 3).astype(int),
+        })
+
+    def doac_repeat_gaps(self, start, max_gap=12, warfdoac_start=None, today=None):
+        '''
+        For each patient and month starting a DOAC repeat, the months since the latest warfarin repeat ended, and since
+        the latest previous DOAC repeat ended (not counting repeats which started on the same date as the new one).
+
+        INPUTS:
+        start (str): first month of DOAC repeats
+        max_gap (int): longest gap to look back over
+        warfdoac_start (str): earliest end date of previous repeats (by default `max_gap` months before `start`, the
+                              earliest any gap can reach)
+        today (date): date of the run; only repeats started before the current month are counted
+
+        OUTPUTS:
+        gaps (df): Patient_ID, doacStartmonth, warfarin_gap and doac_gap (0 if a repeat ended in the start month itself,
+                   and max_gap + 1 if none ended within max_gap months)
+        '''
+        start = _days([start])[0]
+        if warfdoac_start is None:
+            warfdoac_start = (start.astype("datetime64[M]") - max_gap).astype("datetime64[D]")
+        else:
+            warfdoac_start = _days([warfdoac_start])[0]
+        current = _current_month(today)
+
+        patient, starts, ends, doac = self.repeat_patient, self.repeat_start, self.repeat_end, self.repeat_doac
+        ranks = np.unique(patient, return_inverse=True)[1].reshape(-1)
+
+        # #doacR: latest DOAC repeat start per patient and start month (rows are sorted by start within patient)
+        rows = np.flatnonzero(doac & (starts >= start) & (starts < current))
+        key = ranks[rows] * MONTHS + _month_keys(starts[rows])
+        end = np.ones(len(rows), dtype=bool)
+        end[:-1] = key[1:] != key[:-1]
+        doac_key, latest_start, doac_patient = key[end], starts[rows[end]], patient[rows[end]]
+
+        # #warfdoac: earliest start of repeats ending in each month, per patient and drug class
+        def ending(cls):
+            rows = np.flatnonzero((doac == cls) & (ends >= warfdoac_start) & (starts < current))
+            key = ranks[rows] * MONTHS + _month_keys(ends[rows])
+            order = np.lexsort((starts[rows], key))
+            key, rows = key[order], rows[order]
+            new = np.ones(len(rows), dtype=bool)
+            new[1:] = key[1:] != key[:-1]
+            return key[new], starts[rows[new]]
+
+        warf_keys, _ = ending(False)
+        prev_keys, prev_start = ending(True)
+
+        # look back from the furthest month to the start month itself, so the nearest month found is kept
+        warf_gap = np.full(len(doac_key), max_gap + 1)
+        doac_gap = warf_gap.copy()
+        for back in range(max_gap, -1, -1):
+            warf_gap[_lookup(warf_keys, doac_key - back)[1]] = back
+            pos, found = _lookup(prev_keys, doac_key - back)
+            doac_gap[found & (prev_start[pos] != latest_start)] = back
+
+        return pd.DataFrame({
+            "Patient_ID": doac_patient,
+            "doacStartmonth": _months(doac_key % MONTHS),
+            "warfarin_gap": warf_gap,
+            "doac_gap": doac_gap,
+        })
+
+    def doac_repeats_sweep(self, start, graces=range(13), new_graces=None, today=None):
+        '''
+        Patients starting a new DOAC repeat each month, split by whether they were previously taking warfarin (the
+        series of `doac_repeats.csv`), for a whole grid of grace periods at once.
+
+        The gaps to each patient's previous warfarin and DOAC repeats are found once (`doac_repeat_gaps`). For each
+        month, the counts of DOAC starts by (warfarin gap, DOAC gap) are summed cumulatively over both gaps. The count
+        for any grace period is then a difference of these cumulative counts, with no pass over the patients.
+
+        INPUTS:
+        start (str): first month of DOAC repeats
+        graces (list): grace periods, in months, for counting a DOAC start as a switch from warfarin (3 in
+                       `doac_repeats/out`)
+        new_graces (list): grace periods for counting a DOAC start as new (no DOAC repeat ending within it); by
+                           default each equals the switch grace period, otherwise every combination is counted
+        today (date): date of the run; only repeats started before the current month are counted
+
+        OUTPUTS:
+        sweep (df): switch_grace, new_grace, doacStartmonth and the "not previously taking warfarin", "previously
+                    taking warfarin" and "total" columns of `doac_repeats.csv`
+        '''
+        graces = list(graces)
+        pairs = [(g, g) for g in graces] if new_graces is None else [(g, n) for g in graces for n in new_graces]
+        top = max(max(p) for p in pairs) + 1
+        gaps = self.doac_repeat_gaps(start, top - 1, today=today)
+
+        # counts[m, a, b]: DOAC starts in month m with a warfarin gap of at most a and a DOAC gap of at most b
+        months, month = np.unique(gaps["doacStartmonth"].values, return_inverse=True)
+        cell = (month.reshape(-1) * (top + 1) + gaps["warfarin_gap"].values) * (top + 1) + gaps["doac_gap"].values
+        counts = np.bincount(cell, minlength=len(months) * (top + 1)**2).reshape(len(months), top + 1, top + 1)
+        counts = counts.cumsum(axis=1).cumsum(axis=2)
+
+        out = []
+        for g, n in pairs:
+            # new: no DOAC repeat ended within n months (DOAC gap > n); previously taking warfarin: warfarin gap <= g
+            new = counts[:, top, top] - counts[:, top, n]
+            switched = counts[:, g, top] - counts[:, g, n]
+            out.append(pd.DataFrame({"switch_grace": g, "new_grace": n, "doacStartmonth": months,
+                                     "not previously taking warfarin": new - switched,
+                                     "previously taking warfarin": switched, "total": new}))
+        return pd.concat(out, ignore_index=True)
+
+
+##### windows for switching_windows ########
+
+def rolling_windows(first, last, baseline=3, followup=3, step=1):
+    '''
+    Windows of a fixed length starting every `step` months, labelled by the month their follow-up starts.
+
+    INPUTS:
+    first (str): first month of the first baseline
+    last (str): first month of the last baseline
+    baseline (int): months of baseline
+    followup (int): months of follow-up
+    step (int): months between the starts of consecutive windows
+
+    OUTPUTS:
+    windows (df): window, b_start, b_end and f_end of each window
+    '''
+    starts = pd.date_range(pd.Timestamp(first).to_period("M").to_timestamp(), last, freq=pd.DateOffset(months=step))
+    b_end = starts + pd.DateOffset(months=baseline)
+    return pd.DataFrame({"window": b_end.strftime("%Y-%m"), "b_start": starts, "b_end": b_end,
+                         "f_end": b_end + pd.DateOffset(months=followup) - pd.Timedelta(days=1)})
+
+
+def period_windows(dates, label):
+    '''
+    The two windows of a list of notebook dates (e.g. `dates1`), labelled e.g. "March-May 2020" and "March-May 2019".
+
+    INPUTS:
+    dates (list): b_start_2020, b_end_2020, f_end_2020, b_start_2019, b_end_2019, f_end_2019
+    label (str): label of the period
+    '''
+    d = dict(zip(PERIODS, pd.to_datetime(dates)))
+    return pd.DataFrame([{"window": f"{label} {year}", "b_start": d[f"b_start_{year}"], "b_end": d[f"b_end_{year}"],
+                          "f_end": d[f"f_end_{year}"]} for year in ("2020", "2019")])
+
+
+##### summaries, as the SQL summary templates ########
+
+def switching_summary(out):
+    '''Counts of baseline warfarin patients, switching and testing for each year (as `switching/summary`)'''
+    flags = ["continued_warfarin_flag", "switch_flag", "switch_back_flag", "inr_flag", "ttr_flag",
+             "continued_warfarin_had_inr", "continued_warfarin_had_high_inr", "continued_warfarin_had_ttr"]
+    summary = out.groupby("year").agg(baseline_warfarin_patients=("Patient_ID", "nunique"),
+                                      **{f: (f, "sum") for f in flags})
+    summary = summary.rename(columns={"inr_flag": "inr_count", "ttr_flag": "ttr_count"})
+    cols = ["baseline_warfarin_patients", "continued_warfarin_flag", "switch_flag", "switch_back_flag", "inr_count",
+            "ttr_count", "continued_warfarin_had_inr", "continued_warfarin_had_high_inr", "continued_warfarin_had_ttr"]
+    return summary[cols].reset_index()
+
+
+def doac_types(out):
+    '''Patients switching to each first DOAC type, for each year (as `switching/doac_types`)'''
+    switched = out[out["switch_flag"] == 1]
+    return (switched.groupby(["first_doac_type", "year"])["Patient_ID"].nunique()
+            .rename("patient_count").reset_index())
+
+
+def repeats_summary(out):
+    '''
+    Patients issued an anticoagulant each month, and of whom how many had each kind of repeat (the columns of
+    `repeats/summary`, but counting each patient once)
+    '''
+    flags = ["doac_repeat", "warf_repeat", "started_same_date", "started_same_date_warf_cancelled",
+             "started_same_date_doac_cancelled"]
+    summary = out.groupby("issuemonth").agg(total_patients=("Patient_ID", "nunique"), **{f: (f, "sum") for f in flags})
+    summary = summary.rename(columns={"started_same_date_warf_cancelled": "warfarin_cancelled",
+                                      "started_same_date_doac_cancelled": "doac_cancelled"})
+    return summary.reset_index()
+
+
+def doac_repeats_summary(out):
+    '''Patients starting a DOAC repeat each month, by switch and new flags (as `doac_repeats/summary`)'''
+    return (out.groupby(["doacStartmonth", "switch_flag", "new_flag"])["Patient_ID"].nunique()
+            .rename("patient_count").reset_index())
+
+
+def windows_summary(out, windows):
+    '''
+    Counts of baseline warfarin patients, switching and testing (as `switching_summary`), and of switchers to each
+    first DOAC type (as `doac_types`), for every window, as one long table.
+
+    INPUTS:
+    out (df): from `Timelines.switching_windows`
+    windows (df): the windows it was given
+
+    OUTPUTS:
+    summary (df): window, b_start, b_end, f_end, measure (a column of `switching_summary`, or "switch_to_type"),
+                  first_doac_type (for "switch_to_type" only) and patient_count; windows with no baseline patients
+                  are included, with counts of 0
+    '''
+    flags = ["continued_warfarin_flag", "switch_flag", "switch_back_flag", "inr_flag", "ttr_flag",
+             "continued_warfarin_had_inr", "continued_warfarin_had_high_inr", "continued_warfarin_had_ttr"]
+    counts = out.groupby("window").agg(baseline_warfarin_patients=("Patient_ID", "nunique"),
+                                       **{f: (f, "sum") for f in flags})
+    counts = counts.rename(columns={"inr_flag": "inr_count", "ttr_flag": "ttr_count"})
+    counts = counts.reindex(windows["window"], fill_value=0).reset_index()
+    overall = counts.melt(id_vars="window", var_name="measure", value_name="patient_count")
+    switched = out[out["switch_flag"] == 1]
+    types = (switched.groupby(["window", "first_doac_type"])["Patient_ID"].nunique()
+             .rename("patient_count").reset_index().assign(measure="switch_to_type"))
+    summary = pd.concat([overall, types], ignore_index=True)
+    order = {w: i for i, w in enumerate(windows["window"])}
+    # in the order the windows were given (`sort_values(key=...)` needs pandas 1.1)
+    summary = summary.assign(_order=summary["window"].map(order)).sort_values(["_order", "measure"])
+    summary = windows.merge(summary.drop(columns="_order"), on="window")
+    return summary[["window", "b_start", "b_end", "f_end", "measure", "first_doac_type", "patient_count"]]
@@ -22,35 +22,25 @@ import numpy as np
 import os
 from ebmdatalab import bq, maps, charts
 
+# import custom functions from 'lib' folder
+import sys
+sys.path.append('../lib/')
+from sections import DOAC_PRICES, doac_costs, costings
+
 # ## Calculate DOAC annual cost
 
-#create dataframe for DOAC costings
-doacs = {'chemical': ['Edoxaban','Apixaban','Rivaroxaban','Dabigatran etexilate'],
-         'cost_per_pack': [49,53.2,50.4,51],
-         'pack_size': [28,56,28,60],
-         'daily_doses': [1,2,1,2],
-        }
-df = pd.DataFrame(doacs) #create dataframe
+#DOAC prices (DOAC_PRICES in lib/sections.py, shared with the costings stage of lib/pipeline.py)
+DOAC_PRICES
 
 #get proportion data from output from DOACs notebook
-doac_df = pd.read_csv(os.path.join('..','output','doac_types.csv'))
-#filter to use proportion of switching from March-May 2020
-doac_df=doac_df.loc[(doac_df['year']==2020) & (doac_df['period']=='March-May')]
-doac_df=doac_df.drop(['period', 'year'], axis=1)
-
-doac_df.head()
-
-doac_df = pd.merge(df,doac_df)
+doac_types = pd.read_csv(os.path.join('..','output','doac_types.csv'))
 
+#calculate annualised cost, using proportion of switching from March-May 2020
+#first, calculate annual cost, including adjustment for actual cost (7.11% average reduction), then the proportional
+#cost for each DOAC, based on the proportion of uptake
+doac_df = doac_costs(doac_types)
 doac_df.head()
 
-#calculate annualised cost
-#first, calculate annual cost, including adjustment for actual cost (7.11% average reduction)
-doac_df['annual_net_cost'] = 365 * 0.9289 *(doac_df['cost_per_pack']/(doac_df['pack_size']/doac_df['daily_doses']))
-#create proportional cost for each DOAC, based on the proportion of uptake
-doac_df['proportion_cost'] = doac_df['annual_net_cost']*(doac_df['%']/100)
-#df.head()
-
 #create DOAC cost by summing DOAC proportion weighting costs
 doac_cost = doac_df['proportion_cost'].sum(axis=0)
 
@@ -98,19 +88,6 @@ switch_doac_df=switch_df.loc[(switch_df['year']==2020) & (switch_df['period']=='
 
 switch_doac_df.head()
 
-print("Annual average actual cost of DOACs per patient: " + "£{:,.2f}".format(noac_cost))#cost_per_patient for warfarin
-warfarin_pts = 1000* switch_doac_df['baseline warfarin patients (thousands)'].sum(axis=0) #from DOAC switch df
-#calculate annual costs by multiplying by 4
-warf_cost_per_patient = 4 * warf_cost/warfarin_pts
-print("Annual cost per warfarin patient: " + "£{:,.2f}".format(warf_cost_per_patient))
-#estimated cost difference between NOAC and warfarin
-doac_diff =noac_cost - warf_cost_per_patient
-print("Annual drug cost difference per patient from switch from warfarin to DOAC: ""£{:,.2f}".format(doac_diff))
-#switch costs for TPP population
-switched_pts = 1000* switch_doac_df['switched (thousands)'].sum(axis=0) # from DOAC switch df
-print("Number of patients switched: " + str(switched_pts))
-tpp_switch_costs = switched_pts * doac_diff
-print("Estimated annual cost difference for switch from warfarin to DOAC in TPP practices: " + "£{:,.2f}".format(tpp_switch_costs))
 #calculate proportion of patients at TPP practice (as per December 2018)
 #use BQ to get list size (as per December 2018)
 sql='''
@@ -127,11 +104,12 @@ where
 stats.month = '2018-12-01' # latest available date
 '''
 tpp_df = bq.cached_read(sql, csv_path=os.path.join('..','output','tpp_df.csv'))
-#calculate TPP proportion
-prop_tpp = tpp_df['tpp_list_size'].sum(axis=0)/tpp_df['list_size'].sum(axis=0)
-print("Proportion of patients in England registered at TPP practice: " + "{:.2%}".format(prop_tpp))
-#Using percentage TPP coverage, national costs:
-national_switch_costs = (tpp_switch_costs/prop_tpp)
-print("Estimated annual cost different for switch from warfarin to DOAC in England: " + "£{:,.2f}".format(national_switch_costs))
-
-
+#calculate switch costs for TPP population, and nationally using percentage TPP coverage (as the costings stage of
+#lib/pipeline.py does)
+costs = costings(doac_types, switch_df, warf_df, tpp_df)
+print("Annual cost per warfarin patient: " + "£{:,.2f}".format(costs['warfarin_annual_cost_per_patient']))
+print("Annual drug cost difference per patient from switch from warfarin to DOAC: ""£{:,.2f}".format(costs['annual_cost_difference_per_patient']))
+print("Number of patients switched: " + str(costs['switched_patients']))
+print("Estimated annual cost difference for switch from warfarin to DOAC in TPP practices: " + "£{:,.2f}".format(costs['tpp_annual_switch_costs']))
+print("Proportion of patients in England registered at TPP practice: " + "{:.2%}".format(costs['tpp_proportion']))
+print("Estimated annual cost different for switch from warfarin to DOAC in England: " + "£{:,.2f}".format(costs['national_annual_switch_costs']))
@@ -26,8 +26,11 @@ import numpy as np
 # import custom functions from 'lib' folder
 import sys
 sys.path.append('../lib/')
-from functions import plot_line_chart
+from figures import chart, render
 
+# charts are collected as each section's data is prepared, and rendered together at the end (in parallel, skipping
+# any whose data and spec haven't changed since their files in output/ were drawn)
+charts = []
 # -
 
 
@@ -41,7 +44,7 @@ out1 = out1.set_index('Startmonth')
 # plot chart
 titles = ["Warfarin and DOAC prescriptions issued"]
 figname = "warf_doac_issues"
-plot_line_chart([out1], titles, filename=figname)
+charts.append(chart(figname, [out1], titles))
 
     
 # patients having both Warfarin and DOAC prescriptions issued on the same day (displayed later)  
@@ -62,8 +65,8 @@ dfp = out[["total_patients","doac_repeat","warf_repeat"]]
     
 display(Markdown(f"## Patients with an anticoagulant issued each month, and of whom, how many were on a warfarin or DOAC repeat prescription"))
 titles = ["Toal patients with an anticoagulant issued each month, and\n total warfarin & DOAC repeat prescriptions issued"]
-figname = "warf_doac_repeats.png"
-plot_line_chart([dfp], titles, filename=figname, ylabels={0:"Number of patients/repeat prescriptions"})
+figname = "warf_doac_repeats"
+charts.append(chart(figname, [dfp], titles, ylabels={0:"Number of patients/repeat prescriptions"}))
 # -
 # # Prescriptions issued on same day, and Repeats initiated on same day
 
@@ -80,7 +83,7 @@ titles = ["(a) Patients having both Warfarin and DOAC prescriptions\n issued on
  
 dfs = [dfp1, dfp2]
 figname = "same_day"
-plot_line_chart(dfs, titles, filename=figname, loc="upper left")
+charts.append(chart(figname, dfs, titles, loc="upper left"))
 # -
 
 # ## Patients starting a DOAC repeat per month, and of whom, how many switched from Warfarin
@@ -93,7 +96,7 @@ dfp3 = dfp3.set_index('doacStartmonth')
 
 titles = ["Patients with a new DOAC repeat prescription initiated, per month"]
 figname = "doac_repeat"
-plot_line_chart([dfp3], titles, filename=figname,  loc='upper left')
+charts.append(chart(figname, [dfp3], titles, loc='upper left'))
 
 
 # -
@@ -104,7 +107,7 @@ titles = ["(a) Patients having both Warfarin and DOAC prescriptions\n issued on
           "(b) Patients who had both a warfarin and DOAC\n repeat prescription initiated on the same day\n(and at least one prescription issued in month)",
           "(c) Patients with a new DOAC repeat prescription initiated, per month"]
 figname = "same_day2" 
-plot_line_chart(dfs, titles, filename=figname,  loc="upper left")
+charts.append(chart(figname, dfs, titles, loc="upper left"))
 
 # ## Extract patients on Warfarin during baseline and count how many switched to DOAC
 
@@ -129,8 +132,8 @@ dfp4["No of INRs"] = 1000*dfp4["test_count"]/dfp4["denominator"]
 
 titles = ["(a) Number of patients with an INR test per month, and\n number of INRs, per thousand patients on Warfarin"]
 
-plot_line_chart([dfp4[["No of patients with INR","No of INRs"]]], titles, 
-                ylabels={0:"Rate per 1000"}, filename="fig4a")
+charts.append(chart("fig4a", [dfp4[["No of patients with INR","No of INRs"]]], titles, 
+                    ylabels={0:"Rate per 1000"}))
 
 # +
 dfp5 = pd.read_csv(os.path.join("..","output","high_inr.csv"),index_col=0)
@@ -161,11 +164,20 @@ dfp7[">=8 per 1000 pts tested"] = 1000*dfp7["patient_count_equal_greater_8"]/dfp
 
 figname = "high_inr"
 titles = [r'(d) Monthly rate of high INRs $(>8 / \geq 8)$ recorded in warfarin patients']
-plot_line_chart([dfp7[[">8 per 1000 warfarin pts", ">=8 per 1000 warfarin pts",
-                       ">8 per 1000 pts tested", ">=8 per 1000 pts tested"]]],
-                titles,  loc="upper left",
-                ylabels={0:"Number of High INRs per 1000 patients"}, 
-                filename=figname)
+charts.append(chart(figname, [dfp7[[">8 per 1000 warfarin pts", ">=8 per 1000 warfarin pts",
+                                  ">8 per 1000 pts tested", ">=8 per 1000 pts tested"]]],
+                    titles,  loc="upper left",
+                    ylabels={0:"Number of High INRs per 1000 patients"}))
 # -
 
+# # Render charts
 
+# +
+# draw the charts (to output/) in a pool of processes, skipping any which are unchanged
+results = render(charts)
+display(results)
+
+from IPython.display import Image
+for c in charts:
+    display(Image(filename=os.path.join("..","output",f"{c['filename']}.png")))
+# -
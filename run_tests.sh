@@ -3,6 +3,9 @@
 # A python warning filter.  For this one, see #20
 WARNING_FILTER="ignore:KernelManager._kernel_spec_manager_changed:DeprecationWarning"
 
+# Unit tests of the modules in lib/
+python -m pytest tests -W $WARNING_FILTER || exit $?
+
 # This awkward testing of exit codes is to get around the case where
 # no tests are found, which has exit code of 5 in pytest, but we don't
 # want to treat as a failure
@@ -0,0 +1,39 @@
+'''
+Shared fixtures. The modules in lib/ are imported as the notebooks import them, from the lib folder on the path.
+Tests comparing the in-memory engines with the SQL run it against a small simulated DuckDB database (see `local.py`
+and `simulate.py`), and are skipped where duckdb isn't installed.
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+# patients simulated for the SQL parity tests: enough for every switching flag and DOAC type to be counted
+PATIENTS = 3000
+
+
+@pytest.fixture(scope="session")
+def staged(tmp_path_factory):
+    '''A session on a simulated database, with the codelists loaded and the prescriptions staged'''
+    pytest.importorskip("duckdb")
+    import simulate
+    from db import DbSession
+    from benchmark import _codelists
+    from staging import stage
+
+    dbconn = "duckdb:" + str(tmp_path_factory.mktemp("simulated") / "test.duckdb")
+    simulate.load(dbconn, simulate.simulate(patients=PATIENTS, seed=1))
+    connection = DbSession(dbconn, name="tests")
+    _codelists(connection, {})
+    stage(connection)
+    yield connection
+    connection.close()
+
+
+@pytest.fixture(scope="session")
+def timelines(staged):
+    '''Timelines extracted from the staged tables'''
+    from timelines import Timelines
+    return Timelines.extract(staged)
@@ -0,0 +1,40 @@
+'''Bitmap set operations give the same patients as the NumPy set functions'''
+import numpy as np
+import pytest
+
+from cohorts import Bitmap, ARRAY_MAX, CHUNK
+
+
+def _ids(rng, n, dense_chunks=()):
+    '''Random patient IDs across several chunks, with every ID in the chunks given (so they are held as bitmaps)'''
+    ids = [rng.integers(0, 8*CHUNK, n)]
+    ids += [np.arange(k*CHUNK, (k + 1)*CHUNK, 2) for k in dense_chunks]
+    return np.concatenate(ids)
+
+
+@pytest.mark.parametrize("dense", [(), (1,), (1, 3)])
+def test_set_operations(dense):
+    rng = np.random.default_rng(1)
+    a, b = _ids(rng, 20000, dense), _ids(rng, 20000, dense[:1])
+    x, y = Bitmap.from_ids(a), Bitmap.from_ids(b)
+
+    np.testing.assert_array_equal(x.to_array(), np.unique(a))
+    np.testing.assert_array_equal((x & y).to_array(), np.intersect1d(a, b))
+    np.testing.assert_array_equal((x | y).to_array(), np.union1d(a, b))
+    np.testing.assert_array_equal((x - y).to_array(), np.setdiff1d(a, b))
+    np.testing.assert_array_equal((y - x).to_array(), np.setdiff1d(b, a))
+    assert len(x & y) == len(np.intersect1d(a, b))
+    assert x | y == Bitmap.union(y, x)
+
+
+def test_array_and_bitmap_containers():
+    '''A chunk becomes a bitmap past ARRAY_MAX patients, and combines with array chunks either way round'''
+    sparse = np.arange(0, CHUNK, CHUNK // 100)
+    dense = np.arange(0, 2*ARRAY_MAX)
+    x, y = Bitmap.from_ids(sparse), Bitmap.from_ids(dense)
+    np.testing.assert_array_equal((x & y).to_array(), np.intersect1d(sparse, dense))
+    np.testing.assert_array_equal((y & x).to_array(), np.intersect1d(sparse, dense))
+    np.testing.assert_array_equal((y - x).to_array(), np.setdiff1d(dense, sparse))
+    np.testing.assert_array_equal((x - y).to_array(), np.setdiff1d(sparse, dense))
+    assert (x - x).to_array().size == 0 and len(Bitmap() | x) == len(sparse)
+    assert 1 in y and 2*ARRAY_MAX not in y and CHUNK // 100 in x
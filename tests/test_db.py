@@ -0,0 +1,42 @@
+'''After a reconnect, a session replays only the current builds of its temp tables'''
+import pytest
+
+
+@pytest.fixture
+def connection(tmp_path):
+    pytest.importorskip("duckdb")
+    from db import DbSession
+    connection = DbSession("duckdb:" + str(tmp_path / "test.duckdb"), name="tests")
+    yield connection
+    connection.close()
+
+
+def test_reconnect(connection):
+    connection.execute("SELECT * INTO #a FROM (SELECT 1 AS x) q")
+    connection.execute("SELECT * INTO #b FROM (SELECT x + 1 AS y FROM #a) q")
+    # rebuilding #a leaves #b built from its old contents
+    connection.execute("SELECT * INTO #a FROM (SELECT 5 AS x) q")
+    connection.execute("CREATE TABLE #c (v INT)")
+    connection.insert_rows("#c", ["v"], [(1,), (2,)])
+    connection.execute("SELECT * INTO #d FROM (SELECT x * 2 AS z FROM #a) q")
+    connection.execute("DROP TABLE #d")
+    connection.read_sql("SELECT * FROM #c")
+
+    replayed = connection._replay(connection._history)
+    assert len(replayed) == 3
+    assert not any("#b" in batch or "#d" in batch for batch, params in replayed)
+
+    connection._reconnect()
+    assert connection.read_sql("SELECT * FROM #a")["x"].tolist() == [5]
+    assert sorted(connection.read_sql("SELECT * FROM #c")["v"]) == [1, 2]
+    assert not connection.has_table("#b")
+    assert not connection.has_table("#d")
+    assert list(connection._history) == ["#a", "#c"]
+
+
+def test_reconnect_staged(staged):
+    from staging import STAGED
+    counts = "SELECT COUNT(*) AS n FROM {}"
+    before = {table: staged.read_sql(counts.format(table))["n"][0] for table in STAGED}
+    staged._reconnect()
+    assert {table: staged.read_sql(counts.format(table))["n"][0] for table in STAGED} == before
@@ -0,0 +1,11 @@
+'''Codelists are loaded into keyed tables, so a code can only be in one of the lists'''
+import pytest
+
+from queries import load_codelists
+
+
+def test_overlapping_codelists():
+    with pytest.raises(ValueError, match="'123'"):
+        load_codelists(None, drugs={"warfarin": ["123", "456"], "DOAC": [789, 123]})
+    with pytest.raises(ValueError, match="CTV3"):
+        load_codelists(None, drugs={"warfarin": ["123", "123"]}, ctv3={"inr": ["X1"], "high_inr": ["X1"]})
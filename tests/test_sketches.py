@@ -0,0 +1,29 @@
+'''T-digests are exact while they hold few distinct values, and close to the exact quantiles after that'''
+import numpy as np
+import pytest
+
+from sketches import TDigest
+
+
+def test_exact_quantiles():
+    '''With no more distinct values than the compression, quantiles are the first value reaching them'''
+    values = np.array([2.5, 1.0, 3.0, 2.5, 8.0, 1.0, 2.0, 4.5])
+    digest = TDigest().add(values[:5]).merge(TDigest().add(values[5:]))
+    assert digest.exact and digest.count == len(values)
+    # sorted: 1, 1, 2, 2.5, 2.5, 3, 4.5, 8
+    np.testing.assert_array_equal(digest.quantile([0.1, 0.25, 0.5, 0.75, 1.0]), [1.0, 1.0, 2.5, 3.0, 8.0])
+    assert digest.below(2.5) == 3 and digest.bins([0, 2, 3]).tolist() == [2, 3, 3]
+
+
+def test_weighted_values():
+    digest = TDigest().add([1.0, 2.0, 3.0], weights=[1, 3, 1])
+    assert digest.quantile(0.5) == 2.0 and digest.mean() == 2.0
+
+
+def test_approximate_quantiles():
+    values = np.random.default_rng(1).normal(70, 15, 50000)
+    digests = [TDigest().add(part) for part in np.array_split(values, 5)]
+    digest = digests[0].merge(*digests[1:])
+    assert not digest.exact and len(digest.means) <= digest.compression
+    np.testing.assert_allclose(digest.quantile([0.25, 0.5, 0.75]), np.percentile(values, [25, 50, 75]), atol=0.2)
+    assert TDigest.from_dict(digest.to_dict()).quantile(0.5) == pytest.approx(digest.quantile(0.5))
@@ -0,0 +1,46 @@
+'''Timelines written to the store read back unchanged, whole, in blocks of patients, and one patient at a time'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from timelines import Timelines, ARRAYS, INR_CODE, TTR_CODE
+from store import TimelineStore
+
+
+@pytest.fixture
+def timelines():
+    issues = pd.DataFrame({"Patient_ID": [3, 1, 1, 7, 3, 1],
+                           "MultilexDrug_ID": ["w1", "d1", "w1", "d2", "w1", "w2"],
+                           "anticoag": ["warfarin", "DOAC", "warfarin", "DOAC", "warfarin", "warfarin"],
+                           "StartDate": pd.to_datetime(["2020-01-05", "2020-03-01", "2019-12-01", "2020-02-10",
+                                                        "2019-11-20", "2019-12-01"])})
+    repeats = pd.DataFrame({"Patient_ID": [1, 3], "anticoag": ["DOAC", "warfarin"],
+                            "StartDate": pd.to_datetime(["2020-03-01", "2019-06-01"]),
+                            "EndDate": pd.to_datetime([None, "2020-02-01"])})
+    events = pd.DataFrame({"Patient_ID": [3, 3, 5], "CTV3Code": [INR_CODE, TTR_CODE, INR_CODE],
+                           "ConsultationDate": pd.to_datetime(["2020-01-10", "2020-01-10", "2020-04-01"]),
+                           "NumericValue": [2.5, 71.0, np.nan]})
+    return Timelines(issues, repeats, events)
+
+
+def test_round_trip(timelines, tmp_path):
+    store = TimelineStore.write(timelines, path=str(tmp_path / "timelines"))
+    assert len(store) == 4
+    out = TimelineStore(str(tmp_path / "timelines")).timelines()
+    np.testing.assert_array_equal(out.drugs, timelines.drugs)
+    for name in ARRAYS:
+        np.testing.assert_array_equal(getattr(out, name), getattr(timelines, name), err_msg=name)
+
+    # blocks of patients cover every row once, in order
+    blocks = [store.timelines(first, last) for first, last in store.partitions(3)]
+    for name in ARRAYS:
+        np.testing.assert_array_equal(np.concatenate([getattr(b, name) for b in blocks]), getattr(timelines, name))
+
+
+def test_patient(timelines, tmp_path):
+    store = TimelineStore.write(timelines, path=str(tmp_path / "timelines"))
+    one = store.patient(1)
+    assert one["issues"]["MultilexDrug_ID"].tolist() == ["w1", "w2", "d1"]
+    assert one["repeats"]["EndDate"].isna().all() and one["events"].empty
+    assert store.patient(5)["events"]["CTV3Code"].tolist() == [INR_CODE]
+    assert all(df.empty for df in store.patient(2).values())
@@ -0,0 +1,121 @@
+'''The in-memory switching and DOAC repeat engines give the same results as the SQL'''
+import pandas as pd
+import pytest
+
+from queries import PERIODS, Template, get_template
+from incremental import add_months
+from sections import SWITCHING_PERIODS, switching
+from timelines import (Timelines, switching_summary, doac_types, doac_repeats_summary, repeats_summary,
+                       period_windows, windows_summary)
+
+
+def _same(actual, expected, by):
+    '''Compare two result tables regardless of row order and integer/object dtypes'''
+    columns = list(expected.columns)
+    actual, expected = [df.astype({c: str for c in by}).sort_values(by).reset_index(drop=True)[columns]
+                        for df in (actual, expected)]
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("period", list(SWITCHING_PERIODS))
+def test_switching(staged, timelines, period):
+    summary, types = switching(staged, SWITCHING_PERIODS[period])
+    assert summary["baseline_warfarin_patients"].sum() > 0 and len(types) > 0
+
+    out = timelines.switching(SWITCHING_PERIODS[period])
+    _same(switching_summary(out), summary, by=["year"])
+    _same(doac_types(out), types, by=["first_doac_type", "year"])
+
+
+@pytest.mark.parametrize("period", list(SWITCHING_PERIODS))
+def test_switching_windows(staged, timelines, period):
+    '''The two windows of a notebook period, computed together, match its two years'''
+    summary, types = switching(staged, SWITCHING_PERIODS[period])
+    windows = period_windows(SWITCHING_PERIODS[period], period)
+    out = windows_summary(timelines.switching_windows(windows), windows)
+    assert list(out["window"].unique()) == [f"{period} 2020", f"{period} 2019"]
+
+    out["year"] = out["window"].str[-4:]
+    overall = out[out["measure"] != "switch_to_type"].pivot(index="year", columns="measure", values="patient_count")
+    _same(overall.rename_axis(columns=None).reset_index(), summary, by=["year"])
+    switched = out[out["measure"] == "switch_to_type"]
+    _same(switched[["first_doac_type", "year", "patient_count"]], types, by=["first_doac_type", "year"])
+
+
+def test_doac_repeats(staged, timelines):
+    start = '20190101'
+    staged.run("doac_repeats/doacR", start=start)
+    staged.run("doac_repeats/warfdoac", start=add_months(start, -7))
+    staged.run("doac_repeats/out")
+    expected = staged.read("doac_repeats/summary")
+    assert expected["patient_count"].sum() > 0
+
+    out = doac_repeats_summary(timelines.doac_repeats(start))
+    out["doacStartmonth"] = pd.to_datetime(out["doacStartmonth"])
+    expected["doacStartmonth"] = pd.to_datetime(expected["doacStartmonth"])
+    _same(out, expected, by=["doacStartmonth", "switch_flag", "new_flag"])
+
+
+def test_period_windows():
+    windows = period_windows(SWITCHING_PERIODS["March-May"], "March-May")
+    dates = dict(zip(PERIODS, pd.to_datetime(SWITCHING_PERIODS["March-May"])))
+    assert windows.loc[0, "b_start"] == dates["b_start_2020"] and windows.loc[1, "f_end"] == dates["f_end_2019"]
+
+
+def test_repeats():
+    '''One row per patient and month issued an anticoagulant, however many repeats cover it'''
+    issues = pd.DataFrame({"Patient_ID": [1, 1, 1, 2],
+                           "MultilexDrug_ID": ["w1", "w1", "d1", "d1"],
+                           "anticoag": ["warfarin", "warfarin", "DOAC", "DOAC"],
+                           "StartDate": pd.to_datetime(["2020-01-06", "2020-02-03", "2020-03-02", "2020-04-01"])})
+    # patient 1: two overlapping warfarin repeats, then a DOAC repeat started on the same day as a warfarin repeat
+    # which was cancelled (ended the day it started). Patient 3 has a repeat but no issues
+    repeats = pd.DataFrame({"Patient_ID": [1, 1, 1, 1, 3],
+                            "anticoag": ["warfarin", "warfarin", "DOAC", "warfarin", "DOAC"],
+                            "StartDate": pd.to_datetime(["2019-12-02", "2020-01-06", "2020-02-10", "2020-02-10",
+                                                         "2020-01-01"]),
+                            "EndDate": pd.to_datetime(["2020-03-20", "2020-02-28", "2020-05-01", "2020-02-10",
+                                                       "2020-06-01"])})
+    out = Timelines(issues, repeats).repeats("20200101")
+
+    assert list(zip(out["Patient_ID"], out["issuemonth"])) == [
+        (1, pd.Timestamp("2020-01-01")), (1, pd.Timestamp("2020-02-01")), (1, pd.Timestamp("2020-03-01")),
+        (2, pd.Timestamp("2020-04-01"))]
+    flags = {"warf_repeat": [1, 1, 1, 0], "doac_repeat": [0, 1, 1, 0], "started_same_date": [0, 1, 0, 0],
+             "started_same_date_warf_cancelled": [0, 1, 0, 0], "started_same_date_doac_cancelled": [0, 0, 0, 0]}
+    for flag, expected in flags.items():
+        assert out[flag].tolist() == expected, flag
+
+    summary = repeats_summary(out).set_index("issuemonth")
+    assert summary["total_patients"].tolist() == [1, 1, 1, 1]
+    assert summary["warf_repeat"].tolist() == [1, 1, 1, 0]
+    assert summary.loc["2020-02-01", "warfarin_cancelled"] == 1
+
+
+def test_doac_repeats_sweep(staged, timelines):
+    '''Each grace period of the sweep matches doac_repeats/out with that grace period in place of 3 months'''
+    start = '20190101'
+    graces = range(13)
+    sweep = timelines.doac_repeats_sweep(start, graces)
+    staged.run("doac_repeats/doacR", start=start)
+    # the sweep looks back as far as its longest grace period
+    staged.run("doac_repeats/warfdoac", start=add_months(start, -max(graces)))
+    template = get_template("doac_repeats/out")
+    assert template.sql.count("doacStartmonth_key - 3") == 2
+    columns = ["not previously taking warfarin", "previously taking warfarin", "total"]
+    for grace in graces:
+        sql = template.sql.replace("doacStartmonth_key - 3", f"doacStartmonth_key - {grace}")
+        staged.run(Template(f"doac_repeats/out_{grace}", sql, into=template.into))
+        df = staged.read("doac_repeats/summary")
+        df = df.loc[df["new_flag"] == 1]
+        expected = df.pivot_table(index="doacStartmonth", columns="switch_flag", values="patient_count", aggfunc="sum",
+                                  fill_value=0).reindex(columns=[0, 1], fill_value=0)
+        expected.columns = columns[:2]
+        expected["total"] = expected.sum(axis=1)
+        expected.index = pd.to_datetime(expected.index)
+        assert expected["total"].sum() > 0
+
+        out = sweep.loc[sweep["switch_grace"] == grace].set_index("doacStartmonth")[columns]
+        out.index = pd.to_datetime(out.index)
+        out = out.loc[out["total"] > 0]
+        pd.testing.assert_frame_equal(out, expected.rename_axis("doacStartmonth"), check_dtype=False, obj=str(grace))